@@ -1,13 +1,21 @@
+import os
 import time
 import logging
 import threading
-from time import sleep
-from base64 import b64decode
 
 from Transports.mult_transport import MultTransport
 from configurable import choose_source, detect_multicast
 from Utils import *
-from track import Track
+from Utils.ports import PortAllocator
+from Utils.backend import get_backend
+from Utils.metrics import Metrics
+from Utils.expiry import SessionExpiry
+from Utils.tunnel import TunnelDecoder
+from Utils.rtp import report_blocks
+from Utils.rtsp_parser import RTSPParser, Request
+from track import Track, play_tracks, seek_point, warm_start
+from renditions import RateAdapter
+from transcode_cache import TranscodeCache, RETRY_AFTER
 from Transports import *
 
 class RTSPSession:
@@ -15,7 +23,7 @@ class RTSPSession:
         # content-unrelated options
         self.parent_server = parent_server
         self.rconn = conn
-        self.wconn = conn
+        self.wconn = get_backend().egress(conn)
         self.addr = addr
         self.session_id = sid
         self.xsc = None
@@ -24,8 +32,10 @@ class RTSPSession:
         self.tracks = {}
         self.expected_video_tracks = None
         self.expected_audio_tracks = None
+        self.codecs = None
         self.url = None
         self.content_source = None
+        self.transcoded = None  # rendition pinned in the TranscodeCache, released at teardown
 
         # state-related
         # states: 1 - init, 2 - ready, 3 - playing, 0 - torn down
@@ -34,11 +44,17 @@ class RTSPSession:
         self.transport_mode = None # "udp_u", "tcp", "http", "udp_m"
         self.play_start_time = None
         self.play_offset = 0
-        self.last_activity = threading.Event()
-        self.last_activity.set()
+        self.play_end = None  # end of the Range of the last PLAY
+        self.play_requested = None  # when the last PLAY came in, until its first packet is sent
+        self.play_mode = None  # how the last PLAY was served: "cold", "warm", "store"; None for shared live sources
+        self.live_epoch = None  # when the shared live tracks' packets at the RTP-Info rtptime were received; see Track.anchor
+        self.timeout = Config().get("session_timeout", 60)
+        self.expires = time.monotonic() + self.timeout  # moved on by requests and RTCP from the client
 
         self.ssrcs = None
         self.rates = None
+        self.reports = {}  # track_id -> last RTCP receiver report from the client
+        self.adapter = None  # RateAdapter of VoD titles that have renditions
         self.duration = None
         self.prepare_mc = False
         self.mcip = None
@@ -47,77 +63,96 @@ class RTSPSession:
         self.compat_mode = Config().get("always_compat")
         # live mode; 0 - not live; 1 - forced live; 2 - true live
         self.live_mode = Config().get("force_live")
-
-        threading.Thread(target=self.handle_requests).start()
-        threading.Thread(target=self.timeout_watchdog, daemon=True).start()
-
-    def handle_rtsp(self, request_text):
-        cseq = extract_cseq(request_text)
+        self.parser = RTSPParser()
+        self.tunnel = None  # TunnelDecoder once this connection is the POST half of an HTTP tunnel
+        self.handed_off = False  # the connection went to another worker process
+
+    def start(self, data=b""):
+        """data: already received, e.g. by the worker that handed the connection over"""
+        threading.Thread(target=self.handle_requests, args=(data,)).start()
+        SessionExpiry().watch(self)
+
+    def handle_rtsp(self, request):
+        """Dispatch a parsed Request by its method"""
+        cseq = request.cseq
         err = 0
-        logging.debug(f"Received request:\n{request_text}")
-        if "OPTIONS" in request_text:
-            self.handle_options(request_text, cseq)
-        elif "DESCRIBE" in request_text:
+        logging.debug(f"Received request:\n{request}")
+        method = request.method
+        if method == "OPTIONS":
+            self.handle_options(request, cseq)
+        elif method == "DESCRIBE":
             if self.state >= 1: # init or above
-                self.handle_describe(request_text, cseq)
+                self.handle_describe(request, cseq)
             else: err = 455
-        elif "SETUP" in request_text:
+        elif method == "SETUP":
             if self.state in (1, 2): # init or ready
-                self.handle_setup(request_text, cseq)
+                self.handle_setup(request, cseq)
             else: err = 455
-        elif "PLAY" in request_text:
+        elif method == "PLAY":
             if self.state == 2: # ready
-                self.handle_play(request_text, cseq)
+                self.handle_play(request, cseq)
             else:
                 err = 455
-        elif "PAUSE" in request_text:
+        elif method == "PAUSE":
             if self.state == 3: # playing
                 self.handle_pause(cseq)
             else: err = 455
-        elif "TEARDOWN" in request_text:
+        elif method == "TEARDOWN":
             if self.state >= 1:
                 self.teardown(cseq)
             else: err = 455
-        elif "GET / HTTP/1.1" in request_text:
-            self.handle_http_get(request_text)
-        elif "POST / HTTP/1.1" in request_text:
-            self.handle_http_post(request_text)
+        elif method in ("GET_PARAMETER", "SET_PARAMETER"):
+            self.handle_parameter(request, cseq)
+        elif method == "GET" and request.version.startswith("HTTP/"):
+            self.handle_http_get(request)
+        elif method == "POST" and request.version.startswith("HTTP/"):
+            self.handle_http_post(request)
         else:
-            logging.warning(f"Unknown command:\n{request_text}")
-            err = get_cmd_err_code(request_text)
+            logging.warning(f"Unknown command:\n{request}")
+            err = get_cmd_err_code(method)
+            method = "other"  # clients pick these, keep them out of metric labels
+        Metrics().inc("requests_total", method=method)
 
         if err: self.send_err(err, cseq)
 
     def handle_options(self, request_text, cseq):
-        self.compat_mode = self.compat_mode or detect_legacy_client(request_text)
+        self.compat_mode = self.compat_mode or is_legacy_user_agent(request_text.header("user-agent", ""))
         self.prepare_mc = detect_multicast(request_text)
         self.live_mode = self.live_mode or self.compat_mode or (self.prepare_mc and not Config().get("multicast_admins"))
-        resp = [f"Public: OPTIONS, DESCRIBE, SETUP, PLAY, {"PAUSE, " if not self.live_mode else ""}TEARDOWN"]
+        resp = [f"Public: OPTIONS, DESCRIBE, SETUP, PLAY, {"PAUSE, " if not self.live_mode else ""}TEARDOWN, "
+                "GET_PARAMETER, SET_PARAMETER"]
         self.send_response(cseq, resp, False)
 
+    def handle_parameter(self, request, cseq):
+        """GET_PARAMETER is how most clients keep a session alive; the request itself refreshed it.
+        There are no parameters to get, and none that can be set"""
+        if request.method == "SET_PARAMETER" and request.body.strip():
+            self.send_err(451, cseq)
+            return
+        self.send_response(cseq, [], self.state != 1)
+
     def handle_describe(self, request_text, cseq):
-        self.url = request_text.splitlines()[0].split()[1]
+        self.url = request_text.url
 
         self.content_source, temp = choose_source(request_text)
         if self.content_source is None:
             self.send_err(404, cseq)
             return
         if temp: self.live_mode = 2  # True live mode
+        if not self.transcode_source(request_text, cseq): return
 
         if self.prepare_mc:
             self.find_multicast_session()
             if self.multicast_host:
-                last_oct = Config().get_mcip()
+                last_oct = PortAllocator().allocate_mcip(self.session_id)
                 if last_oct is not None:
-                    Config().mcip_set_used(last_oct)
                     self.mcip = Config().get("mc_ip_base") + str(last_oct)
                     self.url = f"rtsp://{self.mcip}:8554"
 
-        p = Config().get_free_port("sdp")
-        Config().port_set_used(p)
         addr = strip_addr(self.url)
-        res = generate_sdp(self.content_source, addr, p, self.live_mode, self.compat_mode)
-        Config().port_set_free(p)
+        started = time.monotonic()
+        res = generate_sdp(self.content_source, addr, self.live_mode, self.compat_mode)
+        Metrics().observe("sdp_generation_seconds", time.monotonic() - started)
 
         sdp_bytes = res["sdp"].encode()
         resp = [
@@ -132,19 +167,37 @@ class RTSPSession:
 
         self.expected_video_tracks = res["vtracks"]
         self.expected_audio_tracks = res["atracks"]
+        self.codecs = res["codecs"]
         self.rates = res["rates"]
         if not self.ssrcs:
             self.ssrcs = res["ssrcs"]
             self.state = 1  # init_s
             self.duration = res["len"]
+        # renditions need timestamps rewritten onto the session timeline, and are for unicast VoD only
+        if (self.adapter is None and Config().get("renditions", True) and not self.live_mode and not self.prepare_mc
+                and not Config().get("random_ts")):
+            self.adapter = RateAdapter(self)
+
+    def transcode_source(self, request_text, cseq):
+        """Swaps the title for its rendition in the client's transcode profile.
+        False if the rendition isn't ready yet and the client was told to retry"""
+        profile = transcode_profile(request_text.header("user-agent", ""))
+        if profile is None or self.live_mode == 2 or not os.path.isfile(self.content_source): return True
+        path = TranscodeCache().acquire(self.content_source, profile, Config().get("transcode_wait", 10))
+        if path is None:
+            logging.info(f"Session {self.session_id}: {self.content_source} is still being transcoded to {profile}")
+            self.send_err(503, cseq, [f"Retry-After: {RETRY_AFTER}"])
+            return False
+        if self.transcoded: TranscodeCache().release(self.transcoded)  # DESCRIBEd again
+        self.transcoded = path if path != self.content_source else None
+        self.content_source = path
+        return True
 
     def handle_setup(self, request_text, cseq):
         """Detect transport type, redirect to parser if supported or send an error message"""
-        track_match = re.search(r'trackID=(\d+)', request_text)
+        track_match = re.search(r'trackID=(\d+)', request_text.url)
         track_id = int(track_match.group(1)) if track_match else 0
-
-        lines = request_text.splitlines()
-        transport_line = next((l for l in lines if l.lower().startswith("transport:")), "")
+        transport_line = request_text.header("transport", "")
 
         # detect protocol
         is_http = self.transport_mode == "http"
@@ -177,27 +230,26 @@ class RTSPSession:
         elif is_udp_m:
             self.transport_mode = "udp_m"
             if self.transport is None:
-                self.find_multicast_session()
+                # created up front, so the group never has a host without a transport; replaced when joining one
+                self.transport = MultTransport(self)
+                self.find_multicast_session(claim=True)
                 self.state = 2  # ready
-                if self.multicast_host:
-                    self.transport = MultTransport(self)
             if not self.multicast_host:
+                self.state = 2  # ready; viewers that joined at DESCRIBE never went through the branch above
                 self.generate_setup_response(track_id, cseq)
                 return
             parse_udp_m(track_id, self.transport)
 
 
         track = Track(self, track_id, self.ssrcs[track_id])
-        if track_id < self.expected_video_tracks:
-            track.selector = ["-an", "-map", f"0:v:{track_id}", "-c:v", "copy", "-payload_type", "96"]
-            track.clock_rate = self.rates[track_id]
-        else:
-            track.selector = ["-vn", "-map", f"0:a:{track_id-self.expected_video_tracks}", "-c:a", "copy", "-payload_type", "97"]
-            track.clock_rate = self.rates[track_id]
+        track.selector = track_selector(track_id, self.expected_video_tracks)
+        track.clock_rate = self.rates[track_id]
         self.tracks[track_id] = track
         self.transport.conf_track(track)
         self.generate_setup_response(track_id, cseq)
         self.state = 2  # ready
+        if Config().get("warm_start") and len(self.tracks) == len(self.rates):
+            warm_start(self.tracks.values(), self.play_offset)
 
     def generate_setup_response(self, track_id, cseq):
         # only TCP and UDP unicast are implemented right now
@@ -220,23 +272,31 @@ class RTSPSession:
                 f"port={self.transport.track_map[track_id][0]}-{self.transport.track_map[track_id][1]};"
                 f"ttl={ttl}"
             )
-        self.send_response(cseq, [transport_line])
-
-    def find_multicast_session(self):
-        """Finds the session with the same source file and gets its Transport instance"""
-        for session in self.parent_server.sessions.values():
-            if session is self: continue
-            if session.transport_mode == "udp_m" and session.content_source == self.content_source:
-                self.transport = session.transport
-                self.transport.watching += 1
-                self.tracks = session.tracks
-                return
+        self.send_response(cseq, [transport_line], timeout=True)
+
+    def find_multicast_session(self, claim=False):
+        """Finds the session hosting the source's multicast group and gets its Transport instance.
+        With claim (on SETUP, transport already created) this session becomes the host if there's none"""
+        session = self.parent_server.registry.multicast_group(self.content_source, self if claim else None)
+        if session is not None and session is not self:
+            self.transport = session.transport
+            self.transport.watching += 1
+            self.tracks = session.tracks
+            if self.mcip is not None:
+                # another DESCRIBE got here first and hosts the group; the address this one took isn't used
+                PortAllocator().release_mcip(int(self.mcip.split(".")[-1]))
+                self.mcip = None
+            self.multicast_host = False
+            self.url = session.url  # SETUP responses point viewers at the host's group
+            return
         self.multicast_host = True
 
     def handle_http_get(self, request):
         self.transport_mode = "http"
-        self.xsc = extract_xsc(request)
+        self.xsc = request.header("x-sessioncookie", 0)
         logging.debug(f"xsc: {self.xsc}")
+        self.parent_server.registry.add_http_get(self.xsc, self)
+        if self.parent_server.link is not None: self.parent_server.link.announce_tunnel(self.xsc)
         if Config().get("allow_http"):
             self.wconn.send(get_http_resp())
         else:
@@ -245,23 +305,23 @@ class RTSPSession:
     def handle_http_post(self, headers):
         self.transport_mode = "http"
         swapped = False
-        self.xsc = extract_xsc(headers)
-        for session in self.parent_server.sessions.values():
-            if session is self: continue
-            if session.xsc == self.xsc:
-                self.wconn = session.rconn
-                logging.debug(f"HTTP mode: swapped connection successfully")
-                session.teardown(None)
-                swapped = True
-                break
+        self.xsc = headers.header("x-sessioncookie", 0)
+        session = self.parent_server.registry.pop_http_get(self.xsc)
+        if session is not None and session is not self:
+            self.wconn = session.wconn
+            logging.debug(f"HTTP mode: swapped connection successfully")
+            session.teardown(None)
+            swapped = True
         if not swapped:
            logging.error("HTTP mode: failed to find session with xsc: %s", self.xsc)
         self.rconn.send(get_http_resp())
 
     def handle_play(self, request, cseq):
+        self.play_requested = time.monotonic()
+        self.play_mode = None
         self.transport.on_play()
         # reuse old offset or extract new one from request
-        start_time, end_time = parse_range(request, self.play_offset)  # self.play_offset is a default value
+        start_time, end_time = parse_range(request.header("range", ""), self.play_offset)  # self.play_offset is a default value
         to_err = False
         if self.live_mode and start_time != self.play_offset: to_err = True
         if end_time is not None and end_time < start_time: to_err = True
@@ -275,23 +335,30 @@ class RTSPSession:
                 self.send_err(416, cseq)
                 return
             if end_time is not None and end_time > self.duration: end_time = self.duration
-        self.play_offset = start_time
+        self.play_offset = seek_point(self, start_time)
+        self.play_end = end_time
 
         # collect RTP-Info from tracks
         rtp_info = []
         zero_rtptime = self.compat_mode or Config().get("report_zero_rtptime")
         for track in self.tracks.values():
-            if not self.transport_mode == "udp_m" or self.multicast_host:
-                while track.proc: sleep(0.1)
             rtp_info.append(track.get_rtpinfo(zero_rtptime))
 
         self.send_response(cseq, [f"Range: npt={self.play_offset:.3f}-", f"RTP-Info: {",".join(rtp_info)}"])
+        logging.debug(f"Session {self.session_id}: PLAY answered in {(time.monotonic() - self.play_requested)*1000:.1f} ms")
         self.state = 3  # playing
         if not self.transport_mode == "udp_m" or self.multicast_host:
-            for track in self.tracks.values():
-                track.on_play(self.play_offset, end_time)
+            play_tracks(self.tracks.values(), self.play_offset, end_time)
         self.play_start_time = time.monotonic()
 
+    def on_first_packet(self):
+        """Called by the first track to send a packet after PLAY"""
+        requested, self.play_requested = self.play_requested, None
+        if requested is not None:
+            delay = time.monotonic() - requested
+            Metrics().observe("first_packet_seconds", delay, mode=self.play_mode or "shared")
+            logging.info(f"Session {self.session_id}: first packet {delay*1000:.1f} ms after PLAY ({self.play_mode or "shared"})")
+
     def handle_pause(self, cseq):
         if self.live_mode or (self.transport_mode == "udp_m" and not decide_multicast(self)):
             self.send_err(455, cseq)
@@ -300,10 +367,11 @@ class RTSPSession:
         self.play_offset += time.monotonic() - self.play_start_time
         self.play_start_time = None
         self.send_response(cseq, [])
+        if self.adapter is not None: self.adapter.reset()
         self.transport.on_pause()
         self.state = 2  # ready
         for t in self.tracks.values():
-            t.on_pause()
+            t.on_pause(kill=True)  # RTP output has nothing to finalize, and PLAY waits for the exit
 
     def teardown(self, cseq):
         td_tracks = True
@@ -313,56 +381,114 @@ class RTSPSession:
         if td_tracks:
             for track in self.tracks.values(): track.teardown()
             if self.transport: self.transport.on_teardown()
-            if self.mcip:
-                octet = int(self.mcip.split(".")[-1])
-                Config().mcip_set_free(octet)
+            # the last viewer may tear down a group whose host left; the address and ports are the host's
+            owner = self.parent_server.registry.end_multicast_group(self) if self.transport_mode == "udp_m" else self
+            if owner.mcip:
+                octet = int(owner.mcip.split(".")[-1])
+                PortAllocator().release_mcip(octet)
+                owner.mcip = None
+            PortAllocator().owner_done(owner.session_id)
+        if self.transcoded:
+            TranscodeCache().release(self.transcoded)
+            self.transcoded = None
 
         if cseq is not None:
             try: self.send_response(cseq, [])
             except BrokenPipeError: pass
-            self.rconn.close()
             self.wconn.close()
+            self.rconn.close()
 
         self.state = 0  # torn down
         self.parent_server.delete_session(self.session_id)
 
-    def handle_requests(self):
-        try:
-            buffer = b""
-            while True:
+    def drop(self, reason):
+        """Tear down and disconnect from outside request handling, e.g. from a relay when the client can't keep up"""
+        if self.state == 0: return
+        logging.warning(f"Session {self.session_id}: {reason}, disconnecting")
+        get_backend().defer(self.disconnect)
+
+    def disconnect(self):
+        if self.state != 0: self.teardown(None)
+        self.wconn.close()
+        self.rconn.close()
 
-                self.last_activity.set()
-                data = self.rconn.recv(1024)
+    def handle_requests(self, data=b""):
+        try:
+            if data: self.on_bytes(data)
+            while not self.handed_off:
+                data = self.rconn.recv(16384)
                 if not data: break
-                buffer += data
-
-                while True:
-                    try: buffer_d = b64decode(buffer, validate=False)
-                    except: buffer_d = b""
-
-                    parse_b64 = False
-                    headers_end = buffer.find(b"\r\n\r\n")
-                    headers_end_d = buffer_d.find(b"\r\n\r\n")
-
-                    if headers_end == -1: parse_b64 = True
-                    else: headers_end += 4
-                    if parse_b64 and headers_end_d == -1: break
-                    else: headers_end_d += 4
-
-                    if not parse_b64:
-                        headers = buffer[:headers_end].decode("utf-8", errors="ignore")
-                        buffer = buffer[headers_end:]
-                        self.handle_rtsp(headers)
-                    else:
-                        headers = buffer_d[:headers_end_d].decode("utf-8", errors="ignore")
-                        buffer = b""
-                        self.handle_rtsp(headers)
+                self.on_bytes(data)
         except Exception as e:
             logging.warning(f"[{self.addr}]: Error: {e}")
 
-    def send_response(self, cseq, data, add_session=True):
+    def on_bytes(self, data):
+        """Parse received bytes and handle every complete request in them.
+        After the POST of an HTTP tunnel, everything on the connection is base64 and is decoded first"""
+        self.touch()
+        if self.tunnel is not None:
+            data = self.tunnel.feed(data)
+        msgs = self.parser.feed(data)
+        for i, msg in enumerate(msgs):
+            if not isinstance(msg, Request):
+                self.on_interleaved(*msg)
+                continue
+            route = self.handoff_route(msg)
+            if route is not None:
+                self.hand_off(route, msgs[i:])
+                return
+            # switch before handling: the asyncio core only queues the request, and the rest may already be here
+            if msg.method == "POST" and self.tunnel is None:
+                self.tunnel = TunnelDecoder()
+                self.handle_rtsp(msg)
+                rest = self.parser.take_rest()
+                if rest: self.on_bytes(rest)
+                return
+            self.handle_rtsp(msg)
+
+    def handoff_route(self, request):
+        """Where the connection has to go from request on if another worker process serves it, or None"""
+        link = self.parent_server.link
+        if link is None or self.state != 1 or self.transport is not None or self.tunnel is not None: return None
+        if request.method == "OPTIONS" and link.index != 0 and detect_multicast(request):
+            return ["multicast"]  # worker 0 hosts every multicast group
+        if request.method == "POST" and request.version.startswith("HTTP/"):
+            xsc = request.header("x-sessioncookie", 0)
+            if not self.parent_server.registry.has_http_get(xsc): return ["tunnel", xsc]
+        return None
+
+    def hand_off(self, route, msgs):
+        """Pass the connection to the worker the supervisor routes it to, with msgs and what follows them unhandled"""
+        data = b"".join(m.encode() + m.body for m in msgs if isinstance(m, Request)) + self.parser.take_rest()
+        fd = self.rconn.detach()
+        try: self.parent_server.link.hand_off(fd, route, data)
+        finally: os.close(fd)
+        self.handed_off = True
+        self.state = 0
+        self.parent_server.delete_session(self.session_id)
+        logging.debug(f"Session {self.session_id}: handed the connection from {self.addr} over ({route[0]})")
+
+    def on_interleaved(self, channel, payload):
+        """$-framed data from the client, i.e. RTCP receiver reports of TCP sessions"""
+        if self.transport_mode in ("tcp", "http") and any(channel == chans[1] for chans in self.transport.track_map.values()):
+            self.on_rtcp(payload)
+
+    def on_rtcp(self, data):
+        """RTCP from the client; keeps the last receiver report about each track"""
+        self.touch()
+        for ssrc, fraction_lost, lost, highest_seq, jitter in report_blocks(data):
+            track = next((t for t in list(self.tracks.values()) if t.ssrc == ssrc), None)
+            if track is None: continue
+            jitter = jitter / track.clock_rate if track.clock_rate else 0.0
+            self.reports[track.track_id] = {"fraction_lost": fraction_lost, "lost": lost, "highest_seq": highest_seq,
+                                            "jitter": jitter, "time": time.monotonic()}
+            logging.debug(f"Session {self.session_id}, track {track.track_id}: {fraction_lost:.1%} lost, {lost} total, "
+                          f"jitter {jitter*1000:.1f} ms")
+            if self.adapter is not None: self.adapter.on_report(track, fraction_lost)
+
+    def send_response(self, cseq, data, add_session=True, timeout=False):
         resp = f"RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\n"
-        if add_session: resp += f"Session: {self.session_id}\r\n"
+        if add_session: resp += f"Session: {self.session_id}{f";timeout={self.timeout}" if timeout else ""}\r\n"
         for s in data: resp += s + "\r\n"
         resp += "\r\n"
 
@@ -370,19 +496,23 @@ class RTSPSession:
         resp_bytes = resp.encode()
         self.wconn.send(resp_bytes)
 
-    def send_err(self, code, cseq=None):
+    def send_err(self, code, cseq=None, data=()):
         resp = get_err(code) + "\r\n"
         if cseq is not None:
             resp += f"CSeq: {cseq}\r\n"
+        for s in data: resp += s + "\r\n"
         resp += "\r\n"
         self.wconn.send(resp.encode())
 
-    def timeout_watchdog(self):
-        wait_time = Config().get("session_timeout")
-        while True:
-            self.last_activity.wait(wait_time)
-            if not self.last_activity.is_set() and not self.state == "torn_down":
-                logging.info(f"Connection from {self.addr} timed out")
-                if self.state != 0: self.teardown(None)
-                break
-            self.last_activity.clear()
\ No newline at end of file
+    def touch(self):
+        """The client is still there; cheap enough for every RTCP packet"""
+        self.expires = time.monotonic() + self.timeout
+
+    def expire(self):
+        """From SessionExpiry once nothing came from the client for session_timeout seconds"""
+        if self.state == 0: return
+        if self.expires > time.monotonic():
+            SessionExpiry().watch(self)  # touched while this was on its way
+            return
+        logging.info(f"Connection from {self.addr} timed out")
+        self.disconnect()
@@ -1,5 +1,6 @@
 from .transport_base import Transport
 from Utils import Config
+from Utils.ports import PortAllocator
 import socket
 
 class MultTransport(Transport):
@@ -13,24 +14,31 @@ class MultTransport(Transport):
         """Set target port for tracks"""
         # These ports will be used in relays to patch RTP packets
         if track.track_id in self.track_map:
-            p = Config().get_free_port("relay")
-            Config().port_set_used(p)
-            track.ffmpeg_target_port = p
+            track.ffmpeg_target_port = PortAllocator().allocate("relay", self.session.session_id)
 
     def on_play(self):
+        if self.sock is not None: return  # kept from the previous PLAY
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        interface = Config().get("multicast_interface")
+        if interface:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
 
     def on_traffic(self, data, track_id, relay_id):
         """Decide on socket and re-send data to all clients"""
         target_port = self.track_map[track_id][relay_id]
         self.sock.sendto(data, (self.session.mcip, target_port))
 
+    def on_batch(self, batch, track_id, relay_id):
+        target_port = self.track_map[track_id][relay_id]
+        batch.sendto(self.sock, (self.session.mcip, target_port))
+
     def on_pause(self):
-        self.sock.close()
+        pass
 
     def on_teardown(self):
         # free the ports
-        self.on_pause()
+        if self.sock is not None: self.sock.close()
+        self.sock = None
         for ports in self.track_map.values():
-            Config().port_set_free(ports[0])
\ No newline at end of file
+            PortAllocator().release(ports[0])
\ No newline at end of file
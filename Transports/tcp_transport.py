@@ -1,5 +1,9 @@
+import struct
 from .transport_base import Transport
 from Utils import Config
+from Utils.ports import PortAllocator
+from Utils.egress import FrameFilter
+from Utils.metrics import Metrics
 
 class TCPTransport(Transport):
     def __init__(self, session):
@@ -7,24 +11,53 @@ class TCPTransport(Transport):
         self.conn = self.session.wconn
         self.track_map = {}
         self.socks = {}
+        self.codecs = {}  # track_id -> codec of video tracks, for dropping whole frames when the client falls behind
+        self.filter = FrameFilter(f"Session {session.session_id}")
+        self.drop_session = Config().get("egress_overflow", "frames") == "session"
+        self.dropped = False
 
     def conf_track(self, track):
         """Set target port for tracks"""
         if track.track_id in self.track_map:
-            p = Config().get_free_port("relay")
-            Config().port_set_used(p)
-            track.ffmpeg_target_port = p
+            track.ffmpeg_target_port = PortAllocator().allocate("relay", self.session.session_id)
+        if track.track_id < (self.session.expected_video_tracks or 0):
+            self.codecs[track.track_id] = self.session.codecs[track.track_id]
 
     def on_play(self):
         pass
 
+    def admit(self, data, track_id, relay_id, pressure):
+        """Whether a packet still goes out; see Utils.egress.FrameFilter and egress_overflow in config.yaml"""
+        if self.dropped: return False
+        if pressure and self.drop_session:
+            self.dropped = True
+            self.session.drop("client can't keep up")
+            return False
+        codec = self.codecs.get(track_id) if relay_id == 0 else None
+        return self.filter.admit(track_id, codec, data, pressure)
+
     def on_traffic(self, data, track_id, relay_id):
         """Decide on channel and re-send data to client"""
+        if not self.admit(data, track_id, relay_id, self.conn.pressure()): return
         channel = self.track_map[track_id][relay_id]
-        # parse the RTP sequence number from the packet header
-        header = bytes([36, channel]) + len(data).to_bytes(2, 'big')
-        self.conn.send(header + data)
+        # interleaved frame header and payload go out in one scatter-gather call, without concatenating;
+        # the connection writes all of it, now or from its queue
+        self.conn.sendmsg([struct.pack("!BBH", 36, channel, len(data)), data])
 
+    def on_batch(self, batch, track_id, relay_id):
+        """Send the whole burst as interleaved frames in one sendmsg"""
+        channel = self.track_map[track_id][relay_id]
+        pressure = self.conn.pressure()
+        bufs = []
+        for data in batch.packets():
+            if not self.admit(data, track_id, relay_id, pressure): continue
+            bufs.append(struct.pack("!BBH", 36, channel, len(data)))
+            bufs.append(data)
+        if bufs: self.conn.sendmsg(bufs)
 
     def on_pause(self):
-        pass
\ No newline at end of file
+        pass
+
+    def on_teardown(self):
+        Metrics().inc("dropped_packets_total", self.filter.dropped)
+        self.filter.dropped = 0
\ No newline at end of file
@@ -11,9 +11,15 @@ class Transport:
         raise NotImplementedError("on_play not implemented")
 
     def on_traffic(self, data, track_id, relay_id):
-        """Re-pack and send data to client"""
+        """Re-pack and send data to client.
+        data may be a memoryview of a reused receive buffer: send or copy it before returning"""
         raise NotImplementedError("on_traffic not implemented")
 
+    def on_batch(self, batch, track_id, relay_id):
+        """Send a Utils.mmsg.Batch of packets; transports that can batch syscalls override this"""
+        for data in batch.packets():
+            self.on_traffic(data, track_id, relay_id)
+
     def on_pause(self):
         """Cleanup for the next playback"""
         raise NotImplementedError("on_pause not implemented")
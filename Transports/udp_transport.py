@@ -1,4 +1,6 @@
 from .transport_base import Transport
+from Utils.backend import get_backend
+from Utils.ports import PortAllocator
 import socket
 
 class UDPTransport(Transport):
@@ -7,28 +9,61 @@ class UDPTransport(Transport):
         self.caddr = self.session.addr[0]
         self.track_map = {}
         self.socks = {}
+        self.rtcp_socks = {}
 
     def conf_track(self, track):
         """Set target port for tracks"""
+        # ffmpeg sends to a relay port; server_port and server_port+1 only face the client
         if track.track_id in self.track_map:
-            track.ffmpeg_target_port = self.track_map[track.track_id]["s"][0]
+            track.ffmpeg_target_port = PortAllocator().allocate("relay", self.session.session_id)
 
     def on_play(self):
-        """Prepare for playback by opening sockets"""
+        """Prepare for playback by opening sockets; they stay open until teardown.
+        RTCP goes out from server_port+1, where the client's receiver reports come in"""
         for track in self.track_map:
-            tsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            tsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            tsock.bind(("0.0.0.0", self.track_map[track]["s"][0]))
-            self.socks[track] = tsock
+            if track in self.socks: continue
+            self.socks[track] = self.bind(self.track_map[track]["s"][0])
+            self.rtcp_socks[track] = self.bind(self.track_map[track]["s"][1])
+            get_backend().add_reader(self.rtcp_socks[track], self.read_rtcp)
+
+    @staticmethod
+    def bind(port):
+        tsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        tsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tsock.bind(("0.0.0.0", port))
+        return tsock
+
+    def read_rtcp(self, sock):
+        data, addr = sock.recvfrom(2048)
+        if addr[0] == self.caddr: self.session.on_rtcp(data)
 
 
     def on_traffic(self, data, track_id, relay_id):
         """Decide on port and re-send data to client"""
         client_port = self.track_map[track_id]["c"][relay_id]
-        self.socks[track_id].sendto(data, (self.caddr, client_port))
+        sock = self.rtcp_socks[track_id] if relay_id else self.socks[track_id]
+        sock.sendto(data, (self.caddr, client_port))
+
+
+    def on_batch(self, batch, track_id, relay_id):
+        client_port = self.track_map[track_id]["c"][relay_id]
+        sock = self.rtcp_socks[track_id] if relay_id else self.socks[track_id]
+        batch.sendto(sock, (self.caddr, client_port))
 
 
     def on_pause(self):
-        """Close all sockets"""
+        """Sockets are kept for the next PLAY"""
+        pass
+
+
+    def on_teardown(self):
+        """Close all sockets and free the ports"""
         for sock in self.socks.values():
-            sock.close()
\ No newline at end of file
+            sock.close()
+        for sock in self.rtcp_socks.values():
+            get_backend().remove_reader(sock)
+        self.socks = {}
+        self.rtcp_socks = {}
+        for ports in self.track_map.values():
+            PortAllocator().release(ports["s"][0])
+            PortAllocator().release(ports["own_c"])
@@ -0,0 +1,62 @@
+import threading
+import subprocess
+from .relay_engine import RelayEngine
+from .egress import EgressQueue
+from .metrics import Metrics
+
+
+class ThreadBackend:
+    """Default I/O backend: blocking subprocesses, relay sockets served by the RelayEngine threads"""
+
+    def spawn(self, cmd):
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        Metrics().watch_process(proc)
+        return proc
+
+    def stop_process(self, proc, then=None, kill=False):
+        """Signal ffmpeg to stop and return; a reaper thread waits for it, then() runs once it has exited,
+        e.g. to free its ports. kill skips the graceful SIGTERM, which ffmpeg may take a while to act on"""
+        if kill: proc.kill()
+        else: proc.terminate()
+        threading.Thread(target=self.reap, args=(proc, then), daemon=True).start()
+
+    @staticmethod
+    def reap(proc, then):
+        try:
+            proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        if then is not None: then()
+
+    def add_reader(self, sock, callback):
+        """Call callback(sock) whenever sock has a datagram to read"""
+        RelayEngine().register(sock, callback)
+
+    def remove_reader(self, sock, close=True):
+        """Stop reading sock; close=False keeps it bound for a later add_reader"""
+        RelayEngine().unregister(sock)
+        if close: sock.close()
+
+    def egress(self, conn):
+        """What sessions send to a client through; never blocks the relay threads"""
+        return EgressQueue(conn)
+
+    def loop_stats(self):
+        """Lag and busy time of every relay loop thread"""
+        if RelayEngine._instance is None: return []
+        return [loop.stats() for loop in RelayEngine().loops]
+
+    def defer(self, func, *args):
+        """Run func outside the current callback, e.g. to tear a session down from its own relay"""
+        threading.Thread(target=func, args=args, daemon=True).start()
+
+
+_backend = ThreadBackend()
+
+def get_backend():
+    return _backend
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
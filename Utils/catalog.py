@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+from array import array
+from urllib.parse import urlsplit, unquote
+from .config import Config
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS titles (
+    path TEXT PRIMARY KEY,  -- real path
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    vtracks INTEGER,        -- NULL until probed
+    atracks INTEGER,
+    duration REAL,
+    probe TEXT,             -- probe_media() as JSON: track layout, SDP lines, rates, codecs
+    keyframes BLOB,         -- probe_keyframes(), float64 seconds
+    error TEXT              -- why probing failed; not retried until the file changes
+)"""
+
+# row for a version of a file; what was stored for another version is cleared
+UPSERT = """INSERT INTO titles (path, mtime_ns, size) VALUES (?, ?, ?) ON CONFLICT (path) DO UPDATE SET
+    mtime_ns = excluded.mtime_ns, size = excluded.size,
+    vtracks = NULL, atracks = NULL, duration = NULL, probe = NULL, keyframes = NULL, error = NULL
+    WHERE mtime_ns != excluded.mtime_ns OR size != excluded.size"""
+
+# ProbeCache kind -> (column, to the database, from the database)
+KINDS = {
+    "sdp": ("probe", json.dumps, json.loads),
+    "keyframes": ("keyframes", lambda times: times.tobytes(), lambda blob: array("d", blob)),
+}
+
+
+class Catalog:
+    """Probe results of titles kept in SQLite (catalog_db), behind ProbeCache: what was probed once isn't probed
+    again until the file changes, restarts included. An indexer thread can probe media_dir ahead of the clients.
+    Rows are keyed like ProbeCache entries, by real path, mtime and size; stale rows are never returned"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance.path = Config().get("catalog_db", "catalog.db")
+                    instance.media_dir = Config().get("media_dir", "")
+                    instance.conn = instance.connect()
+                    instance.lock = threading.Lock()
+                    instance.indexing = False
+                    cls._instance = instance
+        return cls._instance
+
+    def connect(self):
+        if not self.path: return None
+        try:
+            # worker processes share the file; WAL lets them read while one writes
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(SCHEMA)
+            conn.commit()
+            return conn
+        except sqlite3.Error as e:
+            logging.error(f"Can't open catalog {self.path}, probing titles every time: {e}")
+            return None
+
+    def query(self, sql, args=()):
+        with self.lock:
+            try:
+                with self.conn:
+                    return self.conn.execute(sql, args).fetchall()
+            except sqlite3.Error as e:
+                logging.warning(f"Catalog: {e}")
+                return []
+
+    def get(self, key):
+        """Stored data for a ProbeCache key, or None"""
+        kind, path, mtime_ns, size = key
+        if self.conn is None or kind not in KINDS or mtime_ns is None: return None
+        column, _, load = KINDS[kind]
+        rows = self.query(f"SELECT {column} FROM titles WHERE path = ? AND mtime_ns = ? AND size = ?", (path, mtime_ns, size))
+        if not rows or rows[0][0] is None: return None
+        return load(rows[0][0])
+
+    def put(self, key, data):
+        kind, path, mtime_ns, size = key
+        if self.conn is None or kind not in KINDS or mtime_ns is None: return
+        column, dump, _ = KINDS[kind]
+        values = {column: dump(data), "error": None}
+        if kind == "sdp": values.update(vtracks=data["vtracks"], atracks=data["atracks"], duration=data["len"])
+        self.store(path, mtime_ns, size, values)
+
+    def fail(self, key, error):
+        """Probing this version of the file failed; the indexer skips it until the file changes"""
+        if self.conn is None or key[2] is None: return
+        self.store(*key[1:], {"error": str(error)[:500]})
+
+    def store(self, path, mtime_ns, size, values):
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute(UPSERT, (path, mtime_ns, size))
+                    self.conn.execute(f"UPDATE titles SET {", ".join(f"{column} = ?" for column in values)} WHERE path = ?",
+                                      (*values.values(), path))
+            except sqlite3.Error as e:
+                logging.warning(f"Catalog: can't store {path}: {e}")
+
+    def forget(self, path):
+        if self.conn is None: return
+        self.query("DELETE FROM titles WHERE path IN (?, ?)", (path, os.path.realpath(path)))
+
+    def find(self, url):
+        """Path of the media_dir title a request URL names, e.g. rtsp://host:8554/movies/a.mp4 for
+        media_dir/movies/a.mp4; None unless it's indexed and has tracks to play"""
+        if self.conn is None or not self.media_dir: return None
+        name = os.path.normpath(unquote(urlsplit(url).path).strip("/"))
+        if name.startswith("..") or os.path.isabs(name): return None
+        path = os.path.join(self.media_dir, name)
+        rows = self.query("SELECT vtracks + atracks FROM titles WHERE path = ?", (os.path.realpath(path),))
+        return path if rows and rows[0][0] else None
+
+    def start_indexer(self):
+        """Index media_dir now and every catalog_scan_interval seconds; without one, only drop stale rows once"""
+        if self.conn is None or self.indexing: return
+        self.indexing = True
+        threading.Thread(target=self.run_indexer, name="catalog-indexer", daemon=True).start()
+
+    def run_indexer(self):
+        while True:
+            try:
+                with open(f"{self.path}.lock", "w") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        self.index()
+                    except BlockingIOError:
+                        pass  # another worker process is at it
+            except Exception as e:
+                logging.error(f"Catalog indexer: {e}")
+            if not self.media_dir: return
+            time.sleep(Config().get("catalog_scan_interval", 60))
+
+    def index(self):
+        """Drops rows of files that changed or are gone, then probes what's new in media_dir, committing each title"""
+        from .probe_cache import ProbeCache, cache_key  # ProbeCache reads the catalog
+        from .sdp_gen import probe_media
+        from .keyframes import probe_keyframes
+        done = set()
+        for path, mtime_ns, size, indexed in self.query(
+                "SELECT path, mtime_ns, size, probe IS NOT NULL AND (vtracks = 0 OR keyframes IS NOT NULL) "
+                "OR error IS NOT NULL FROM titles"):
+            if cache_key(path, "sdp")[2:] != (mtime_ns, size): self.forget(path)
+            elif indexed: done.add(path)
+        started, count = time.monotonic(), 0
+        for path in self.files():
+            key = cache_key(path, "sdp")
+            if key[1] in done or key[2] is None: continue
+            try:
+                probe = ProbeCache().get(path, "sdp", probe_media)
+                if probe["vtracks"]: ProbeCache().get(path, "keyframes", probe_keyframes)
+            except Exception as e:
+                logging.debug(f"Catalog: can't probe {path}: {e}")
+                self.fail(key, e)
+            count += 1
+        if count: logging.info(f"Catalog: indexed {count} new or changed files in {time.monotonic() - started:.1f} s")
+
+    def files(self):
+        """Files below media_dir, leaving out hidden ones and the server's own caches"""
+        if not self.media_dir: return
+        own = {os.path.realpath(Config().get(key, default))
+               for key, default in (("vod_store_dir", "store"), ("transcode_cache_dir", "transcoded"))}
+        for root, dirs, names in os.walk(self.media_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".") and os.path.realpath(os.path.join(root, d)) not in own)
+            for name in sorted(names):
+                if not name.startswith("."): yield os.path.join(root, name)
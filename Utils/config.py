@@ -12,8 +12,6 @@ class Config:
     def _load_config(self, path):
         with open(path, "r") as file:
             self._config = yaml.safe_load(file)
-            self._used_ports = set()
-            self._used_mcips = set()
 
     def get(self, key, default=None):
         return self._config.get(key, default)
@@ -21,48 +19,4 @@ class Config:
     def all(self):
         return self._config
 
-    def get_mcip(self):
-        rng = self.get("multicast_lo", [0, 255])
-        for ip in range(*rng):
-            if ip not in self._used_mcips:
-                return ip
-        return None
-
-    def mcip_set_used(self, last_oct):
-        # example: 127.0.0.{last_oct}
-        self._used_mcips.add(last_oct)
-
-    def mcip_set_free(self, last_oct):
-        # example: 127.0.0.{last_oct}
-        self._used_mcips.remove(last_oct)
-
-    def port_set_used(self, port):
-        self._used_ports.add(port)
-
-    def port_set_free(self, port):
-        try:
-            self._used_ports.remove(port)
-        except KeyError:
-            pass
-
-    def get_free_port(self, mode="udp"):
-        # Since all ports allocated through this are used in pairs, only the first port from the pair will be returned
-        # Second port can be accessed at returned_port+1
-        if mode == "relay":
-            start = self._config["min_relay_port"]
-            finish = self._config["max_relay_port"]
-        elif mode == "sdp":
-            start = self._config["min_sdp_gen_port"]
-            finish = self._config["max_sdp_gen_port"]
-        else:
-            start = self._config["min_udp_port"]
-            finish = self._config["max_udp_port"]
-
-        i = start
-        while i < finish:
-            if i not in self._used_ports:
-                return i
-            i += 2
-        return None
-
 config_instance = Config()
\ No newline at end of file
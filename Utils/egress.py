@@ -0,0 +1,230 @@
+import socket
+import logging
+import threading
+import selectors
+from itertools import islice
+from collections import deque
+from .config import Config
+from .rtp import is_keyframe_start
+
+# buffers handed to one sendmsg; Linux takes up to 1024 (IOV_MAX)
+MAX_IOV = 512
+# video codecs whose keyframes can be found; frames of others are dropped one at a time
+KEYFRAME_CODECS = ("H264", "H265", "HEVC")
+
+
+def egress_budget():
+    return Config().get("egress_queue_kb", 512) * 1024
+
+def pressure_of(queued, budget):
+    """0 - the client keeps up; 1 - over budget, non-key video is dropped; 2 - over twice the budget, audio too"""
+    if queued <= budget: return 0
+    return 1 if queued <= 2 * budget else 2
+
+
+class EgressQueue:
+    """Outgoing side of a client connection in the threads core. Sends never block the caller:
+    what the socket doesn't take right away is queued and written out by the EgressWriter thread,
+    whole, in order and coalesced into sendmsg calls. Responses and interleaved packets share the queue,
+    so a response can't land in the middle of a frame"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.chunks = deque()
+        self.queued = 0  # bytes in chunks
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.waiting = False  # registered with the writer
+        self.error = None
+        self.budget = egress_budget()
+
+    def pressure(self):
+        return pressure_of(self.queued, self.budget)
+
+    def sendmsg(self, buffers):
+        """Send or queue all of buffers; they may be reused once this returns"""
+        total = sum(len(b) for b in buffers)
+        with self.lock:
+            if self.error is not None: raise self.error
+            if not self.chunks:
+                sent = self.write(buffers)
+                if sent == total: return total
+                buffers = remainder(buffers, sent)
+            for b in buffers:
+                self.chunks.append(bytes(b))
+                self.queued += len(b)
+            self.peak = max(self.peak, self.queued)
+            if not self.waiting:
+                self.waiting = True
+                EgressWriter().watch(self)
+        return total
+
+    def send(self, data):
+        return self.sendmsg([data])
+
+    sendall = send
+
+    def write(self, buffers):
+        """One non-blocking sendmsg; returns the bytes sent, 0 if the socket buffer is full"""
+        try:
+            return self.sock.sendmsg(buffers, (), socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError as e:
+            self.error = e
+            self.chunks.clear()
+            self.queued = 0
+            raise
+
+    def flush(self):
+        """Write what the socket takes now; True once the queue is empty. Called by the writer thread"""
+        with self.lock:
+            while self.chunks:
+                try:
+                    sent = self.write(list(islice(self.chunks, MAX_IOV)))
+                except OSError:
+                    break
+                if not sent: return False
+                self.queued -= sent
+                while sent:
+                    head = self.chunks[0]
+                    if len(head) > sent:
+                        self.chunks[0] = memoryview(head)[sent:]
+                        break
+                    sent -= len(head)
+                    self.chunks.popleft()
+            self.waiting = False
+            return True
+
+    def stats(self):
+        return {"queued": self.queued, "peak": self.peak}
+
+    def close(self):
+        EgressWriter().unwatch(self)
+        with self.lock:
+            self.chunks.clear()
+            self.queued = 0
+            if self.error is None: self.error = BrokenPipeError("connection closed")
+        try: self.sock.shutdown(socket.SHUT_RDWR)  # also wakes the request thread blocked in recv
+        except OSError: pass
+        self.sock.close()
+
+
+def remainder(buffers, sent):
+    """What's left of buffers after the first sent bytes went out"""
+    for idx, b in enumerate(buffers):
+        if sent < len(b):
+            return [memoryview(b)[sent:], *buffers[idx+1:]]
+        sent -= len(b)
+    return []
+
+
+class EgressWriter:
+    """One selector thread writing out the queues of every client that can't keep up"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._init()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init(self):
+        self.selector = selectors.DefaultSelector()
+        self.commands = deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self.run, name="egress", daemon=True)
+        self.thread.start()
+
+    def watch(self, queue):
+        """Start writing queue out when its socket is writable. Doesn't wait: called with queue.lock held"""
+        self.commands.append((self.add, queue, None))
+        self.wake_w.send(b"\0")
+
+    def unwatch(self, queue):
+        """Once this returns, the writer won't touch queue again"""
+        if threading.current_thread() is self.thread:
+            self.remove(queue)
+            return
+        done = threading.Event()
+        self.commands.append((self.remove, queue, done))
+        self.wake_w.send(b"\0")
+        done.wait()
+
+    def add(self, queue):
+        if queue.sock.fileno() == -1: return
+        try:
+            self.selector.register(queue.sock, selectors.EVENT_WRITE, queue)
+        except KeyError:
+            pass  # still registered
+
+    def remove(self, queue):
+        try:
+            self.selector.unregister(queue.sock)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wake_r:
+                    self.run_commands()
+                elif key.data.flush():
+                    self.remove(key.data)
+
+    def run_commands(self):
+        try:
+            while self.wake_r.recv(4096): pass
+        except BlockingIOError:
+            pass
+        while self.commands:
+            func, queue, done = self.commands.popleft()
+            try: func(queue)
+            except Exception as e: logging.error(f"Egress writer command failed: {e}")
+            if done is not None: done.set()
+
+
+class FrameFilter:
+    """Decides which RTP packets still go to a client that can't keep up. Video is dropped a frame at a time,
+    and H.264/H.265 then until the next keyframe, since the frames in between can't be decoded anyway.
+    Audio and RTCP only go once the queue is past twice its budget"""
+    def __init__(self, name):
+        self.name = name
+        self.frames = {}  # track -> (RTP timestamp, admitted) of the frame being sent
+        self.skipping = set()  # video tracks waiting for a keyframe
+        self.dropped = 0
+        self.congested = False
+
+    def admit(self, track_id, codec, data, pressure):
+        """codec is None for audio and RTCP"""
+        if pressure and not self.congested:
+            self.congested = True
+            logging.warning(f"{self.name}: client can't keep up, dropping frames")
+        elif not pressure and self.congested and not self.skipping:
+            self.congested = False
+            logging.info(f"{self.name}: client caught up, {self.dropped} packets dropped so far")
+
+        if codec is None:
+            if pressure < 2: return True
+            self.dropped += 1
+            return False
+
+        ts = bytes(data[4:8])
+        frame = self.frames.get(track_id)
+        if frame is not None and frame[0] == ts:
+            admitted = frame[1]  # packets of a frame share its fate
+        else:
+            if not pressure and track_id not in self.skipping: admitted = True
+            elif codec in KEYFRAME_CODECS: admitted = pressure < 2 and is_keyframe_start(codec, data)
+            else: admitted = False
+            if codec in KEYFRAME_CODECS:
+                if admitted: self.skipping.discard(track_id)
+                else: self.skipping.add(track_id)
+            self.frames[track_id] = (ts, admitted)
+        if not admitted: self.dropped += 1
+        return admitted
@@ -0,0 +1,55 @@
+import heapq
+import itertools
+import threading
+from time import monotonic
+from .backend import get_backend
+
+
+class SessionExpiry:
+    """Times out sessions nobody has heard from for session_timeout seconds. One thread and a heap of deadlines
+    serve every session: touching a session only moves its deadline forward, and the heap catches up when the
+    old one comes due"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance.heap = []  # (deadline, order, session)
+                    instance.order = itertools.count()  # sessions don't compare
+                    instance.cond = threading.Condition()
+                    threading.Thread(target=instance.run, name="session-expiry", daemon=True).start()
+                    cls._instance = instance
+        return cls._instance
+
+    def watch(self, session):
+        """Expire session once monotonic() passes session.expires"""
+        with self.cond:
+            heapq.heappush(self.heap, (session.expires, next(self.order), session))
+            if self.heap[0][2] is session: self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                session = self.next_due()
+            get_backend().defer(session.expire)
+
+    def next_due(self):
+        """Waits for the first session past its deadline; called with the lock held"""
+        while True:
+            if not self.heap:
+                self.cond.wait()
+                continue
+            now = monotonic()
+            due, _, session = self.heap[0]
+            if due > now:
+                self.cond.wait(due - now)
+                continue
+            heapq.heappop(self.heap)
+            if session.state == 0: continue
+            if session.expires > now:
+                heapq.heappush(self.heap, (session.expires, next(self.order), session))
+                continue
+            return session
@@ -3,10 +3,12 @@ def get_err(code):
         400: "RTSP/1.0 400 Bad Request",
         404: "RTSP/1.0 404 Not Found",
         416: "RTSP/1.0 416 Requested Range Not Satisfiable",
+        451: "RTSP/1.0 451 Parameter Not Understood",
         455: "RTSP/1.0 455 Method Not Valid in This State",
         457: "RTSP/1.0 457 Invalid Range",
         461: "RTSP/1.0 461 Unsupported Transport",
         501: "RTSP/1.0 501 Not Implemented",
+        503: "RTSP/1.0 503 Service Unavailable",
         -501: "HTTP/1.0 501 Not Implemented\r\nConnection: close"
     }
     return messages.get(code, "RTSP/1.0 500 Internal Server Error")
@@ -23,9 +25,8 @@ def get_http_resp():
         )
     return resp.encode()
 
-def get_cmd_err_code(command):
-    not_implemented = ("ANNOUNCE", "GET_PARAMETER", "RECORD", "REDIRECT", "SET_PARAMETER")
-    for cmd in not_implemented:
-        if cmd in not_implemented:
-            return 501
+def get_cmd_err_code(method):
+    not_implemented = ("ANNOUNCE", "RECORD", "REDIRECT")
+    if method in not_implemented:
+        return 501
     return 400
\ No newline at end of file
@@ -0,0 +1,31 @@
+import logging
+import subprocess
+from array import array
+from bisect import bisect_right
+from .probe_cache import ProbeCache
+
+
+def probe_keyframes(input_path):
+    """Keyframe times of the first video stream in seconds from the start of the file, as ffmpeg -ss counts them.
+    Reads packet flags only, nothing is decoded"""
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+           "-show_entries", "packet=pts_time,flags:format=start_time", "-of", "csv", input_path]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    times = array("d")
+    start = 0.0
+    for line in proc.stdout.splitlines():
+        fields = line.split(",")
+        try:
+            if fields[0] == "packet" and "K" in fields[2]: times.append(float(fields[1]))
+            elif fields[0] == "format": start = float(fields[1])
+        except (IndexError, ValueError):
+            continue  # N/A timestamps
+    times = array("d", sorted(t - start for t in times))
+    logging.debug(f"Indexed {len(times)} keyframes in {input_path}")
+    return times
+
+def keyframe_before(input_path, seconds):
+    """Time of the last keyframe at or before seconds; seconds itself if the input has no keyframe index"""
+    times = ProbeCache().get(input_path, "keyframes", probe_keyframes)
+    i = bisect_right(times, seconds + 1e-6)  # tolerate rounding in reported ranges
+    return times[i-1] if i else seconds
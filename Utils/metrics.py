@@ -0,0 +1,211 @@
+import time
+import weakref
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .config import Config
+from .ports import PortAllocator
+
+PREFIX = "deadrtsp_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name -> (type, help) of everything exported
+HELP = {
+    "uptime_seconds": ("gauge", "Seconds since the server started"),
+    "requests_total": ("counter", "RTSP and tunnel HTTP requests handled, by method"),
+    "sessions": ("gauge", "Active sessions by transport mode"),
+    "track_packets_total": ("counter", "RTP packets relayed to the transport, per track of an active session"),
+    "track_bytes_total": ("counter", "RTP bytes relayed to the transport, per track of an active session"),
+    "relayed_packets_total": ("counter", "RTP packets relayed to transports since start; drops are counted separately"),
+    "relayed_bytes_total": ("counter", "RTP bytes relayed to transports since start"),
+    "dropped_packets_total": ("counter", "Packets not sent to TCP/HTTP clients that couldn't keep up, since start"),
+    "track_fraction_lost": ("gauge", "Fraction of packets lost in the client's last receiver report, per track of an active session"),
+    "track_jitter_seconds": ("gauge", "Interarrival jitter in the client's last receiver report, per track of an active session"),
+    "rendition_switches_total": ("counter", "Switches of sessions to a lower or higher bitrate rendition"),
+    "transcodes_total": ("counter", "Titles transcoded for a client profile, by profile and result"),
+    "transcode_cache_evictions_total": ("counter", "Renditions removed from the transcode cache to stay within its size"),
+    "egress_queued_bytes": ("gauge", "Bytes waiting to be written to TCP/HTTP clients"),
+    "egress_queued_bytes_max": ("gauge", "Largest egress backlog of a single active client"),
+    "relay_loop_lag_seconds": ("gauge", "Time for a relay loop to run a no-op, measured at scrape"),
+    "relay_loop_busy_seconds_total": ("counter", "Time relay loop threads spent relaying; rate() gives utilisation"),
+    "ffmpeg_processes": ("gauge", "Running ffmpeg processes"),
+    "ffmpeg_spawned_total": ("counter", "ffmpeg processes started"),
+    "first_packet_seconds": ("histogram", "Time from PLAY to the first packet sent, by how PLAY was served"),
+    "sdp_generation_seconds": ("histogram", "Time to generate the SDP of a DESCRIBE"),
+    "port_pool_size": ("gauge", "Values in a port or multicast pool"),
+    "port_pool_in_use": ("gauge", "Values of a pool in use"),
+    "port_pool_peak": ("gauge", "Most values of a pool in use at once"),
+    "port_pool_exhausted_total": ("counter", "Allocations that found a pool empty"),
+    "port_leaks_total": ("counter", "Ports still held by sessions port_leak_grace seconds after teardown"),
+}
+
+
+def fmt_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    """Cumulative histogram in Prometheus' layout"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect_left(self.buckets, value)
+        if idx < len(self.counts): self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f"{name}_bucket{fmt_labels(labels + (("le", bound),))} {total}"
+        yield f"{name}_bucket{fmt_labels(labels + (("le", "+Inf"),))} {self.count}"
+        yield f"{name}_sum{fmt_labels(labels)} {self.sum:.6f}"
+        yield f"{name}_count{fmt_labels(labels)} {self.count}"
+
+
+class Metrics:
+    """Server-wide counters and histograms. Per-packet numbers aren't kept here: tracks and transports count
+    in their own attributes, read at scrape time and added to the totals here when they go away"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._init()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init(self):
+        self.started = time.monotonic()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.processes = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms: self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def watch_process(self, proc):
+        """Count an ffmpeg process; proc needs poll() like subprocess.Popen"""
+        with self.lock:
+            self.processes.add(proc)
+        self.inc("ffmpeg_spawned_total")
+
+    def running_processes(self):
+        with self.lock:
+            procs = list(self.processes)
+        return sum(1 for proc in procs if proc.poll() is None)
+
+    def collect(self, server):
+        """Current value of everything, as (name, labels, value or Histogram)"""
+        from .backend import get_backend  # the backends count processes here
+        res = [("uptime_seconds", (), round(time.monotonic() - self.started, 3))]
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = [(name, labels, hist) for (name, labels), hist in self.histograms.items()]
+        with server.registry.lock:
+            sessions = list(server.registry.sessions.values())
+
+        modes = {}
+        packets, octets = counters.pop(("relayed_packets_total", ()), 0), counters.pop(("relayed_bytes_total", ()), 0)
+        dropped = counters.pop(("dropped_packets_total", ()), 0)
+        queued = []
+        for session in sessions:
+            mode = session.transport_mode or "none"
+            modes[mode] = modes.get(mode, 0) + 1
+            if mode == "udp_m" and not session.multicast_host: continue  # the group's tracks belong to its host
+            for tid, track in list(session.tracks.items()):
+                labels = (("session", session.session_id), ("track", tid))
+                res.append(("track_packets_total", labels, track.packets))
+                res.append(("track_bytes_total", labels, track.octets))
+                report = session.reports.get(tid)
+                if report is not None:
+                    res.append(("track_fraction_lost", labels, report["fraction_lost"]))
+                    res.append(("track_jitter_seconds", labels, round(report["jitter"], 6)))
+                packets += track.packets
+                octets += track.octets
+            dropped += getattr(getattr(session.transport, "filter", None), "dropped", 0)
+            if mode in ("tcp", "http"): queued.append(session.wconn.stats()["queued"])
+        res += [("sessions", (("transport", mode),), count) for mode, count in sorted(modes.items())]
+        res += [("relayed_packets_total", (), packets), ("relayed_bytes_total", (), octets),
+                ("dropped_packets_total", (), dropped),
+                ("egress_queued_bytes", (), sum(queued)), ("egress_queued_bytes_max", (), max(queued, default=0))]
+
+        for loop in get_backend().loop_stats():
+            labels = (("loop", loop["name"]),)
+            res.append(("relay_loop_lag_seconds", labels, round(loop["lag"], 6)))
+            if "busy" in loop: res.append(("relay_loop_busy_seconds_total", labels, round(loop["busy"], 6)))
+
+        res.append(("ffmpeg_processes", (), self.running_processes()))
+        ports = PortAllocator().stats()
+        res.append(("port_leaks_total", (), ports.pop("leaks")))
+        for pool, stats in sorted(ports.items()):
+            labels = (("pool", pool),)
+            res += [("port_pool_size", labels, stats["size"]), ("port_pool_in_use", labels, stats["in_use"]),
+                    ("port_pool_peak", labels, stats["peak"]), ("port_pool_exhausted_total", labels, stats["exhausted"])]
+        res += [(name, labels, value) for (name, labels), value in counters.items()]
+        res += histograms
+        return res
+
+    def render(self, server):
+        """Prometheus text exposition format"""
+        by_name = {}
+        for name, labels, value in self.collect(server):
+            by_name.setdefault(name, []).append((labels, value))
+        out = []
+        for name, samples in by_name.items():
+            kind, text = HELP[name]
+            out.append(f"# HELP {PREFIX}{name} {text}")
+            out.append(f"# TYPE {PREFIX}{name} {kind}")
+            for labels, value in samples:
+                if isinstance(value, Histogram): out.extend(value.lines(PREFIX + name, labels))
+                else: out.append(f"{PREFIX}{name}{fmt_labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = Metrics().render(self.server.rtsp_server).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape would drown the server log
+
+
+def start_metrics(rtsp_server):
+    """Serve /metrics on metrics_port, if set; worker processes on metrics_port + their index"""
+    port = Config().get("metrics_port", 0)
+    if not port: return None
+    if rtsp_server.link is not None: port += rtsp_server.link.index
+    bind = Config().get("metrics_bind", "127.0.0.1")
+    httpd = ThreadingHTTPServer((bind, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.rtsp_server = rtsp_server
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics at http://{bind}:{port}/metrics")
+    return httpd
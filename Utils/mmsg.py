@@ -0,0 +1,192 @@
+"""Batched datagram I/O for relays: recvmmsg/sendmmsg through ctypes and UDP GSO (UDP_SEGMENT).
+Linux only; AVAILABLE is False elsewhere and relays keep using the per-packet path"""
+import os
+import sys
+import errno
+import socket
+import struct
+import ctypes
+import logging
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH_SIZE = 64
+SLOT_SIZE = 2048  # ffmpeg's RTP packets are at most 1472 bytes by default
+GSO_MAX_BYTES = 65000
+UDP_SEGMENT = 103
+MASK = 0xFFFFFFFF
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+_recvmmsg = _sendmmsg = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _recvmmsg = _libc.recvmmsg
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _sendmmsg = _libc.sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        _recvmmsg = _sendmmsg = None
+
+AVAILABLE = _recvmmsg is not None
+_gso = hasattr(socket, "SOL_UDP")
+_local = threading.local()
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise BlockingIOError(err, os.strerror(err))
+    raise OSError(err, os.strerror(err))
+
+def sockaddr_in(addr):
+    host, port = addr
+    return struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + socket.inet_aton(socket.gethostbyname(host)) + bytes(8)
+
+
+class Batch:
+    """Up to BATCH_SIZE datagrams in one contiguous buffer, SLOT_SIZE bytes apart.
+    The same mmsghdr array is used to receive the burst and to send it on"""
+    def __init__(self):
+        self.mem = bytearray(BATCH_SIZE * SLOT_SIZE)
+        self.view = memoryview(self.mem)
+        self.base = ctypes.addressof((ctypes.c_char * len(self.mem)).from_buffer(self.mem))
+        self.iovs = (iovec * BATCH_SIZE)()
+        self.msgs = (mmsghdr * BATCH_SIZE)()
+        for i in range(BATCH_SIZE):
+            self.iovs[i].iov_base = self.base + i * SLOT_SIZE
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+        self.count = 0
+        self.first = 0  # packets before this index are dropped
+        self.lengths = []
+        self.addr = None
+        self.addr_buf = None
+
+    def recv(self, sock):
+        """Drain up to BATCH_SIZE datagrams with one syscall; BlockingIOError if there are none"""
+        for i in range(BATCH_SIZE):
+            self.iovs[i].iov_len = SLOT_SIZE
+            self.msgs[i].msg_hdr.msg_name = None
+            self.msgs[i].msg_hdr.msg_namelen = 0
+        n = _recvmmsg(sock.fileno(), self.msgs, BATCH_SIZE, socket.MSG_DONTWAIT, None)
+        if n < 0: _raise_errno()
+        self.count = n
+        self.first = 0
+        self.lengths = [min(self.msgs[i].msg_len, SLOT_SIZE) for i in range(n)]
+        return n
+
+    def packets(self):
+        for i in range(self.first, self.count):
+            yield self.view[i*SLOT_SIZE:i*SLOT_SIZE + self.lengths[i]]
+
+    def field(self, offset, fmt):
+        """Header field of every packet as a numpy view (or a list without numpy)"""
+        if np is not None:
+            dtype = np.dtype(">u4" if fmt == "I" else ">u2")
+            return np.ndarray((self.count,), dtype=dtype, buffer=self.mem, offset=offset, strides=(SLOT_SIZE,))
+        return [struct.unpack_from("!" + fmt, self.mem, i*SLOT_SIZE + offset)[0] for i in range(self.count)]
+
+    def timestamps(self):
+        ts = self.field(4, "I")
+        return ts.copy() if np is not None else ts
+
+    def last_seq(self):
+        return struct.unpack_from("!H", self.mem, (self.count-1)*SLOT_SIZE + 2)[0]
+
+    def rewrite(self, src_ts, ts_offset, first_seq=None, ssrc=None):
+        """Rewrite timestamps (and optionally seq and SSRC) of packets first..count in place, vectorized with numpy"""
+        lo, hi = self.first, self.count
+        if np is not None:
+            self.field(4, "I")[lo:hi] = (src_ts[lo:hi].astype(np.int64) + ts_offset) & MASK
+            if first_seq is not None:
+                self.field(2, "H")[lo:hi] = (np.arange(hi - lo, dtype=np.int64) + first_seq) & 0xFFFF
+            if ssrc is not None:
+                self.field(8, "I")[lo:hi] = ssrc
+            return
+        for n, i in enumerate(range(lo, hi)):
+            struct.pack_into("!I", self.mem, i*SLOT_SIZE + 4, (src_ts[i] + ts_offset) & MASK)
+            if first_seq is not None:
+                struct.pack_into("!H", self.mem, i*SLOT_SIZE + 2, (first_seq + n) & 0xFFFF)
+            if ssrc is not None:
+                struct.pack_into("!I", self.mem, i*SLOT_SIZE + 8, ssrc)
+
+    def sendto(self, sock, addr):
+        """Send packets first..count to addr with UDP GSO where sizes allow, sendmmsg otherwise"""
+        global _gso
+        if addr != self.addr:
+            self.addr = addr
+            self.addr_buf = ctypes.create_string_buffer(sockaddr_in(addr), 16)
+        for i in range(self.first, self.count):
+            self.iovs[i].iov_len = self.lengths[i]
+            self.msgs[i].msg_hdr.msg_name = ctypes.cast(self.addr_buf, ctypes.c_void_p)
+            self.msgs[i].msg_hdr.msg_namelen = 16
+
+        i = pending = self.first
+        while i < self.count:
+            run = self.gso_run(i) if _gso else 1
+            if run > 1:
+                self.send_mmsg(sock, pending, i)
+                try:
+                    sock.sendmsg(list(self.packets_range(i, i + run)),
+                                 [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", self.lengths[i]))], 0, addr)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT): raise
+                    logging.info(f"UDP GSO not supported here ({e}); using sendmmsg only")
+                    _gso = False
+                    pending = i  # the packets before the run went out above
+                    continue
+                i = pending = i + run
+            else:
+                i += 1
+        self.send_mmsg(sock, pending, self.count)
+
+    def gso_run(self, start):
+        """Length of the GSO-able run at start: equal-size packets, optionally ending with one shorter packet"""
+        size = self.lengths[start]
+        end, total = start + 1, size
+        while end < self.count and total + size <= GSO_MAX_BYTES:
+            if self.lengths[end] > size: break
+            total += self.lengths[end]
+            end += 1
+            if self.lengths[end-1] < size: break
+        return end - start
+
+    def packets_range(self, lo, hi):
+        for i in range(lo, hi):
+            yield self.view[i*SLOT_SIZE:i*SLOT_SIZE + self.lengths[i]]
+
+    def send_mmsg(self, sock, lo, hi):
+        while lo < hi:
+            n = _sendmmsg(sock.fileno(), ctypes.byref(self.msgs, lo * ctypes.sizeof(mmsghdr)), hi - lo, 0)
+            if n <= 0: _raise_errno()
+            lo += n
+
+
+def recv_batch(sock):
+    """Per-thread Batch, shared by all relays of a relay loop like relay_engine.recv_buffer"""
+    try:
+        batch = _local.batch
+    except AttributeError:
+        batch = _local.batch = Batch()
+    batch.recv(sock)
+    return batch
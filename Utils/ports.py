@@ -0,0 +1,157 @@
+import logging
+import threading
+from time import monotonic
+from collections import deque
+from .config import Config
+
+# config keys of each port range; ports are handed out in pairs (RTP, RTCP), only the first one is returned
+RANGES = {
+    "udp": ("min_udp_port", "max_udp_port"),
+    "relay": ("min_relay_port", "max_relay_port"),
+    "sdp": ("min_sdp_gen_port", "max_sdp_gen_port"),
+}
+
+
+class Pool:
+    """Free list of the values in one range. Freed values go to the back, so a port isn't reused
+    right after release while something may still be sending to it"""
+    def __init__(self, name, start, finish, step):
+        self.name = name
+        self.start = start
+        self.finish = finish
+        self.free = deque(range(start, finish, step))
+        self.free_set = set(self.free)  # the deque may also hold reserved values; they're skipped on allocate
+        self.in_use = {}  # value -> (owner, allocated at)
+        self.lock = threading.Lock()
+        self.allocations = 0
+        self.exhausted = 0
+        self.peak = 0
+
+    def allocate(self, owner=None):
+        with self.lock:
+            while self.free:
+                value = self.free.popleft()
+                if value in self.free_set:
+                    self.free_set.remove(value)
+                    self.take(value, owner)
+                    return value
+            self.exhausted += 1
+        logging.error(f"No free {self.name} ports left ({self.start}-{self.finish})")
+        return None
+
+    def reserve(self, value, owner=None):
+        """Mark a specific value as used; False if it already is"""
+        with self.lock:
+            if value not in self.free_set: return False
+            self.free_set.remove(value)
+            self.take(value, owner)
+            return True
+
+    def take(self, value, owner):
+        self.in_use[value] = (owner, monotonic())
+        self.allocations += 1
+        self.peak = max(self.peak, len(self.in_use))
+
+    def release(self, value):
+        with self.lock:
+            if self.in_use.pop(value, None) is None: return
+            self.free.append(value)
+            self.free_set.add(value)
+
+    def owned_by(self, owner):
+        with self.lock:
+            return [value for value, (o, _) in self.in_use.items() if o == owner]
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.free_set) + len(self.in_use), "in_use": len(self.in_use), "peak": self.peak,
+                    "allocations": self.allocations, "exhausted": self.exhausted}
+
+
+def share(start, finish, step, index, count):
+    """The part of a range worker index of count allocates from; the last worker gets what doesn't divide evenly"""
+    size = (finish - start) // step // count * step
+    lo = start + index * size
+    return lo, finish if index == count - 1 else lo + size
+
+
+class PortAllocator:
+    """Thread-safe allocation of local port pairs and multicast octets, tagged with the owning session.
+    A session that still owns anything port_leak_grace seconds after teardown is reported as a leak"""
+    _instance = None
+    _create_lock = threading.Lock()
+    worker = (0, 1)  # (index, count) of this worker process, see partition
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._init()
+                    cls._instance = instance
+        return cls._instance
+
+    @classmethod
+    def partition(cls, index, count):
+        """Allocate from worker index's share of every port range only; called in a worker process before anything
+        is allocated. Multicast groups all live in worker 0, so it keeps every multicast address"""
+        cls.worker = (index, count)
+
+    def _init(self):
+        self.pools = {}
+        by_range = {}
+        index, count = self.worker
+        for mode, (lo, hi) in RANGES.items():
+            start, finish = share(Config().get(lo), Config().get(hi), 2, index, count)
+            # ranges configured identically (see config.yaml) share one pool
+            if (start, finish) not in by_range:
+                by_range[(start, finish)] = Pool(mode, start, finish, 2)
+            self.pools[mode] = by_range[(start, finish)]
+        lo, hi = Config().get("multicast_lo", [0, 255])
+        self.mcips = Pool("multicast", lo, hi if index == 0 else lo, 1)
+        self.leaks = 0
+
+    def pool_of(self, port):
+        for pool in self.pools.values():
+            if pool.start <= port < pool.finish: return pool
+        return None
+
+    def allocate(self, mode="udp", owner=None):
+        """First port of a free pair in the mode's range, or None if the range is used up"""
+        return self.pools[mode].allocate(owner)
+
+    def reserve(self, port, owner=None):
+        pool = self.pool_of(port)
+        return pool is not None and pool.reserve(port, owner)
+
+    def release(self, port):
+        if port is None: return
+        pool = self.pool_of(port)
+        if pool is not None: pool.release(port)
+
+    def allocate_mcip(self, owner=None):
+        return self.mcips.allocate(owner)
+
+    def release_mcip(self, octet):
+        self.mcips.release(octet)
+
+    def owner_done(self, owner):
+        """Called on session teardown; ports are freed once ffmpeg exits, so the check runs a bit later"""
+        timer = threading.Timer(Config().get("port_leak_grace", 10), self.check_leaks, args=(owner,))
+        timer.daemon = True
+        timer.start()
+
+    def check_leaks(self, owner):
+        leaked = {pool.name: pool.owned_by(owner) for pool in set(self.pools.values()) | {self.mcips}}
+        leaked = {name: values for name, values in leaked.items() if values}
+        if leaked:
+            self.leaks += sum(len(values) for values in leaked.values())
+            logging.warning(f"Session {owner} still holds {leaked} after teardown")
+        return leaked
+
+    def stats(self):
+        """Counters of every pool, keyed by pool name, plus leaked values found so far"""
+        res = {pool.name: pool.stats() for pool in set(self.pools.values())}
+        res["multicast"] = self.mcips.stats()
+        res["leaks"] = self.leaks
+        return res
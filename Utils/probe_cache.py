@@ -0,0 +1,79 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from .config import Config
+from .catalog import Catalog
+
+
+def cache_key(path, kind):
+    """Builds a key that changes whenever the file is replaced or modified.
+    Sources that can't be stat'ed (URLs, devices) get no mtime/size and are never stored"""
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return (kind, path, None, None)
+    return (kind, os.path.realpath(path), st.st_mtime_ns, st.st_size)
+
+
+class ProbeCache:
+    """LRU cache for ffprobe/ffmpeg derived data. Concurrent misses for the same key share one loader call.
+    Misses look in the catalog before calling the loader, and what the loader returns is added to it"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._entries = OrderedDict()
+                    instance._inflight = {}
+                    instance._lock = threading.Lock()
+                    instance._max_size = Config().get("probe_cache_size", 64)
+                    cls._instance = instance
+        return cls._instance
+
+    def get(self, path, kind, loader):
+        """Returns cached data for path, calling loader(path) on a miss"""
+        key = cache_key(path, kind)
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+                job = self._inflight.get(key)
+                owner = job is None
+                if owner:
+                    job = [threading.Event(), None]
+                    self._inflight[key] = job
+            if owner: break
+            # someone else is probing this source; if they fail, retry as the owner
+            job[0].wait()
+            if job[1] is not None: return job[1]
+
+        try:
+            job[1] = Catalog().get(key)
+            if job[1] is None:
+                job[1] = loader(path)
+                logging.debug(f"Probe cache miss for {path} ({kind})")
+                Catalog().put(key, job[1])
+            return job[1]
+        finally:
+            with self._lock:
+                if job[1] is not None and key[2] is not None and self._max_size > 0:
+                    self._entries[key] = job[1]
+                    while len(self._entries) > self._max_size:
+                        self._entries.popitem(last=False)
+                del self._inflight[key]
+            job[0].set()
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            real = os.path.realpath(path)
+            Catalog().forget(path)
+            for key in [k for k in self._entries if k[1] in (path, real)]:
+                del self._entries[key]
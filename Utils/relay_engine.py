@@ -0,0 +1,137 @@
+import os
+import socket
+import logging
+import threading
+import selectors
+from time import monotonic
+from collections import deque
+from .config import Config
+from . import mmsg
+
+# datagrams read per readable event before other sockets get their turn
+MAX_BURST = 64
+
+_local = threading.local()
+
+
+def recv_buffer():
+    """Per-thread receive buffer and its memoryview. Relay callbacks of one thread never overlap
+    and transports send before returning, so all relays of a thread can share one buffer"""
+    try:
+        return _local.buf, _local.view
+    except AttributeError:
+        _local.buf = bytearray(65536)
+        _local.view = memoryview(_local.buf)
+        return _local.buf, _local.view
+
+
+def use_batched_io():
+    """Relay RTP with recvmmsg/sendmmsg when enabled and supported, per packet otherwise"""
+    return mmsg.AVAILABLE and Config().get("batched_io", True)
+
+
+class RelayLoop:
+    """One selector (epoll on Linux) thread serving any number of relay sockets.
+    Sockets are added and removed through a command queue, so only the loop thread touches the selector"""
+    def __init__(self, idx):
+        self.selector = selectors.DefaultSelector()
+        self.commands = deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.count = 0  # sockets assigned to this loop, maintained by RelayEngine
+        self.busy = 0.0  # seconds spent serving sockets, for metrics
+        self.thread = threading.Thread(target=self.run, name=f"relay-{idx}", daemon=True)
+        self.thread.start()
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, func, *args):
+        """Run func in the loop thread and wait for it, unless already there"""
+        if self.in_loop():
+            func(*args)
+            return
+        done = threading.Event()
+        self.commands.append((func, args, done))
+        self.wake_w.send(b"\0")
+        done.wait()
+
+    def add(self, sock, callback):
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def remove(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self):
+        while True:
+            events = self.selector.select()
+            start = monotonic()
+            for key, _ in events:
+                if key.fileobj is self.wake_r:
+                    self.run_commands()
+                    continue
+                sock, callback = key.fileobj, key.data
+                try:
+                    for _ in range(MAX_BURST):
+                        callback(sock)
+                except BlockingIOError:
+                    pass
+                except Exception as e:
+                    logging.error(f"Relay stopped: {e}")
+                    self.remove(sock)
+                    sock.close()
+            self.busy += monotonic() - start
+
+    def stats(self):
+        start = monotonic()
+        self.submit(lambda: None)
+        return {"name": self.thread.name, "lag": monotonic() - start, "busy": self.busy}
+
+    def run_commands(self):
+        try:
+            while self.wake_r.recv(4096): pass
+        except BlockingIOError:
+            pass
+        while self.commands:
+            func, args, done = self.commands.popleft()
+            try: func(*args)
+            except Exception as e: logging.error(f"Relay engine command failed: {e}")
+            done.set()
+
+
+class RelayEngine:
+    """Owns every loopback relay socket; Tracks register on play and unregister on pause/teardown"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:  # published only once built, so concurrent first PLAYs all see .lock
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    count = Config().get("relay_threads", 1) or os.cpu_count() or 1
+                    instance.loops = [RelayLoop(i) for i in range(count)]
+                    instance.owners = {}
+                    instance.lock = threading.Lock()
+                    cls._instance = instance
+        return cls._instance
+
+    def register(self, sock, callback):
+        sock.setblocking(False)
+        with self.lock:
+            loop = min(self.loops, key=lambda l: l.count)
+            loop.count += 1
+            self.owners[sock] = loop
+        loop.submit(loop.add, sock, callback)
+
+    def unregister(self, sock):
+        """Once this returns, callback won't be called for sock again"""
+        with self.lock:
+            loop = self.owners.pop(sock, None)
+            if loop is not None: loop.count -= 1
+        if loop is not None:
+            loop.submit(loop.remove, sock)
@@ -0,0 +1,73 @@
+import time
+import struct
+
+NTP_EPOCH_OFFSET = 2208988800
+
+
+def rtp_payload(packet):
+    """Returns the payload of an RTP packet, skipping CSRCs and the header extension"""
+    start = 12 + 4 * (packet[0] & 0x0f)
+    if packet[0] & 0x10 and len(packet) >= start + 4:
+        start += 4 + 4 * int.from_bytes(packet[start+2:start+4], "big")
+    return packet[start:]
+
+def encoding_name(sdp_lines):
+    """Gets the encoding name (H264, MPEG4-GENERIC...) from a track's a=rtpmap line"""
+    for line in sdp_lines or ():
+        if line.startswith("a=rtpmap:"):
+            return line.split(" ", 1)[1].split("/")[0].upper()
+    return None
+
+def is_keyframe_start(codec, packet):
+    """True if the RTP packet starts a video keyframe (or the parameter sets sent right before one).
+    Only H.264 and H.265 are inspected; packets of other codecs are never reported as keyframes"""
+    payload = rtp_payload(packet)
+    if len(payload) < 3:
+        return False
+    if codec == "H264":
+        nal = payload[0] & 0x1f
+        if nal in (5, 7): return True
+        if nal == 28: return bool(payload[1] & 0x80) and payload[1] & 0x1f == 5  # FU-A start
+        if nal == 24 and len(payload) > 3: return payload[3] & 0x1f in (5, 7)  # STAP-A
+        return False
+    if codec in ("H265", "HEVC"):
+        nal = (payload[0] >> 1) & 0x3f
+        if 16 <= nal <= 21 or nal in (32, 33, 34): return True
+        if nal == 49: return bool(payload[2] & 0x80) and 16 <= payload[2] & 0x3f <= 21  # FU start
+        if nal == 48 and len(payload) > 4: return 16 <= (payload[4] >> 1) & 0x3f <= 21 or (payload[4] >> 1) & 0x3f in (32, 33, 34)
+        return False
+    return False
+
+def sender_report(ssrc, rtp_ts, packets, octets, cname="deadRTSP"):
+    """Builds a compound RTCP packet: SR followed by SDES with CNAME"""
+    now = time.time() + NTP_EPOCH_OFFSET
+    ntp_sec = int(now)
+    ntp_frac = int((now - ntp_sec) * (1 << 32)) & 0xFFFFFFFF
+    sr = struct.pack("!BBHIIIIII", 0x80, 200, 6, ssrc, ntp_sec & 0xFFFFFFFF, ntp_frac, rtp_ts & 0xFFFFFFFF,
+                     packets & 0xFFFFFFFF, octets & 0xFFFFFFFF)
+    item = bytes([1, len(cname)]) + cname.encode()
+    chunk = struct.pack("!I", ssrc) + item + b"\0"
+    chunk += b"\0" * (-len(chunk) % 4)
+    sdes = struct.pack("!BBH", 0x81, 202, len(chunk) // 4) + chunk
+    return sr + sdes
+
+def report_blocks(packet):
+    """Report blocks of the SRs and RRs in a compound RTCP packet, as (ssrc, fraction lost, cumulative lost,
+    extended highest seq, jitter in RTP timestamp units). Malformed packets end the walk"""
+    blocks = []
+    pos = 0
+    while pos + 8 <= len(packet):
+        first, ptype, length = struct.unpack_from("!BBH", packet, pos)
+        end = pos + 4 * (length + 1)
+        if first >> 6 != 2 or end > len(packet): break
+        start = {200: pos + 28, 201: pos + 8}.get(ptype)
+        if start is not None:
+            for i in range(first & 0x1f):
+                off = start + 24 * i
+                if off + 24 > end: break
+                ssrc, lost, seq, jitter = struct.unpack_from("!IIII", packet, off)
+                cumulative = lost & 0xFFFFFF
+                if cumulative & 0x800000: cumulative -= 0x1000000  # signed; duplicates can make it negative
+                blocks.append((ssrc, (lost >> 24) / 256, cumulative, seq, jitter))
+        pos = end
+    return blocks
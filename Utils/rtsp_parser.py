@@ -0,0 +1,100 @@
+import logging
+
+MAX_HEADER_BYTES = 65536  # a request whose headers don't end by then is garbage; the buffer is dropped
+
+
+class Request(str):
+    """A parsed RTSP (or tunnel HTTP) request. It's also the request text itself,
+    so code matching on the raw text, like configurable.choose_source, keeps working"""
+    def __new__(cls, text, body=b""):
+        self = super().__new__(cls, text)
+        lines = text.split("\r\n")
+        parts = lines[0].split(" ", 2)
+        self.method = parts[0].upper()
+        self.url = parts[1] if len(parts) > 1 else ""
+        self.version = parts[2] if len(parts) > 2 else ""
+        self.headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep: self.headers[name.strip().lower()] = value.strip()
+        self.body = body
+        return self
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def cseq(self):
+        value = self.headers.get("cseq", "")
+        return value if value.isdigit() else 0
+
+
+class RTSPParser:
+    """Incremental parser for a client connection. feed() returns a list of what became complete:
+    Request objects and (channel, payload) tuples for $-framed interleaved data (RTCP from TCP clients).
+    Each byte is scanned once, Content-Length bodies are honoured and pipelined requests come out in order"""
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0  # start of unparsed data in buf
+        self.scanned = 0  # offset from pos already searched for the end of headers
+        self.pending = None  # (request, body length) while waiting for a body
+
+    def feed(self, data):
+        self.buf += data
+        out = []
+        while True:
+            msg = self.next_message()
+            if msg is None: break
+            out.append(msg)
+            if isinstance(msg, Request) and msg.method == "POST": break  # the rest is tunnel base64, see take_rest
+        # compact once the consumed part dominates, so the buffer doesn't grow with the connection's lifetime
+        if self.pos > len(self.buf) // 2:
+            del self.buf[:self.pos]
+            self.pos = 0
+        return out
+
+    def next_message(self):
+        buf, pos = self.buf, self.pos
+        if self.pending is not None:
+            request, length = self.pending
+            if len(buf) - pos < length: return None
+            self.pending = None
+            self.pos = pos + length
+            request.body = bytes(buf[pos:pos+length])
+            return request
+
+        while pos < len(buf) and buf[pos] in (13, 10):  # CRLF between requests
+            pos += 1
+        self.pos = pos
+        if pos == len(buf): return None
+
+        if buf[pos] == 0x24:  # '$': interleaved binary frame
+            if len(buf) - pos < 4: return None
+            length = int.from_bytes(buf[pos+2:pos+4], "big")
+            if len(buf) - pos < 4 + length: return None
+            self.pos = pos + 4 + length
+            return buf[pos+1], bytes(buf[pos+4:pos+4+length])
+
+        end = buf.find(b"\r\n\r\n", pos + max(self.scanned - 3, 0))
+        if end == -1:
+            self.scanned = len(buf) - pos
+            if self.scanned > MAX_HEADER_BYTES:
+                logging.warning(f"Dropping {self.scanned} bytes without a complete request")
+                self.buf, self.pos, self.scanned = bytearray(), 0, 0
+            return None
+        self.scanned = 0
+        text = buf[pos:end].decode("utf-8", errors="ignore")
+        self.pos = end + 4
+        request = Request(text + "\r\n\r\n")
+        length = request.header("content-length", "0")
+        length = int(length) if length.isdigit() else 0
+        if length and request.method != "POST":  # a tunnel POST's "body" is the rest of the connection
+            self.pending = (request, length)
+            return self.next_message()
+        return request
+
+    def take_rest(self):
+        """Unparsed bytes, e.g. the base64 that follows a tunnel POST; the parser is left empty"""
+        rest = bytes(self.buf[self.pos:])
+        self.buf, self.pos, self.scanned = bytearray(), 0, 0
+        return rest
@@ -0,0 +1,119 @@
+from base64 import b64encode
+
+# MPEG-4 Audio sampling frequency index, used to build AudioSpecificConfig when the container has none
+AAC_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+AAC_PROFILES = {"Main": 1, "LC": 2, "SSR": 3, "LTP": 4, "HE-AAC": 5, "HE-AACv2": 29}
+
+
+def parse_extradata(dump):
+    """Converts ffprobe's -show_data hex dump back to bytes"""
+    res = bytearray()
+    if not dump:
+        return bytes(res)
+    for line in dump.splitlines():
+        # "%08x: " offset, then a hex area padded to 41 chars, then the ascii column
+        if len(line) < 11 or line[8] != ":":
+            continue
+        res += bytes.fromhex(line[10:51])
+    return bytes(res)
+
+def split_annexb(data):
+    """Splits Annex B byte stream into NAL units"""
+    nals = []
+    i = data.find(b"\x00\x00\x01")
+    while i != -1:
+        start = i + 3
+        i = data.find(b"\x00\x00\x01", start)
+        end = len(data) if i == -1 else i
+        nal = data[start:end].rstrip(b"\x00")
+        if nal: nals.append(nal)
+    return nals
+
+def h264_parameter_sets(extradata):
+    """Gets SPS and PPS NAL units from avcC or Annex B extradata"""
+    if not extradata:
+        return [], []
+    if extradata[0] == 1 and len(extradata) > 6:
+        # avcC: version, profile, compat, level, length size, then counted SPS and PPS lists
+        nals = []
+        pos = 5
+        try:
+            for mask in (0x1f, 0xff):
+                count = extradata[pos] & mask
+                pos += 1
+                for _ in range(count):
+                    size = int.from_bytes(extradata[pos:pos+2], "big")
+                    nals.append(extradata[pos+2:pos+2+size])
+                    pos += 2 + size
+        except IndexError:
+            pass
+    else:
+        nals = split_annexb(extradata)
+    sps = [n for n in nals if n and n[0] & 0x1f == 7]
+    pps = [n for n in nals if n and n[0] & 0x1f == 8]
+    return sps, pps
+
+def aac_config(stream, extradata):
+    """Returns AudioSpecificConfig as hex, building it from stream fields for ADTS sources"""
+    if extradata:
+        return extradata.hex()
+    rate, ch = int(stream["sample_rate"]), int(stream["channels"])
+    if rate not in AAC_RATES or ch > 7:
+        return None
+    obj = AAC_PROFILES.get(stream.get("profile"), 2)
+    if obj > 5: obj = 2  # SBR/PS are signalled implicitly
+    asc = (obj << 11) | (AAC_RATES.index(rate) << 7) | (ch << 3)
+    return asc.to_bytes(2, "big").hex()
+
+def build_media(stream, ptype):
+    """Builds SDP media lines (m=, a=rtpmap, a=fmtp...) for one ffprobe stream.
+    Returns None if the codec isn't supported, so the caller can fall back to ffmpeg"""
+    codec = stream.get("codec_name")
+    extradata = parse_extradata(stream.get("extradata"))
+
+    if stream.get("codec_type") == "video":
+        lines = [f"m=video 0 RTP/AVP {ptype}"]
+        if codec == "h264":
+            sps, pps = h264_parameter_sets(extradata)
+            if not sps or not pps or len(sps[0]) < 4:
+                return None
+            sprop = ",".join(b64encode(n).decode() for n in sps + pps)
+            lines.append(f"a=rtpmap:{ptype} H264/90000")
+            lines.append(f"a=fmtp:{ptype} packetization-mode=1; sprop-parameter-sets={sprop}; profile-level-id={sps[0][1:4].hex().upper()}")
+        elif codec in ("h263", "h263p"):
+            lines.append(f"a=rtpmap:{ptype} H263-2000/90000")
+            lines.append(f"a=framesize:{ptype} {stream["width"]}-{stream["height"]}")
+        elif codec == "mpeg4":
+            config = f"; config={extradata.hex()}" if extradata else ""
+            lines.append(f"a=rtpmap:{ptype} MP4V-ES/90000")
+            lines.append(f"a=fmtp:{ptype} profile-level-id=1{config}")
+        else:
+            return None
+        return lines
+
+    if stream.get("codec_type") == "audio":
+        lines = [f"m=audio 0 RTP/AVP {ptype}"]
+        rate, ch = stream["sample_rate"], stream["channels"]
+        if codec == "aac":
+            config = aac_config(stream, extradata)
+            if config is None:
+                return None
+            lines.append(f"a=rtpmap:{ptype} MPEG4-GENERIC/{rate}/{ch}")
+            lines.append(f"a=fmtp:{ptype} profile-level-id=1;mode=AAC-hbr;sizelength=13;indexlength=3;indexdeltalength=3; config={config}")
+        elif codec in ("mp3", "mp2"):
+            lines.append(f"a=rtpmap:{ptype} MPA/{rate}/{ch}")
+        elif codec == "pcm_mulaw":
+            lines.append(f"a=rtpmap:{ptype} PCMU/{rate}/{ch}")
+        elif codec == "pcm_alaw":
+            lines.append(f"a=rtpmap:{ptype} PCMA/{rate}/{ch}")
+        elif codec in ("amr_nb", "amr_wb"):
+            lines.append(f"a=rtpmap:{ptype} {"AMR" if codec == "amr_nb" else "AMR-WB"}/{rate}/{ch}")
+            lines.append(f"a=fmtp:{ptype} octet-align=1")
+        elif codec == "opus":
+            lines.append(f"a=rtpmap:{ptype} opus/48000/2")
+            if int(ch) == 2: lines.append(f"a=fmtp:{ptype} sprop-stereo=1")
+        else:
+            return None
+        return lines
+
+    return None
@@ -1,6 +1,11 @@
 from secrets import randbelow
 import subprocess
 import json
+import logging
+from .probe_cache import ProbeCache
+from .ports import PortAllocator
+from .sdp_engine import build_media
+from .rtp import encoding_name
 
 MAX_SSRC = 2_147_483_648
 
@@ -9,7 +14,8 @@ SDP_HEADER = ["v=0", "a=control:*"]
 
 def parse_streams(input_path):
     """Gets video and audio tracks, as well as audio codec data"""
-    streams_cmd = ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", input_path]
+    # -show_data adds stream extradata (SPS/PPS, AudioSpecificConfig) used by the SDP engine
+    streams_cmd = ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-show_data", "-of", "json", input_path]
     proc = subprocess.run(streams_cmd, capture_output=True, text=True)
     res = json.loads(proc.stdout)
     vtracks = []
@@ -46,16 +52,60 @@ def parse_sdp_media(sdp_lines, track_id, fmt=None):
 
     return media, ssrc
 
-def generate_sdp(input_path, target_ip, port, is_live=False, compat=False):
-    """Generates SDP for the given input.
+def fallback_media(input_path, track_id, ptype, port, track_info):
+    """Scrapes SDP lines from a short ffmpeg run for codecs the SDP engine can't describe"""
+    lines = parse_track(input_path, track_id, ptype, port)
+    if ptype == 96: return lines, None
+    codec, rate, ch = track_info["codec_name"], track_info["sample_rate"], track_info["channels"]
+
+    contains_rtpmap = any(line.startswith("a=rtpmap") for line in lines)
+    fmt_lines = []
+    if not contains_rtpmap:
+        if codec == "mp3": fmt_lines.append(f"a=rtpmap:97 MPA/{rate}/{ch}")
+        elif codec == "pcm_mulaw": fmt_lines.append(f"a=rtpmap:97 PCMU/{rate}/{ch}")
+        else: fmt_lines.append(f"a=rtpmap:97 {codec.upper()}/{rate}/{ch}")
+    return lines, fmt_lines
+
+def probe_media(input_path):
+    """Collects the session-independent parts of the SDP: track layout, per-track SDP lines, rates and duration.
+    SDP lines are built from ffprobe data; ffmpeg is only run for codecs the SDP engine doesn't know"""
+    vtracks, atracks, ffprobe_data = parse_streams(input_path)
+    media = []  # (track_id, sdp_lines, fmt_lines)
+    rates = []
+    port = None
+
+    try:
+        for track_id in vtracks + atracks:
+            track_info = ffprobe_data["streams"][track_id]
+            ptype = 96 if track_id in vtracks else 97
+            lines = build_media(track_info, ptype)
+            if lines is not None:
+                media.append((track_id, lines, None))
+            else:
+                logging.info(f"SDP engine can't describe {track_info.get("codec_name")}, asking ffmpeg")
+                if port is None:
+                    port = PortAllocator().allocate("sdp", "sdp")
+                media.append((track_id, *fallback_media(input_path, track_id, ptype, port, track_info)))
+            rates.append(90000 if ptype == 96 else int(track_info["sample_rate"]))
+    finally:
+        PortAllocator().release(port)
+
+    try: vid_duration = float(ffprobe_data["format"]["duration"])
+    except: vid_duration = None
+    try: bitrate = int(ffprobe_data["format"]["bit_rate"])
+    except: bitrate = None
+    codecs = [encoding_name(list(lines) + list(fmt_lines or [])) for _, lines, fmt_lines in media]
+    return {"vtracks": len(vtracks), "atracks": len(atracks), "media": media, "rates": rates, "len": vid_duration,
+            "codecs": codecs, "bitrate": bitrate}
+
+def generate_sdp(input_path, target_ip, is_live=False, compat=False):
+    """Generates SDP for the given input. Probe results are cached per file, SSRCs are fresh on every call.
     Args:
         input_path (str): Path to the input
         target_ip (str): IP to use in SDP
-        port (int): Port to use for generation
         is_live (bool): Don't report content duration if true
         compat (bool): Enables is_live and limits tracks to 1v+1a max"""
-    # get amount of tracks and ffprobe
-    vtracks, atracks, ffprobe_data = parse_streams(input_path)
+    probe = ProbeCache().get(input_path, "sdp", probe_media)
 
     if compat:
         is_live = True
@@ -63,42 +113,18 @@ def generate_sdp(input_path, target_ip, port, is_live=False, compat=False):
         # atracks = min(1, atracks)
 
     ssrcs = []
-    rates = []
     sdp_media = []
-
-    # generate video sdp
-    for track_id in vtracks:
-        v_lines = parse_track(input_path, track_id, 96, port)
-        sm, ssrc_temp = parse_sdp_media(v_lines, track_id, None)
-        sdp_media.extend(sm)
-        ssrcs.append(ssrc_temp)
-        rates.append(90000)
-
-    # generate audio sdp
-    for track_id in atracks:
-        a_lines = parse_track(input_path, track_id, 97, port)
-        track_info = ffprobe_data["streams"][track_id]
-        codec, rate, ch = track_info["codec_name"], track_info["sample_rate"], track_info["channels"]
-
-        contains_rtpmap = any(line.startswith("a=rtpmap") for line in a_lines)
-        fmt_lines = []
-        if not contains_rtpmap:
-            if codec == "mp3": fmt_lines.append(f"a=rtpmap:97 MPA/{rate}/{ch}")
-            elif codec == "pcm_mulaw": fmt_lines.append(f"a=rtpmap:97 PCMU/{rate}/{ch}")
-            else: fmt_lines.append(f"a=rtpmap:97 {codec.upper()}/{rate}/{ch}")
-
-        sm, ssrc_temp = parse_sdp_media(a_lines, track_id, fmt_lines)
+    for track_id, lines, fmt_lines in probe["media"]:
+        sm, ssrc_temp = parse_sdp_media(lines, track_id, fmt_lines)
         sdp_media.extend(sm)
         ssrcs.append(ssrc_temp)
 
-        rates.append(int(rate))
-
-    headers = SDP_HEADER
-    try: vid_duration = float(ffprobe_data["format"]["duration"])
-    except: vid_duration = None
+    headers = list(SDP_HEADER)
+    vid_duration = probe["len"]
     if not is_live and vid_duration is not None:
         headers.append(f"a=range:npt=0-{vid_duration}")
     res = "\r\n".join(headers + sdp_media).replace("127.0.0.1", target_ip)
     # Convert to CRLF line endings
     res += "\r\n\r\n"
-    return {"sdp": res, "vtracks": len(vtracks), "atracks": len(atracks), "ssrcs": ssrcs, "rates": rates, "len": vid_duration}
+    return {"sdp": res, "vtracks": probe["vtracks"], "atracks": probe["atracks"], "ssrcs": ssrcs, "rates": list(probe["rates"]),
+            "len": vid_duration, "codecs": list(probe["codecs"])}
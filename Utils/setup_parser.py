@@ -1,18 +1,20 @@
-from .config import Config
+from .ports import PortAllocator
 
 def parse_udp(tline, track_id, transport):
+    client_ports = None
     parts = tline.split(";")
     for part in parts:
         if "client_port" in part:
             ports = part.split("=")[1]
             client_ports = tuple(map(int, ports.split("-")))
+    own_port = None
     if not client_ports:
-        t = Config().get_free_port()
-        client_ports = (t, t + 1)
+        # a pair nobody else gets until teardown, as other sessions' clients may be on this host too
+        own_port = PortAllocator().allocate("udp", transport.session.session_id)
+        client_ports = (own_port, own_port + 1)
 
-    server_port = Config().get_free_port("udp")
-    Config().port_set_used(server_port)
-    transport.track_map[track_id] = {"c": client_ports, "s": tuple([server_port, server_port+1])}
+    server_port = PortAllocator().allocate("udp", transport.session.session_id)
+    transport.track_map[track_id] = {"c": client_ports, "s": tuple([server_port, server_port+1]), "own_c": own_port}
 
 def parse_tcp(tline, track_id, transport):
     channels = []
@@ -29,6 +31,5 @@ def parse_tcp(tline, track_id, transport):
     transport.track_map[track_id] = tuple(channels)
 
 def parse_udp_m(track_id, transport):
-    server_port = Config().get_free_port("udp")
-    Config().port_set_used(server_port)
+    server_port = PortAllocator().allocate("udp", transport.session.session_id)
     transport.track_map[track_id] = tuple([server_port, server_port+1])
\ No newline at end of file
@@ -0,0 +1,29 @@
+import binascii
+
+WHITESPACE = b" \t\r\n"
+
+
+class TunnelDecoder:
+    """Client-to-server half of an RTSP-over-HTTP tunnel: base64 text in, the RTSP byte stream out.
+    Only complete 4-character groups are decoded, each byte once; the rest waits for the next read.
+    Clients encode every request on its own, so padded groups can appear mid-stream"""
+    def __init__(self):
+        self.encoded = b""  # fewer than 4 characters left over from the last feed
+
+    def feed(self, data):
+        """Returns the bytes that can be decoded now"""
+        decoded = bytearray()
+        data = self.encoded + data.translate(None, WHITESPACE)
+        usable = len(data) - len(data) % 4
+        self.encoded = data[usable:]
+        start = 0
+        while start < usable:
+            # a2b_base64 stops at padding, so decode up to and including each padded group separately
+            pad = data.find(b"=", start, usable)
+            end = usable if pad == -1 else pad - pad % 4 + 4
+            try:
+                decoded += binascii.a2b_base64(data[start:end])
+            except binascii.Error:
+                pass  # garbage from a broken client; drop the chunk like the old whole-buffer decode did
+            start = end
+        return decoded
@@ -0,0 +1,272 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from Utils import Config, generate_session_id
+from Utils.backend import set_backend
+from Utils.expiry import SessionExpiry
+from Utils.egress import egress_budget, pressure_of
+from Utils.metrics import Metrics, start_metrics
+from Utils.catalog import Catalog
+from RTSPSession import RTSPSession
+from main import SessionRegistry
+
+
+class LoopConn:
+    """Socket-like wrapper around an asyncio transport, so sessions and transports can keep calling send()"""
+    def __init__(self, backend, transport):
+        self.backend = backend
+        self.transport = transport
+        self.budget = egress_budget()
+        self.peak = 0
+
+    def pressure(self):
+        """Same levels as EgressQueue.pressure, from what the asyncio transport hasn't written yet"""
+        queued = self.transport.get_write_buffer_size()
+        self.peak = max(self.peak, queued)
+        return pressure_of(queued, self.budget)
+
+    def stats(self):
+        return {"queued": self.transport.get_write_buffer_size(), "peak": self.peak}
+
+    # The transport keeps what it can't write right away without copying it, while relays reuse their buffers
+    # for the next packet, so it always gets a copy
+    def send(self, data):
+        self.backend.call(self.transport.write, bytes(data))
+        return len(data)
+
+    def sendmsg(self, buffers):
+        self.backend.call(self.transport.writelines, [bytes(b) for b in buffers])
+        return sum(len(b) for b in buffers)
+
+    sendall = send
+
+    def close(self):
+        self.backend.call(self.transport.close)
+
+    def detach(self):
+        """A duplicate of the connection's descriptor; the transport is closed without shutting the connection down"""
+        fd = os.dup(self.transport.get_extra_info("socket").fileno())
+        self.transport.abort()
+        return fd
+
+
+class AsyncProcess:
+    """ffmpeg started with asyncio.create_subprocess_exec; stop() can be called before it's running"""
+    def __init__(self, loop, cmd):
+        self.loop = loop
+        self.cmd = cmd
+        self.proc = None
+        self.task = None
+        self.stopping = False
+        self.kill = False
+        self.on_exit = []
+
+    def start(self):
+        self.task = self.loop.create_task(self.run())
+
+    async def run(self):
+        try:
+            self.proc = await asyncio.create_subprocess_exec(*self.cmd, stdout=subprocess.DEVNULL)
+        except OSError as e:
+            logging.error(f"Failed to start ffmpeg: {e}")
+            self.exited()
+            return
+        if self.stopping: await self.terminate()
+        else: await self.proc.wait()  # reap when it exits on its own
+
+    def stop(self, then=None, kill=False):
+        if then is not None: self.on_exit.append(then)
+        if self.stopping: return
+        self.stopping = True
+        self.kill = kill
+        if self.proc is not None:
+            self.loop.create_task(self.terminate())
+        elif self.task is not None and self.task.done():
+            self.exited()
+
+    async def terminate(self):
+        if self.proc.returncode is None and self.kill:
+            self.proc.kill()
+            await self.proc.wait()
+        elif self.proc.returncode is None:
+            self.proc.terminate()
+            try:
+                await asyncio.wait_for(self.proc.wait(), 2)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+        self.exited()
+
+    def poll(self):
+        """Like Popen.poll: None while starting or running"""
+        if self.proc is not None: return self.proc.returncode
+        return -1 if self.task is not None and self.task.done() else None
+
+    def exited(self):
+        callbacks, self.on_exit = self.on_exit, []
+        for then in callbacks: then()
+
+
+class AsyncioBackend:
+    """Runs relays and ffmpeg processes on the server's event loop instead of threads"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+
+    def in_loop(self):
+        return threading.get_ident() == self.thread_id
+
+    def call(self, func, *args):
+        if self.in_loop(): func(*args)
+        else: self.loop.call_soon_threadsafe(func, *args)
+
+    def spawn(self, cmd):
+        proc = AsyncProcess(self.loop, cmd)
+        self.call(proc.start)
+        Metrics().watch_process(proc)
+        return proc
+
+    def stop_process(self, proc, then=None, kill=False):
+        self.call(proc.stop, then, kill)
+
+    def add_reader(self, sock, callback):
+        sock.setblocking(False)
+        self.call(self.loop.add_reader, sock, self.on_readable, sock, callback)
+
+    def remove_reader(self, sock, close=True):
+        self.call(self.close_reader, sock, close)
+
+    def egress(self, conn):
+        return conn  # a LoopConn; the asyncio transport queues copies of what it gets and writes them in the background
+
+    def defer(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def loop_stats(self):
+        """How long the event loop takes to get to a callback; called from the metrics thread"""
+        ran = threading.Event()
+        start = time.monotonic()
+        self.loop.call_soon_threadsafe(ran.set)
+        ran.wait(5)
+        return [{"name": "asyncio", "lag": time.monotonic() - start}]
+
+    def close_reader(self, sock, close=True):
+        if sock.fileno() != -1: self.loop.remove_reader(sock)
+        if close: sock.close()
+
+    def on_readable(self, sock, callback):
+        try:
+            callback(sock)
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            logging.error(f"Relay stopped: {e}")
+            self.close_reader(sock)
+
+
+class AsyncRTSPSession(RTSPSession):
+    """RTSPSession driven by the event loop: no request threads.
+    Requests are handled in order; those that may probe the source run in a small executor"""
+    def __init__(self, conn, addr, sid, parent_server):
+        super().__init__(conn, addr, sid, parent_server)
+        self.loop = parent_server.loop
+        self.pending = []
+        self.draining = False
+
+    def start(self, data=b""):
+        SessionExpiry().watch(self)
+        if data: self.on_bytes(data)
+
+    def on_bytes(self, data):
+        try: super().on_bytes(data)
+        except Exception as e:
+            logging.warning(f"[{self.addr}]: Error: {e}")
+
+    def handle_rtsp(self, request):
+        self.pending.append(request)
+        if not self.draining:
+            self.draining = True
+            self.loop.create_task(self.drain())
+
+    def may_block(self, request):
+        """DESCRIBE may probe the source. A VoD PLAY that doesn't start at 0, seeking or resuming after PAUSE,
+        may build the title's keyframe index (see track.seek_point)"""
+        if request.method == "DESCRIBE": return True
+        return request.method == "PLAY" and not self.live_mode and ("range" in request.headers or self.play_offset > 0)
+
+    async def drain(self):
+        try:
+            while self.pending:
+                request = self.pending.pop(0)
+                try:
+                    if self.may_block(request):
+                        await self.loop.run_in_executor(self.parent_server.executor, super().handle_rtsp, request)
+                    else:
+                        super().handle_rtsp(request)
+                except Exception as e:
+                    logging.warning(f"[{self.addr}]: Error: {e}")
+        finally:
+            self.draining = False
+
+
+class RTSPProtocol(asyncio.Protocol):
+    def __init__(self, server, data=b""):
+        self.server = server
+        self.session = None
+        self.data = data  # received by the worker that handed the connection over
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info("peername")
+        logging.info(f"Connection from {addr} handed over" if self.data else f"New connection from {addr}")
+        conn = LoopConn(self.server.backend, transport)
+        self.session = self.server.new_session(conn, addr, self.data)
+
+    def data_received(self, data):
+        self.session.on_bytes(data)
+
+
+class AsyncRTSPServer:
+    """Same interface as main.RTSPServer, but every session, relay, timeout and ffmpeg process lives on one event loop"""
+    def __init__(self, link=None):
+        self.link = link  # WorkerLink when running as one of several worker processes
+        self.registry = SessionRegistry()
+        self.sessions = self.registry.sessions
+        self.sessions_lock = self.registry.lock
+        self.executor = ThreadPoolExecutor(Config().get("async_blocking_workers", 4))
+        self.loop = asyncio.new_event_loop()
+        self.backend = AsyncioBackend(self.loop)
+        set_backend(self.backend)
+        start_metrics(self)
+        Catalog().start_indexer()
+        if link is not None: link.serve(self.accept_handoff)
+        self.loop.run_until_complete(self.serve())
+
+    async def serve(self):
+        port = Config().get("main_port")
+        server = await self.loop.create_server(
+            lambda: RTSPProtocol(self), family=socket.AF_INET, port=port,
+            backlog=Config().get("max_connections"), reuse_address=True, reuse_port=self.link is not None
+        )
+        if self.link is None: print(f"Started RTSP server at port {port} (asyncio)")
+        async with server:
+            await server.serve_forever()
+
+    def new_session(self, conn, addr, data=b""):
+        sid = generate_session_id(self.sessions_lock, self.sessions)
+        session = AsyncRTSPSession(conn, addr, sid, self)
+        self.registry.add(sid, session)
+        session.start(data)
+        return session
+
+    def accept_handoff(self, conn, data):
+        """From the worker link's thread: serve a connection another worker received"""
+        conn.setblocking(False)
+        asyncio.run_coroutine_threadsafe(self.loop.connect_accepted_socket(lambda: RTSPProtocol(self, data), conn), self.loop)
+
+    def delete_session(self, sid):
+        self.registry.remove(sid)
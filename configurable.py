@@ -1,3 +1,6 @@
+import os
+import glob
+
 # EDIT THIS FUNCTION TO CHANGE THE SOURCE
 def choose_source(request_text):
     """Gets content source for the stream.
@@ -5,10 +8,28 @@ def choose_source(request_text):
     content_path(str): path to the content; return None if no content
     is_live(bool): True if the stream is live, False otherwise
     """
+    # To serve the titles indexed in media_dir (config.yaml) by name, e.g. rtsp://host:8554/movies/a.mp4:
+    # from Utils.catalog import Catalog
+    # return Catalog().find(request_text.url), False
 
     return "vids/res.ts", True
 
 
+# EDIT THIS FUNCTION TO CHANGE HOW BITRATE RENDITIONS ARE FOUND
+def find_renditions(content_path):
+    """Gets other encodings of the same title that sessions may switch to, e.g. when clients report loss.
+    They need the same tracks and codecs and keyframes at the same times; anything else is skipped.
+    By default those are files next to the title named <title>@<anything>.<ext>,
+    e.g. vids/movie@480p.mp4 and vids/movie@1080p.mp4 for vids/movie.mp4
+    Returns:
+    list of paths; the title itself may be included
+    """
+    base, ext = os.path.splitext(content_path)
+    folder, title = os.path.split(base)
+    base = os.path.join(folder, title.split("@")[0])
+    return [path for path in glob.glob(glob.escape(base) + "@*" + ext) + [base + ext] if os.path.isfile(path)]
+
+
 def detect_multicast(request_text):
     """Detects multicast addresses from OPTIONS request"""
     return "multicast" in request_text
@@ -19,3 +40,29 @@ legacy_signatures = [
     "realmedia player"
     # ADD YOUR DEVICE HERE
 ]
+
+# EDIT THIS TO TRANSCODE TITLES FOR CLIENTS THAT CAN'T PLAY THEM AS-IS
+# Clients whose user agent contains one of a profile's signatures get titles transcoded with the profile's ffmpeg
+# options (first video and audio track only). Each title is transcoded once per profile, kept in transcode_cache_dir
+# and then served with stream copy like any other file. The first profile that matches is used
+transcode_profiles = {
+    # QCIF H.263 + AMR-NB, for phones without H.264
+    "qcif_h263_amr": {
+        "signatures": [
+            # ADD YOUR DEVICE HERE
+        ],
+        "ext": ".3gp",
+        "args": ["-c:v", "h263", "-s", "176x144", "-r", "15", "-g", "30", "-b:v", "96k",
+                 "-c:a", "libopencore_amrnb", "-ar", "8000", "-ac", "1", "-b:a", "12.2k"],
+    },
+    # low bitrate H.264 Baseline + AAC-LC
+    "h264_baseline_low": {
+        "signatures": [
+            # ADD YOUR DEVICE HERE
+        ],
+        "ext": ".mp4",
+        "args": ["-c:v", "libx264", "-profile:v", "baseline", "-level", "3.0", "-pix_fmt", "yuv420p",
+                 "-vf", "scale=-2:240", "-r", "25", "-g", "50", "-b:v", "256k", "-maxrate", "256k", "-bufsize", "512k",
+                 "-c:a", "aac", "-profile:a", "aac_low", "-ar", "22050", "-ac", "1", "-b:a", "48k"],
+    },
+}
@@ -0,0 +1,192 @@
+import time
+import socket
+import struct
+import logging
+import threading
+from Utils import Config
+from Utils.backend import get_backend
+from Utils.ports import PortAllocator
+from Utils.relay_engine import recv_buffer, use_batched_io
+from Utils.mmsg import recv_batch
+from Utils.rtp import is_keyframe_start
+
+
+class LiveSource:
+    """One ffmpeg and one relay per live source track, fanned out to every subscribed Track.
+    H.264/H.265 sources keep the RTP packets since the last keyframe (the GOP cache), so a new subscriber gets
+    a picture right away instead of waiting for the next keyframe"""
+    def __init__(self, key, content_source, selector, stream_loop, codec=None):
+        self.key = key
+        self.content_source = content_source
+        self.selector = selector
+        self.stream_loop = stream_loop
+        self.subscribers = ()  # replaced as a whole, so relays can iterate without locking
+        self.joining = ()  # subscribers waiting for the relay to send them the GOP cache
+        self.lock = threading.Lock()  # for replacing subscribers and joining; never held while waiting on a relay loop
+        self.run_lock = threading.Lock()  # start() and stop() may come from different threads, in either order
+        self.stopped = False
+
+        # packets as ffmpeg sent them, starting at a keyframe; None until the first one or after a GOP too long to keep
+        self.gop_limit = Config().get("gop_cache_kb", 1024) * 1024
+        self.codec = codec if codec in ("H264", "H265", "HEVC") and self.gop_limit > 0 else None
+        self.gop = None
+        self.gop_ts = None
+        self.gop_time = None  # when the keyframe was received
+        self.gop_bytes = 0
+        self.proc = None
+        self.relay_socks = []
+
+        self.ffmpeg_from_port = PortAllocator().allocate("relay", "live")
+        self.ffmpeg_target_port = PortAllocator().allocate("relay", "live")
+
+    def start(self):
+        with self.run_lock:
+            if not self.stopped: self.spawn()
+
+    def spawn(self):
+        cmd = [
+            "ffmpeg", "-loglevel", "error",
+            *(["-stream_loop", "-1"] if self.stream_loop else []), "-re",
+            "-i", self.content_source,
+            *self.selector, "-f", "rtp",
+            f"rtp://127.0.0.1:{self.ffmpeg_target_port}/?localport={self.ffmpeg_from_port}"
+        ]
+        self.start_relay(self.ffmpeg_target_port, 0)
+        if not Config().get("disable_rtcp"):
+            self.start_relay(self.ffmpeg_target_port + 1, 1)
+        self.proc = get_backend().spawn(cmd)
+        logging.info(f"Started shared live source {self.content_source} {self.selector}")
+
+    def stop(self):
+        """Safe to call before or while another thread starts the source; it won't be started after"""
+        with self.run_lock:
+            self.stopped = True
+            self.close()
+
+    def close(self):
+        for sock in self.relay_socks:
+            get_backend().remove_reader(sock)
+        self.relay_socks = []
+        if self.proc is not None:
+            get_backend().stop_process(self.proc, self.free_ports)
+        else:
+            self.free_ports()
+        self.proc = None
+        logging.info(f"Stopped shared live source {self.content_source} {self.selector}")
+
+    def free_ports(self):
+        PortAllocator().release(self.ffmpeg_from_port)
+        PortAllocator().release(self.ffmpeg_target_port)
+
+    def start_relay(self, from_port, relay_id):
+        try:
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp_socket.bind(("127.0.0.1", from_port))
+        except OSError:
+            logging.error(f"Port {from_port} is already in use; not relaying shared source {self.content_source}")
+            return
+        self.relay_socks.append(udp_socket)
+        if relay_id == 0 and use_batched_io():
+            get_backend().add_reader(udp_socket, self.relay_batch)
+        else:
+            get_backend().add_reader(udp_socket, lambda sock: self.relay(sock, relay_id))
+
+    def relay(self, sock, relay_id):
+        """Receive a packet from ffmpeg and hand a copy to every subscriber"""
+        buf, view = recv_buffer()
+        n = sock.recv_into(buf)
+        src_ts = struct.unpack_from("!I", buf, 4 if relay_id == 0 else 16)[0]
+        if relay_id == 0 and self.codec is not None: self.cache_packet(view[:n], src_ts)
+        for track in self.subscribers:
+            try: track.on_shared_packet(buf, view[:n], relay_id, src_ts)
+            except OSError as e:
+                logging.debug(f"Shared relay: dropping packet for session {track.session.session_id}: {e}")
+        if relay_id == 0 and self.joining: self.admit()
+
+    def relay_batch(self, sock):
+        """relay() for a whole burst of RTP packets"""
+        batch = recv_batch(sock)
+        src_ts = batch.timestamps()
+        if self.codec is not None:
+            for packet, ts in zip(batch.packets(), src_ts): self.cache_packet(packet, int(ts))
+        for track in self.subscribers:
+            try: track.on_shared_batch(batch, src_ts)
+            except OSError as e:
+                logging.debug(f"Shared relay: dropping packets for session {track.session.session_id}: {e}")
+        if self.joining: self.admit()
+
+    def cache_packet(self, packet, ts):
+        """Keep an RTP packet from ffmpeg in the GOP cache, before subscribers rewrite its header"""
+        if is_keyframe_start(self.codec, packet) and ts != self.gop_ts:
+            # parameter sets and the slices of one keyframe share a timestamp; a new one starts a new GOP
+            self.gop, self.gop_ts, self.gop_time, self.gop_bytes = [], ts, time.monotonic(), 0
+        if self.gop is None: return
+        self.gop_bytes += len(packet)
+        if self.gop_bytes > self.gop_limit:
+            self.gop = None  # too much to send in one go; new subscribers wait for the next keyframe instead
+            return
+        self.gop.append(bytes(packet))
+
+    def admit(self):
+        """Moves joining subscribers over, sending them the GOP cache first. Runs in the relay between two packets,
+        so a subscriber's burst and the live packets after it have no gap or overlap"""
+        gop = self.gop
+        with self.lock:
+            if gop:
+                # while they're still joining, so the other tracks of their sessions wait for this; see Track.anchor
+                for track in self.joining:
+                    if track.ts_offset is None: track.anchor(struct.unpack_from("!I", gop[0], 4)[0], self.gop_time, True)
+            joining, self.joining = self.joining, ()
+            self.subscribers = self.subscribers + joining
+        if not gop: return
+        for track in joining:
+            for packet in gop:
+                buf = bytearray(packet)  # rewritten in place for each subscriber
+                try: track.on_shared_packet(buf, memoryview(buf), 0, struct.unpack_from("!I", buf, 4)[0])
+                except OSError as e:
+                    logging.debug(f"Shared relay: dropping GOP for session {track.session.session_id}: {e}")
+                    break
+            logging.debug(f"Session {track.session.session_id}: sent {len(gop)} cached packets of {self.content_source}")
+
+
+class LiveHub:
+    """Registry of shared live sources; a source lives while it has subscribers"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance.sources = {}
+                    instance.lock = threading.Lock()
+                    cls._instance = instance
+        return cls._instance
+
+    def subscribe(self, track):
+        key = (track.session.content_source, tuple(track.selector), track.stream_loop)
+        video = track.track_id < (track.session.expected_video_tracks or 0)
+        with self.lock:
+            source = self.sources.get(key)
+            new = source is None
+            if new:
+                source = LiveSource(key, *key, track.session.codecs[track.track_id] if video else None)
+                self.sources[key] = source
+            with source.lock:
+                if source.codec is not None: source.joining = source.joining + (track,)
+                else: source.subscribers = source.subscribers + (track,)
+        # starting waits on the relay loops, so other sources' subscribers mustn't wait on it for the hub's lock
+        if new: source.start()
+        return source
+
+    def unsubscribe(self, track, source):
+        with self.lock:
+            with source.lock:
+                source.subscribers = tuple(t for t in source.subscribers if t is not track)
+                source.joining = tuple(t for t in source.joining if t is not track)
+                if source.subscribers or source.joining or self.sources.get(source.key) is not source:
+                    return
+            del self.sources[source.key]
+        source.stop()
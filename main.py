@@ -3,19 +3,81 @@ import logging
 import threading
 from Utils import Config, generate_session_id
 from RTSPSession import RTSPSession
+from Utils.metrics import start_metrics
+from Utils.catalog import Catalog
 
 
-class RTSPServer:
+class SessionRegistry:
+    """Sessions by ID, plus indexes for looking sessions up by multicast source and HTTP tunnel cookie.
+    Every update and lookup takes the lock, so no one iterates over sessions while another thread changes them"""
     def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.multicast = {}  # content source -> session hosting its multicast group
+        self.http_gets = {}  # x-sessioncookie -> session holding the GET half of an HTTP tunnel
+
+    def add(self, sid, session):
+        with self.lock:
+            self.sessions[sid] = session
+
+    def remove(self, sid):
+        with self.lock:
+            session = self.sessions.pop(sid, None)
+            if session is None: return
+            # a host leaving without multicast_admins leaves the group running for its viewers
+            if self.multicast.get(session.content_source) is session and getattr(session.transport, "watching", 0) <= 0:
+                del self.multicast[session.content_source]
+            if self.http_gets.get(session.xsc) is session:
+                del self.http_gets[session.xsc]
+
+    def multicast_group(self, content_source, claim=None):
+        """Host session of the source's multicast group. If there's none and claim is given, claim becomes the host"""
+        with self.lock:
+            host = self.multicast.get(content_source)
+            if host is None and claim is not None:
+                self.multicast[content_source] = host = claim
+            return host
+
+    def end_multicast_group(self, session):
+        """The multicast group session belongs to is torn down; returns the session that hosted it"""
+        with self.lock:
+            host = self.multicast.get(session.content_source)
+            if host is not None and host.transport is session.transport:
+                del self.multicast[session.content_source]
+                return host
+        return session
+
+    def add_http_get(self, xsc, session):
+        with self.lock:
+            self.http_gets[xsc] = session
+
+    def has_http_get(self, xsc):
+        with self.lock:
+            return xsc in self.http_gets
+
+    def pop_http_get(self, xsc):
+        """The GET session waiting for the POST half with this cookie, or None"""
+        with self.lock:
+            return self.http_gets.pop(xsc, None)
+
+
+class RTSPServer:
+    def __init__(self, link=None):
         port = Config().get("main_port")
+        self.link = link  # WorkerLink when running as one of several worker processes
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if link is not None: self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind(('', port))
         self.socket.listen(Config().get("max_connections"))
-        print(f"Started RTSP server at port {port}")
+        if link is None: print(f"Started RTSP server at port {port}")
 
-        self.sessions = {}
-        self.sessions_lock = threading.Lock()
+        self.registry = SessionRegistry()
+        self.sessions = self.registry.sessions
+        self.sessions_lock = self.registry.lock
+        start_metrics(self)
+        Catalog().start_indexer()
+        if link is not None: link.serve(self.accept_handoff)
 
         self.handle_connections()
 
@@ -25,16 +87,29 @@ class RTSPServer:
             logging.info(f"New connection from {addr}")
             self.new_session(conn, addr)
 
-    def new_session(self, conn, addr):
+    def new_session(self, conn, addr, data=b""):
         sid = generate_session_id(self.sessions_lock, self.sessions)
-        with self.sessions_lock:
-            self.sessions[sid] = RTSPSession(conn, addr, sid, self)
+        session = RTSPSession(conn, addr, sid, self)
+        self.registry.add(sid, session)
+        session.start(data)
+
+    def accept_handoff(self, conn, data):
+        """A connection another worker received; data is what it had received and not handled"""
+        addr = conn.getpeername()
+        logging.info(f"Connection from {addr} handed over")
+        self.new_session(conn, addr, data)
 
     def delete_session(self, sid):
-        with self.sessions_lock:
-            del self.sessions[sid]
+        self.registry.remove(sid)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=Config().get("log_level", 40))
-    RTSPServer()
\ No newline at end of file
+    if Config().get("workers", 1) > 1:
+        from workers import Supervisor
+        Supervisor(Config().get("workers")).run()
+    elif Config().get("server_core") == "asyncio":
+        from async_server import AsyncRTSPServer
+        AsyncRTSPServer()
+    else:
+        RTSPServer()
\ No newline at end of file
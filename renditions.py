@@ -0,0 +1,175 @@
+import os
+import logging
+import threading
+from time import monotonic
+from bisect import bisect_left, bisect_right
+from configurable import find_renditions
+from Utils import Config
+from Utils.backend import get_backend
+from Utils.keyframes import probe_keyframes
+from Utils.metrics import Metrics
+from Utils.probe_cache import ProbeCache
+from Utils.sdp_gen import probe_media
+from track import spawn_tracks, when_stopped
+
+# keyframes of two renditions this close are taken as the same switching point
+ALIGN_TOLERANCE = 0.05
+# the switch happens at a keyframe at least this far past the estimated position; ffmpeg -re sends a bit ahead
+SWITCH_LEAD = 2
+# how far ahead a keyframe both renditions have is looked for
+SWITCH_HORIZON = 30
+# reports right after a switch still cover the old rendition and the restart, and aren't acted on
+SETTLE = 5
+# ffmpeg bitstream filters that repeat the parameter sets in-band, so a rendition's SPS/PPS reach the client
+# even though the SDP describes the title
+INBAND_BSF = {"H264": "h264_mp4toannexb", "H265": "hevc_mp4toannexb", "HEVC": "hevc_mp4toannexb"}
+
+
+class Rendition:
+    def __init__(self, path, bitrate, keyframes):
+        self.path = path
+        self.bitrate = bitrate
+        self.keyframes = keyframes
+
+    def keyframe_near(self, seconds):
+        """Time of a keyframe within ALIGN_TOLERANCE of seconds, or None"""
+        i = bisect_left(self.keyframes, seconds - ALIGN_TOLERANCE)
+        if i < len(self.keyframes) and self.keyframes[i] <= seconds + ALIGN_TOLERANCE: return self.keyframes[i]
+        return None
+
+
+def load_ladder(content_source):
+    """Renditions of a title that can stand in for each other, lowest bitrate first; empty if there's no choice"""
+    others = [path for path in find_renditions(content_source) if os.path.realpath(path) != os.path.realpath(content_source)]
+    if not others: return []
+    own = ProbeCache().get(content_source, "sdp", probe_media)
+    ladder = []
+    seen = set()
+    for path in [content_source, *others]:
+        if os.path.realpath(path) in seen: continue
+        seen.add(os.path.realpath(path))
+        try:
+            probe = ProbeCache().get(path, "sdp", probe_media)
+        except Exception as e:
+            logging.warning(f"Can't probe rendition {path}: {e}")
+            continue
+        if any(probe[key] != own[key] for key in ("vtracks", "atracks", "codecs", "rates")):
+            logging.warning(f"Rendition {path} doesn't have the tracks of {content_source}, skipping it")
+            continue
+        if probe["bitrate"] is None:
+            logging.warning(f"Bitrate of rendition {path} unknown, skipping it")
+            continue
+        keyframes = ProbeCache().get(path, "keyframes", probe_keyframes) if own["vtracks"] else []
+        ladder.append(Rendition(path, probe["bitrate"], keyframes))
+    if len(ladder) < 2 or ladder[0].path != content_source: return []  # the title itself has to qualify too
+    return sorted(ladder, key=lambda r: r.bitrate)
+
+
+class RateAdapter:
+    """Moves a VoD session between renditions of its title, following the receiver reports of its first track.
+    Reported loss of rendition_down_loss percent or more, or frames dropped for a TCP/HTTP client that can't keep
+    up, move it one rendition down; rendition_up_after seconds without either, one up.
+    The switch happens at the next keyframe both renditions have: the old ffmpeg's packets stop there and a new one
+    starts at it, continuing SSRC, seq and timestamps"""
+    def __init__(self, session):
+        self.session = session
+        self.ladder = None  # loaded in the background; nothing is switched until then
+        self.current = None  # index in ladder
+        self.pending = None  # (target index, start time) of the switch waiting for its keyframe
+        self.down_loss = Config().get("rendition_down_loss", 5) / 100
+        self.base_up_after = self.up_after = Config().get("rendition_up_after", 20)
+        self.calm_since = monotonic()  # last switch or congested report
+        self.switched = 0
+        self.last_up = None
+        self.dropped = 0  # frames the egress filter had dropped at the last report
+        self.lock = threading.Lock()
+        threading.Thread(target=self.load, args=(session.content_source,), daemon=True).start()
+
+    def load(self, content_source):
+        try:
+            ladder = load_ladder(content_source)
+        except Exception as e:
+            logging.error(f"Session {self.session.session_id}: can't load renditions of {content_source}: {e}")
+            return
+        if not ladder: return
+        self.current = next(i for i, r in enumerate(ladder) if r.path == content_source)
+        self.ladder = ladder
+        logging.info(f"Session {self.session.session_id}: {len(ladder)} renditions of {content_source}, "
+                     f"{", ".join(f"{r.bitrate // 1000}k" for r in ladder)}")
+
+    def on_report(self, track, fraction_lost):
+        """A receiver report about track came in"""
+        session = self.session
+        if self.ladder is None or track.track_id != 0 or session.state != 3 or session.transport_mode == "udp_m": return
+        now = monotonic()
+        dropped = getattr(getattr(session.transport, "filter", None), "dropped", 0)
+        congested = fraction_lost >= self.down_loss or dropped > self.dropped
+        self.dropped = dropped
+        with self.lock:
+            if self.pending is not None or now - self.switched < SETTLE: return
+            if congested:
+                self.calm_since = now
+                if self.current == 0: return
+                if self.last_up is not None and now - self.last_up < 2 * self.up_after:
+                    # the rendition above didn't hold; wait longer before trying it again
+                    self.up_after = min(2 * self.up_after, 8 * self.base_up_after)
+                self.schedule(self.current - 1, f"{fraction_lost:.0%} loss, {dropped} frames dropped")
+            elif now - self.calm_since >= self.up_after and self.current < len(self.ladder) - 1:
+                self.schedule(self.current + 1, f"no loss for {now - self.calm_since:.0f} s")
+
+    def schedule(self, target, reason):
+        """Cut every track at the next keyframe the current and the target rendition share"""
+        session = self.session
+        if session.play_start_time is None: return
+        position = session.play_offset + monotonic() - session.play_start_time + SWITCH_LEAD
+        current, rendition = self.ladder[self.current], self.ladder[target]
+        at = start = position
+        if current.keyframes:
+            i = bisect_right(current.keyframes, position)
+            while i < len(current.keyframes) and current.keyframes[i] <= position + SWITCH_HORIZON:
+                at = current.keyframes[i]
+                start = rendition.keyframe_near(at)
+                if start is not None: break
+                i += 1
+            else:
+                logging.debug(f"Session {session.session_id}: no keyframe of {rendition.path} lines up with {current.path} soon")
+                return
+        logging.info(f"Session {session.session_id}: switching to {rendition.path} at {at:.3f} s ({reason})")
+        self.pending = (target, start)
+        for track in list(session.tracks.values()):
+            cut_ts = (round(at * track.clock_rate) + track.initial_ts_offset) & 0xFFFFFFFF
+            track.cut_at(cut_ts, self.on_cut)
+
+    def on_cut(self, track, reached):
+        """From a relay; the first track to reach the cut starts the switch, a missed one calls it off"""
+        with self.lock:
+            if self.pending is None: return
+            pending, self.pending = self.pending, None
+            if not reached:
+                logging.debug(f"Session {self.session.session_id}: switch point already sent, not switching")
+                for other in list(self.session.tracks.values()):
+                    if other is not track and other.cut_ts is not None: other.uncut()
+                return
+        get_backend().defer(self.switch, *pending)
+
+    def switch(self, target, start):
+        session = self.session
+        if session.state != 3: return  # paused or torn down meanwhile; PLAY goes on with the current rendition
+        tracks = list(session.tracks.values())
+        for track in tracks:
+            track.on_pause(kill=True)
+            if track.track_id < (session.expected_video_tracks or 0):
+                track.bsf = INBAND_BSF.get(session.codecs[track.track_id])
+        up = target > self.current
+        self.current = target
+        self.switched = self.calm_since = monotonic()
+        if up: self.last_up = self.switched
+        Metrics().inc("rendition_switches_total", direction="up" if up else "down")
+        session.content_source = self.ladder[target].path
+        session.play_offset, session.play_start_time = start, monotonic()
+        when_stopped(tracks, spawn_tracks, tracks, start, session.play_end)
+
+    def reset(self):
+        """PAUSE ends a pending switch along with the relays"""
+        with self.lock:
+            self.pending = None
@@ -0,0 +1,89 @@
+import socket
+import asyncio
+import threading
+import unittest
+from async_server import AsyncioBackend, LoopConn
+
+FRAMES = 200
+FRAME_SIZE = 1400
+
+
+def frame(i):
+    """$-framed interleaved packet whose payload identifies it"""
+    payload = bytes([i & 0xFF]) * (FRAME_SIZE - 4)
+    return b"$" + bytes([i % 4]) + len(payload).to_bytes(2, "big") + payload
+
+
+class SlowClientTest(unittest.TestCase):
+    """Relays reuse one receive buffer for every packet, so whatever the transport queues has to be a copy"""
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.backend = AsyncioBackend(self.loop)
+            started.set()
+            self.loop.run_forever()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.client = socket.create_connection(listener.getsockname())
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        server, _ = listener.accept()
+        listener.close()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+        async def connect():
+            transport, _ = await self.loop.connect_accepted_socket(asyncio.Protocol, server)
+            return transport
+        self.transport = asyncio.run_coroutine_threadsafe(connect(), self.loop).result(5)
+        self.conn = LoopConn(self.backend, self.transport)
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.client.close()
+
+    def relay(self, send):
+        """Sends every frame from one reused buffer on the loop, while the client isn't reading"""
+        done = threading.Event()
+        buf = bytearray(FRAME_SIZE)
+
+        def run():
+            for i in range(FRAMES):
+                buf[:] = frame(i)
+                send(memoryview(buf))
+            done.set()
+        self.loop.call_soon_threadsafe(run)
+        self.assertTrue(done.wait(5))
+        self.assertGreater(self.transport.get_write_buffer_size(), 0, "the client's socket never filled up")
+
+    def received(self):
+        data = bytearray()
+        self.client.settimeout(5)
+        while len(data) < FRAMES * FRAME_SIZE:
+            chunk = self.client.recv(65536)
+            if not chunk: break
+            data += chunk
+        return data
+
+    def check(self, data):
+        self.assertEqual(len(data), FRAMES * FRAME_SIZE)
+        for i in range(FRAMES):
+            self.assertEqual(data[i * FRAME_SIZE:(i + 1) * FRAME_SIZE], frame(i), f"frame {i} corrupted")
+
+    def test_send(self):
+        self.relay(self.conn.send)
+        self.check(self.received())
+
+    def test_sendmsg(self):
+        self.relay(lambda view: self.conn.sendmsg([view[:4], view[4:]]))
+        self.check(self.received())
+
+
+if __name__ == "__main__":
+    unittest.main()
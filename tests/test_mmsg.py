@@ -0,0 +1,50 @@
+import errno
+import socket
+import unittest
+from Utils import mmsg
+
+SIZES = [100] + [1200] * 8  # a packet sendmmsg sends on its own, then a run GSO would take
+
+
+class NoGSOSocket(socket.socket):
+    """Fails GSO sends the way kernels without UDP_SEGMENT support do"""
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        if ancdata: raise OSError(errno.EIO, "UDP GSO not supported")
+        return super().sendmsg(buffers, ancdata, flags, address)
+
+
+@unittest.skipUnless(mmsg.AVAILABLE, "needs recvmmsg/sendmmsg")
+class GSOFallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.gso = mmsg._gso
+        mmsg._gso = True
+        self.source = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.relay.bind(("127.0.0.1", 0))
+        self.sender = NoGSOSocket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(0.5)
+
+    def tearDown(self):
+        mmsg._gso = self.gso
+        for sock in (self.source, self.relay, self.sender, self.client): sock.close()
+
+    def test_each_packet_sent_once(self):
+        for i, size in enumerate(SIZES):
+            self.source.sendto(bytes([i]) * size, self.relay.getsockname())
+        batch = mmsg.Batch()
+        self.assertEqual(batch.recv(self.relay), len(SIZES))
+        batch.sendto(self.sender, self.client.getsockname())
+        self.assertFalse(mmsg._gso)
+
+        received = []
+        try:
+            while True: received.append(self.client.recv(2048))
+        except socket.timeout:
+            pass
+        self.assertEqual([(p[0], len(p)) for p in received], list(enumerate(SIZES)))
+
+
+if __name__ == "__main__":
+    unittest.main()
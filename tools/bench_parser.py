@@ -0,0 +1,106 @@
+"""Request parsing throughput: the old on_bytes loop against Utils.rtsp_parser (and Utils.tunnel for HTTP).
+
+Usage: python3 tools/bench_parser.py [requests] [read size]
+Pipelined requests are fed in read-size chunks, like recv() returns them. The tunnel case
+base64-encodes each request on its own, as clients do. Both sides go as far as the handler needs:
+CSeq, method and Range of every request. Nothing is sent and no handler runs."""
+import os
+import sys
+import time
+import re
+import base64
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Utils.rtsp_parser import RTSPParser
+from Utils.tunnel import TunnelDecoder
+from Utils.utils import parse_range
+
+REQUEST = (
+    "PLAY rtsp://192.168.1.10:8554/vids/movie.mp4/ RTSP/1.0\r\n"
+    "CSeq: {}\r\n"
+    "Session: 1234567890\r\n"
+    "Range: npt=12.500-\r\n"
+    "User-Agent: LibVLC/3.0.20 (LIVE555 Streaming Media v2016.11.28)\r\n"
+    "\r\n"
+)
+
+
+class OldLoop:
+    """The on_bytes loop the parser replaced, kept here for comparison"""
+    def __init__(self):
+        self.buffer = b""
+        self.count = 0
+
+    def on_bytes(self, data):
+        self.buffer += data
+        while True:
+            try: buffer_d = base64.b64decode(self.buffer, validate=False)
+            except: buffer_d = b""
+
+            parse_b64 = False
+            headers_end = self.buffer.find(b"\r\n\r\n")
+            headers_end_d = buffer_d.find(b"\r\n\r\n")
+
+            if headers_end == -1: parse_b64 = True
+            else: headers_end += 4
+            if parse_b64 and headers_end_d == -1: break
+            else: headers_end_d += 4
+
+            if not parse_b64:
+                headers = self.buffer[:headers_end].decode("utf-8", errors="ignore")
+                self.buffer = self.buffer[headers_end:]
+            else:
+                headers = buffer_d[:headers_end_d].decode("utf-8", errors="ignore")
+                self.buffer = b""
+            self.dispatch(headers)
+
+    def dispatch(self, request_text):
+        # what the old handle_rtsp and handle_play pulled out of the text
+        cseq = re.search(r"CSeq:\s*(\d+)", request_text)
+        method = next((m for m in ("OPTIONS", "DESCRIBE", "SETUP", "PLAY", "PAUSE", "TEARDOWN") if m in request_text), None)
+        if method == "PLAY":
+            re.search(r'Range:\s*npt=(\d+(?:\.\d+)?)(?:-(\d+(?:\.\d+)?))?', request_text)
+        self.count += 1
+
+
+def chunks(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def run_old(stream, size):
+    loop = OldLoop()
+    start = time.perf_counter()
+    for chunk in chunks(stream, size): loop.on_bytes(chunk)
+    return time.perf_counter() - start, loop.count
+
+
+def run_new(stream, size, tunnel=False):
+    parser = RTSPParser()
+    decoder = TunnelDecoder() if tunnel else None
+    count = 0
+    start = time.perf_counter()
+    for chunk in chunks(stream, size):
+        if decoder is not None: chunk = decoder.feed(chunk)
+        for request in parser.feed(chunk):
+            request.cseq
+            if request.method == "PLAY": parse_range(request.header("range"), 0)
+            count += 1
+    return time.perf_counter() - start, count
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    plain = b"".join(REQUEST.format(i).encode() for i in range(n))
+    tunnel = b"".join(base64.b64encode(REQUEST.format(i).encode()) for i in range(n))
+
+    print(f"{n} pipelined requests, {size} byte reads")
+    for name, stream, is_tunnel in (("plain", plain, False), ("tunnel", tunnel, True)):
+        old_time, old_count = run_old(stream, size)
+        new_time, new_count = run_new(stream, size, is_tunnel)
+        print(f"{name:<7} old: {n/old_time:>10.0f} req/s ({old_count} parsed)   "
+              f"new: {n/new_time:>10.0f} req/s ({new_count} parsed)   x{old_time/new_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
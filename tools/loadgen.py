@@ -0,0 +1,455 @@
+"""End-to-end load test: N simulated RTSP clients against a local server, on loopback only.
+
+Usage: python3 tools/loadgen.py [--clients N] [--modes udp,tcp,http,multicast] [--duration S]
+                                [--core threads|asyncio] [--workers N] [--port P] [--media FILE] [--out FILE]
+For each mode a fresh server is started with generated test media (ffmpeg lavfi test source, unless --media
+is given), the clients connect, play for --duration seconds and tear down. Reported per mode:
+DESCRIBE latency, SETUP to first RTP latency, packet rate, RFC 3550 interarrival jitter and loss seen by
+the clients, and CPU (server, its workers and ffmpegs), RSS and threads of the server processes (Linux only, reads /proc).
+One JSON object per mode is printed; --out also writes all of them, with the commit, for tracking over releases."""
+import os
+import re
+import sys
+import json
+import time
+import signal
+import base64
+import socket
+import argparse
+import selectors
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ("udp", "tcp", "http", "multicast")
+
+BOOTSTRAP = """
+import os, sys, json
+sys.path.insert(0, os.getcwd())
+from Utils import Config
+Config().all().update(json.loads(sys.argv[1]))
+import logging
+logging.basicConfig(level=Config().get("log_level"))
+import RTSPSession
+RTSPSession.choose_source = lambda request: (sys.argv[2], False)
+if Config().get("workers", 1) > 1:
+    from workers import Supervisor
+    Supervisor(Config().get("workers")).run()
+elif Config().get("server_core") == "asyncio":
+    from async_server import AsyncRTSPServer
+    AsyncRTSPServer()
+else:
+    from main import RTSPServer
+    RTSPServer()
+"""
+
+
+def make_media(path, seconds):
+    """H.264 + AAC test pattern, a keyframe every second"""
+    subprocess.run([
+        "ffmpeg", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25", "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+        "-t", str(seconds), "-c:v", "libx264", "-preset", "ultrafast", "-g", "25", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-ac", "1", path,
+    ], check=True)
+
+
+class TrackStats:
+    """Receive side of one RTP stream: packets, loss from sequence numbers, RFC 3550 interarrival jitter"""
+    def __init__(self, clock_rate):
+        self.clock_rate = clock_rate
+        self.packets = 0
+        self.first_seq = None
+        self.max_seq = None  # extended with wrap-arounds
+        self.transit = None
+        self.jitter = 0.0
+
+    def add(self, packet, arrival):
+        if len(packet) < 12 or packet[0] >> 6 != 2: return
+        seq = int.from_bytes(packet[2:4], "big")
+        ts = int.from_bytes(packet[4:8], "big")
+        self.packets += 1
+        if self.first_seq is None:
+            self.first_seq = self.max_seq = seq
+        else:
+            ext = (self.max_seq & ~0xFFFF) | seq
+            if ext < self.max_seq - 0x8000: ext += 0x10000
+            self.max_seq = max(self.max_seq, ext)
+        transit = arrival * self.clock_rate - ts
+        if self.transit is not None:
+            self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+        self.transit = transit
+
+    def lost(self):
+        if self.first_seq is None: return 0
+        return max(self.max_seq - self.first_seq + 1 - self.packets, 0)
+
+    def jitter_ms(self):
+        return self.jitter / self.clock_rate * 1000 if self.clock_rate else 0.0
+
+
+class Control:
+    """RTSP requests and responses, over one connection or both halves of an HTTP tunnel.
+    Interleaved frames met while waiting for a response are handed to on_frame"""
+    def __init__(self, port, http, on_frame):
+        self.on_frame = on_frame
+        self.buf = b""
+        self.http = http
+        self.rsock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        if http:
+            cookie = os.urandom(8).hex()
+            self.rsock.sendall(f"GET / HTTP/1.1\r\nx-sessioncookie: {cookie}\r\nAccept: application/x-rtsp-tunnelled\r\n\r\n".encode())
+            self.read_headers()
+            self.wsock = socket.create_connection(("127.0.0.1", port), timeout=10)
+            self.wsock.sendall(f"POST / HTTP/1.1\r\nx-sessioncookie: {cookie}\r\nContent-Type: application/x-rtsp-tunnelled\r\n"
+                               f"Content-Length: 32767\r\n\r\n".encode())
+        else:
+            self.wsock = self.rsock
+
+    def request(self, method, url, cseq, headers=()):
+        text = f"{method} {url} RTSP/1.0\r\nCSeq: {cseq}\r\n" + "".join(h + "\r\n" for h in headers) + "\r\n"
+        data = text.encode()
+        self.wsock.sendall(base64.b64encode(data) if self.http else data)
+        head = self.read_headers()
+        if not head.startswith("RTSP/1.0 200"):
+            raise RuntimeError(f"{method}: {head.splitlines()[0]}")
+        length = re.search(r"(?im)^content-length:\s*(\d+)", head)
+        body = self.read_exact(int(length.group(1))) if length else b""
+        return head, body
+
+    def read_headers(self):
+        while True:
+            self.take_frames()
+            end = self.buf.find(b"\r\n\r\n")
+            if end != -1 and not self.buf.startswith(b"$"):
+                head, self.buf = self.buf[:end].decode(errors="replace"), self.buf[end+4:]
+                return head
+            self.fill()
+
+    def read_exact(self, n):
+        while len(self.buf) < n: self.fill()
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def fill(self):
+        data = self.rsock.recv(65536)
+        if not data: raise ConnectionError("closed by server")
+        self.buf += data
+
+    def take_frames(self):
+        now = time.monotonic()
+        while len(self.buf) >= 4 and self.buf[0] == 0x24:
+            length = int.from_bytes(self.buf[2:4], "big")
+            if len(self.buf) < 4 + length: return
+            self.on_frame(self.buf[1], self.buf[4:4+length], now)
+            self.buf = self.buf[4+length:]
+
+    def close(self):
+        for sock in {self.rsock, self.wsock}: sock.close()
+
+
+def parse_sdp(sdp):
+    """Clock rate of each media section, in track order"""
+    rates = []
+    for line in sdp.splitlines():
+        if line.startswith("m="): rates.append(None)
+        m = re.match(r"a=rtpmap:\d+ [^/]+/(\d+)", line)
+        if m and rates and rates[-1] is None: rates[-1] = int(m.group(1))
+    return [rate or 90000 for rate in rates]
+
+
+def bind_pair():
+    """Even/odd UDP port pair for RTP and RTCP"""
+    while True:
+        rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtp.bind(("127.0.0.1", 0))
+        port = rtp.getsockname()[1]
+        if port % 2:
+            rtp.close()
+            continue
+        rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            rtcp.bind(("127.0.0.1", port + 1))
+            return rtp, rtcp
+        except OSError:
+            rtp.close()
+            rtcp.close()
+
+
+class Client(threading.Thread):
+    def __init__(self, port, mode, duration):
+        super().__init__(daemon=True)
+        self.port = port
+        self.mode = mode
+        self.duration = duration
+        self.tracks = []
+        self.socks = []
+        self.receivers = {}  # RTP socket -> track id
+        self.first_rtp = None
+        self.res = {"ok": False}
+
+    def on_packet(self, track_id, packet, arrival):
+        if self.first_rtp is None: self.first_rtp = arrival
+        self.tracks[track_id].add(packet, arrival)
+
+    def on_frame(self, channel, payload, arrival):
+        if channel % 2 == 0 and channel // 2 < len(self.tracks):
+            self.on_packet(channel // 2, payload, arrival)
+
+    def run(self):
+        ctl = None
+        try:
+            path = "/multicast" if self.mode == "multicast" else "/loadgen"
+            url = f"rtsp://127.0.0.1:{self.port}{path}"
+            ctl = Control(self.port, self.mode == "http", self.on_frame)
+            ctl.request("OPTIONS", url, 1)
+            start = time.monotonic()
+            _, sdp = ctl.request("DESCRIBE", url, 2)
+            self.res["describe_ms"] = (time.monotonic() - start) * 1000
+            self.tracks = [TrackStats(rate) for rate in parse_sdp(sdp.decode())]
+
+            session = None
+            setup_start = time.monotonic()
+            for tid in range(len(self.tracks)):
+                headers = [f"Transport: {self.transport(tid)}"] + ([f"Session: {session}"] if session else [])
+                head, _ = ctl.request("SETUP", f"{url}/trackID={tid}", 3 + tid, headers)
+                session = re.search(r"(?im)^session:\s*([^;\r\n]+)", head).group(1).strip()
+                if self.mode == "multicast": self.join_group(head, tid)
+            ctl.request("PLAY", url, 10, [f"Session: {session}", "Range: npt=0-"])
+            self.receive(ctl, time.monotonic() + self.duration)
+            if self.first_rtp is not None:
+                self.res["first_rtp_ms"] = (self.first_rtp - setup_start) * 1000
+            try: ctl.wsock.sendall(self.encode(ctl, f"TEARDOWN {url} RTSP/1.0\r\nCSeq: 11\r\nSession: {session}\r\n\r\n"))
+            except OSError: pass
+            self.res["ok"] = self.first_rtp is not None
+            if not self.res["ok"]: self.res["error"] = "no RTP received"
+        except Exception as e:
+            self.res["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            self.res["packets"] = sum(t.packets for t in self.tracks)
+            self.res["lost"] = sum(t.lost() for t in self.tracks)
+            self.res["jitter_ms"] = [round(t.jitter_ms(), 3) for t in self.tracks if t.packets > 1]
+            time.sleep(0.1)
+            if ctl is not None: ctl.close()
+            for sock in self.socks: sock.close()
+
+    @staticmethod
+    def encode(ctl, text):
+        return base64.b64encode(text.encode()) if ctl.http else text.encode()
+
+    def transport(self, tid):
+        if self.mode in ("tcp", "http"):
+            return f"RTP/AVP/TCP;unicast;interleaved={2*tid}-{2*tid+1}"
+        if self.mode == "multicast":
+            return "RTP/AVP;multicast"
+        rtp, rtcp = bind_pair()
+        self.socks += [rtp, rtcp]
+        self.receivers[rtp] = tid
+        port = rtp.getsockname()[1]
+        return f"RTP/AVP;unicast;client_port={port}-{port+1}"
+
+    def join_group(self, head, tid):
+        """Receive the group the SETUP response points to, on the loopback interface"""
+        group = re.search(r"destination=([\d.]+)", head).group(1)
+        port = int(re.search(r";port=(\d+)", head).group(1))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton("127.0.0.1"))
+        self.socks.append(sock)
+        self.receivers[sock] = tid
+
+    def receive(self, ctl, deadline):
+        if self.mode in ("tcp", "http"):
+            ctl.rsock.settimeout(0.2)
+            while time.monotonic() < deadline:
+                try: ctl.fill()
+                except socket.timeout: continue
+                ctl.take_frames()
+            return
+        sel = selectors.DefaultSelector()
+        for sock, tid in self.receivers.items(): sel.register(sock, selectors.EVENT_READ, tid)
+        while time.monotonic() < deadline:
+            for key, _ in sel.select(0.2):
+                packet = key.fileobj.recv(65536)
+                self.on_packet(key.data, packet, time.monotonic())
+        sel.close()
+
+
+class ServerSampler(threading.Thread):
+    """Polls the server process: CPU of it, its workers and their ffmpegs, peak RSS, threads and ffmpeg count"""
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.running = True
+        self.peak = {"rss_kb": 0, "threads": 0, "ffmpeg": 0}
+
+    def cpu(self):
+        """CPU seconds of the server and everything it started, running or reaped"""
+        ticks = os.sysconf("SC_CLK_TCK")
+        total = 0
+        for pid, _ in [(self.pid, "")] + self.descendants():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            total += sum(int(field) for field in fields[11:15])  # utime, stime, cutime, cstime
+        return total / ticks
+
+    def descendants(self):
+        """(pid, command) of the server's workers and ffmpegs"""
+        parents = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit(): continue
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    comm, rest = f.read().split("(", 1)[1].rsplit(")", 1)
+                parents[int(name)] = (int(rest.split()[1]), comm)
+            except (OSError, ValueError):
+                pass
+        res, pids = [], {self.pid}
+        while True:
+            found = [(pid, comm) for pid, (ppid, comm) in parents.items() if ppid in pids and pid not in pids]
+            if not found: return res
+            res += found
+            pids.update(pid for pid, _ in found)
+
+    def run(self):
+        while self.running:
+            procs = [(self.pid, "")] + self.descendants()
+            rss = threads = 0
+            for pid, comm in procs:
+                if comm == "ffmpeg": continue
+                try:
+                    with open(f"/proc/{pid}/status") as f:
+                        status = dict(line.split(":", 1) for line in f)
+                except OSError:
+                    continue
+                rss += int(status["VmRSS"].split()[0])
+                threads += int(status["Threads"])
+            if not rss: break
+            self.peak["rss_kb"] = max(self.peak["rss_kb"], rss)
+            self.peak["threads"] = max(self.peak["threads"], threads)
+            self.peak["ffmpeg"] = max(self.peak["ffmpeg"], sum(1 for _, comm in procs if comm == "ffmpeg"))
+            time.sleep(0.5)
+
+
+def percentiles(values):
+    if not values: return None
+    values = sorted(values)
+    pick = lambda q: round(values[min(int(q * len(values)), len(values) - 1)], 2)
+    return {"p50": pick(0.5), "p95": pick(0.95), "max": round(values[-1], 2)}
+
+
+def wait_for_port(port, proc):
+    for _ in range(100):
+        if proc.poll() is not None: raise RuntimeError("server exited on startup")
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise RuntimeError("server didn't start")
+
+
+def wait_for_release(port):
+    """Until nothing accepts on port; worker processes of the last server may still be exiting"""
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            time.sleep(0.1)
+        except ConnectionRefusedError:
+            return
+
+
+def run_mode(mode, args, media):
+    overrides = {"server_core": args.core, "main_port": args.port, "log_level": 40, "session_timeout": 600,
+                 "max_connections": max(2 * args.clients, 10), "multicast_interface": "127.0.0.1",
+                 "workers": args.workers}
+    # own process group, so the ffmpegs go down with the server
+    proc = subprocess.Popen([sys.executable, "-c", BOOTSTRAP, json.dumps(overrides), media], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, start_new_session=True)
+    sampler = ServerSampler(proc.pid)
+    try:
+        wait_for_port(args.port, proc)
+        sampler.start()
+        cpu_start, wall_start = sampler.cpu(), time.monotonic()
+        clients = [Client(args.port, mode, args.duration) for _ in range(args.clients)]
+        for client in clients:
+            client.start()
+            time.sleep(args.ramp)
+        for client in clients: client.join(args.duration + 30)
+        cpu = sampler.cpu() - cpu_start
+        wall = time.monotonic() - wall_start
+    finally:
+        sampler.running = False
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        wait_for_release(args.port)
+
+    results = [client.res for client in clients]
+    ok = [r for r in results if r["ok"]]
+    packets = sum(r["packets"] for r in results)
+    lost = sum(r["lost"] for r in results)
+    jitter = [j for r in ok for j in r["jitter_ms"]]
+    errors = {}
+    for r in results:
+        if "error" in r: errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "mode": mode, "core": args.core, "workers": args.workers, "clients": args.clients, "ok": len(ok), "duration_s": args.duration,
+        "describe_ms": percentiles([r["describe_ms"] for r in results if "describe_ms" in r]),
+        "first_rtp_ms": percentiles([r["first_rtp_ms"] for r in ok if "first_rtp_ms" in r]),
+        "packets_per_s": round(packets / args.duration, 1),
+        "loss_pct": round(100 * lost / (packets + lost), 3) if packets + lost else None,
+        "jitter_ms": percentiles(jitter),
+        "server_cpu_pct": round(100 * cpu / wall, 1),
+        "server_rss_peak_kb": sampler.peak["rss_kb"],
+        "server_threads_peak": sampler.peak["threads"],
+        "ffmpeg_peak": sampler.peak["ffmpeg"],
+        "errors": errors,
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end RTSP load test on loopback")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated: " + ", ".join(MODES))
+    parser.add_argument("--duration", type=float, default=10, help="seconds each client plays")
+    parser.add_argument("--ramp", type=float, default=0.02, help="seconds between client starts")
+    parser.add_argument("--core", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--port", type=int, default=18554)
+    parser.add_argument("--media", help="file to serve instead of generated test media")
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    for mode in modes:
+        if mode not in MODES: parser.error(f"unknown mode {mode}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        media = args.media
+        if media is None:
+            media = os.path.join(tmp, "loadgen.mp4")
+            make_media(media, int(args.duration + args.clients * args.ramp) + 10)
+        results = []
+        for mode in modes:
+            res = run_mode(mode, args, os.path.abspath(media))
+            print(json.dumps(res))
+            results.append(res)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"commit": commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
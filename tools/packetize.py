@@ -0,0 +1,36 @@
+"""Packetizes titles into the VoD packet store ahead of time, so their first PLAY doesn't need ffmpeg.
+
+Usage: python3 tools/packetize.py <file or directory>...
+Directories are walked recursively. Titles that already have an up-to-date store are skipped.
+Run from the server directory, so config.yaml (vod_store_dir, vod_store_readrate) is picked up."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vod_store import VodStore, store_path
+
+
+def titles(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files): yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    for path in titles(sys.argv[1:]):
+        if os.path.isfile(os.path.join(store_path(path), "meta.json")):
+            print(f"up to date  {path}")
+            continue
+        VodStore().packetize(path)
+        done = os.path.isfile(os.path.join(store_path(path), "meta.json"))
+        print(f"{'packetized' if done else 'FAILED':<11} {path}")
+
+
+if __name__ == "__main__":
+    main()
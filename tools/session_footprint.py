@@ -0,0 +1,81 @@
+"""Compares server threads and memory with N idle RTSP sessions for each server core.
+
+Usage: python3 tools/session_footprint.py [sessions] [port]
+Each client connects, sends OPTIONS and keeps the connection open. No media is involved, so
+the numbers show the per-session cost of the server core itself (Linux only, reads /proc)."""
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOOTSTRAP = """
+import os, sys, json
+sys.path.insert(0, os.getcwd())
+from Utils import Config
+Config().all().update(json.loads(sys.argv[1]))
+if Config().get("server_core") == "asyncio":
+    from async_server import AsyncRTSPServer
+    AsyncRTSPServer()
+else:
+    from main import RTSPServer
+    RTSPServer()
+"""
+
+
+def proc_status(pid):
+    res = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ("Threads", "VmRSS"):
+                res[key] = int(value.split()[0])
+    return res
+
+def open_sessions(port, count):
+    conns = []
+    for i in range(count):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(f"OPTIONS rtsp://127.0.0.1:{port}/ RTSP/1.0\r\nCSeq: 1\r\n\r\n".encode())
+        conns.append(s)
+    for s in conns:
+        s.settimeout(10)
+        if not s.recv(1024).startswith(b"RTSP/1.0 200"):
+            raise RuntimeError("unexpected OPTIONS response")
+    return conns
+
+def measure(core, count, port):
+    overrides = {"server_core": core, "main_port": port, "max_connections": count, "log_level": 40, "session_timeout": 600}
+    proc = subprocess.Popen([sys.executable, "-c", BOOTSTRAP, json.dumps(overrides)], cwd=ROOT, stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        time.sleep(0.5)
+        idle = proc_status(proc.pid)
+        conns = open_sessions(port, count)
+        time.sleep(1)
+        loaded = proc_status(proc.pid)
+        for s in conns: s.close()
+        return {
+            "core": core, "sessions": count,
+            "threads_idle": idle["Threads"], "threads": loaded["Threads"],
+            "rss_idle_kb": idle["VmRSS"], "rss_kb": loaded["VmRSS"],
+            "rss_per_session_kb": round((loaded["VmRSS"] - idle["VmRSS"]) / count, 1),
+        }
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 18554
+    for core in ("threads", "asyncio"):
+        print(json.dumps(measure(core, count, port)))
@@ -1,28 +1,169 @@
 import socket
+import struct
 import logging
-import subprocess
+import threading
+from time import monotonic
 from random import randint
-from threading import Thread
 from Utils import Config
+from Utils.backend import get_backend
+from Utils.relay_engine import recv_buffer, use_batched_io
+from Utils.mmsg import recv_batch
+from Utils.keyframes import keyframe_before
+from Utils.ports import PortAllocator
+from Utils.metrics import Metrics
+from live_hub import LiveHub
+from vod_store import VodStore, VodPacer, play_from_store
+
+anchor_lock = threading.Lock()  # for the live_epoch of sessions; see Track.anchor
+
+def input_args(track, start_time=0, end_time=None):
+    """ffmpeg options up to and including the input, shared by every track of a session"""
+    return [
+        "ffmpeg", "-loglevel", "error",
+        "-ss", str(start_time), *(["-to", str(end_time)] if end_time is not None else []),
+        *(["-stream_loop", "-1"] if track.stream_loop else []), "-re",
+        "-i", track.session.content_source,
+    ]
+
+def seek_point(session, start_time):
+    """Where playback of a VoD title requested at start_time really starts: the keyframe at or before it.
+    Starting there lets the client decode the first frame it gets, and RTP-Info/Range can report the real position"""
+    if session.live_mode or start_time <= 0:
+        return start_time
+    store = VodStore().get(session.content_source)
+    if store is not None:
+        return store.seek_time(start_time)
+    return keyframe_before(session.content_source, start_time)
+
+def play_tracks(tracks, start_time=0, end_time=None):
+    """Start playback of a session's tracks. Packetized VoD titles are sent straight from the packet store,
+    tracks with a warm ffmpeg from SETUP just release what it has buffered, the rest start ffmpeg now"""
+    own = []
+    # video tracks subscribe first, so the others know to wait for the keyframe they start with; see Track.anchor
+    tracks = sorted(tracks, key=lambda track: track.track_id)
+    if tracks: tracks[0].session.live_epoch = None
+    for track in tracks:
+        if track.is_shared():
+            track.watch_first_packet()
+            track.on_play(start_time, end_time)
+        else: own.append(track)
+    if not own: return
+    session = own[0].session
+    if all(track.held is not None for track in own):
+        if end_time is None and all(track.warm_start == start_time and not track.warm_expired for track in own):
+            session.play_mode = "warm"
+            for track in own: track.release()
+            return
+        # the warm ffmpeg started at the wrong position or has run too far ahead; its output is of no use
+        for track in own: track.on_pause(kill=True)
+    for track in own: track.watch_first_packet()
+    if not session.live_mode:
+        store = VodStore().get(session.content_source)
+        if store is not None and all(track.track_id < len(store.tracks) for track in own):
+            session.play_mode = "store"
+            play_from_store(store, own, start_time, end_time)
+            return
+    session.play_mode = "cold"
+    when_stopped(own, spawn_tracks, own, start_time, end_time)
+
+def warm_start(tracks, start_time=0):
+    """Start ffmpeg for a VoD session at SETUP, holding its packets until PLAY releases them.
+    ffmpeg has then opened the input and produced the first frames by the time the client asks to play"""
+    tracks = list(tracks)
+    session = tracks[0].session
+    if session.live_mode or session.transport_mode == "udp_m" or VodStore().get(session.content_source) is not None:
+        return
+    for track in tracks: track.hold(start_time)
+    when_stopped(tracks, spawn_tracks, tracks, start_time)
+    logging.debug(f"Session {session.session_id}: warm ffmpeg started at {start_time}")
+
+def spawn_tracks(tracks, start_time=0, end_time=None):
+    """Bind the relays and start ffmpeg. With single_ffmpeg_per_session one ffmpeg reads and demuxes the input
+    once and has an RTP output per track, so tracks share one pacing clock and start together"""
+    if tracks[0].session.state == 0: return  # torn down while the previous ffmpeg was exiting
+    if len(tracks) < 2 or not Config().get("single_ffmpeg_per_session", True):
+        for track in tracks: track.on_play(start_time, end_time)
+        return
+
+    cmd = input_args(tracks[0], start_time, end_time)
+    for track in tracks:
+        track.start_relays()
+        cmd += track.output_args()
+    proc = SharedProcess(get_backend().spawn(cmd))
+    for track in tracks: track.proc = proc
+
+def when_stopped(tracks, func, *args):
+    """Call func(*args) once the previous ffmpeg of every track has exited and released its ports"""
+    remaining = [len(tracks)]
+    lock = threading.Lock()
+    def stopped():
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]: return
+        func(*args)
+    for track in tracks: track.when_stopped(stopped)
+
+
+class SharedProcess:
+    """One ffmpeg feeding several tracks. The first track to stop it stops it for all;
+    every track's then() callback runs once the process has exited"""
+    def __init__(self, proc):
+        self.proc = proc
+        self.stopping = False
+        self.exited = False
+        self.waiting = []
+
+    def stop(self, then=None, kill=False):
+        if then is not None: self.waiting.append(then)
+        if self.exited:
+            self.on_exit()
+            return
+        if self.stopping: return
+        self.stopping = True
+        get_backend().stop_process(self.proc, self.on_exit, kill)
+
+    def on_exit(self):
+        self.exited = True
+        waiting, self.waiting = self.waiting, []
+        for then in waiting: then()
+
 
 class Track:
     def __init__(self, parent, tid, ssrc):
         self.session = parent
         self.track_id = tid
-        self.ffmpeg_from_port = Config().get_free_port("relay")
-        Config().port_set_used(self.ffmpeg_from_port)
+        self.ffmpeg_from_port = PortAllocator().allocate("relay", parent.session_id)
         self.ssrc = ssrc
 
         self.ffmpeg_target_port = None
         self.selector = None  # list of ffmpeg options to select the correct track and payload type; provided separately before PLAY
         self.on_data = self.session.transport.on_traffic
+        self.on_batch = self.session.transport.on_batch
         self.stream_loop = (self.session.live_mode == 1) and Config().get("stream_loop")
 
         self.ts_offset = None
         self.clock_rate = 0
         self.proc = None
-        self.relays = [None, None]
-        self.relay_socks = []
+        self.relay_socks = {}  # relay_id -> socket ffmpeg sends to
+        self.live_source = None  # set while subscribed to a shared live source
+        self.paced = None  # set while played from a VoD packet store
+        self.packets = 0  # RTP sent to the client, for metrics
+        self.octets = 0
+        self.bsf = None  # bitstream filter putting parameter sets in-band, once renditions are switched
+        self.cut_ts = None  # see cut_at
+        self.cut_seq = None
+        self.cut_then = None
+        self.cut_armed = False
+
+        # warm start: packets of an ffmpeg started at SETUP are held here until PLAY
+        self.held = None
+        self.hold_lock = threading.Lock()
+        self.hold_seq = None
+        self.hold_since = None
+        self.warm_start = None
+        self.warm_expired = False
+        self.exiting = None  # callbacks waiting for the previous ffmpeg to exit; None when none is stopping
+        self.exit_lock = threading.Lock()
 
         if Config().get("seq_start_at_one"): self.last_seq = 0
         else: self.last_seq = randint(0, 65534)
@@ -34,108 +175,307 @@ class Track:
 
     def get_rtpinfo(self, zero_rtptime):
         if not zero_rtptime:
-            rtptime = int(self.session.play_offset*self.clock_rate) + self.initial_ts_offset
+            rtptime = round(self.session.play_offset*self.clock_rate) + self.initial_ts_offset
         else:
             rtptime = 0
-        return f"url={self.session.url}/trackID={self.track_id};seq={self.last_seq+1};rtptime={rtptime}"
+        seq = self.hold_seq if self.held is not None else self.last_seq
+        return f"url={self.session.url}/trackID={self.track_id};seq={seq+1};rtptime={rtptime}"
+
+    def is_shared(self):
+        """Live unicast tracks get their packets from a shared LiveSource instead of their own ffmpeg"""
+        return bool(self.session.live_mode) and self.session.transport_mode != "udp_m" and Config().get("share_live_sources", True)
 
     def on_play(self, start_time=0, end_time=None):
-        cmd = [
-            "ffmpeg", "-loglevel", "error",
-            "-ss", str(start_time), *(["-to", str(end_time)] if end_time is not None else []),
-            *(["-stream_loop", "-1"] if self.stream_loop else []), "-re",
-            "-i", self.session.content_source,
+        if self.is_shared():
+            self.ts_offset = 0 if Config().get("random_ts") else None
+            self.live_source = LiveHub().subscribe(self)
+            return
+
+        self.start_relays()
+        self.proc = get_backend().spawn(input_args(self, start_time, end_time) + self.output_args())
+
+    def output_args(self):
+        """ffmpeg output options for this track; they go after the input, so several tracks can share one ffmpeg"""
+        return [
             "-ssrc", str(self.ssrc), "-seq", str(self.last_seq+1),
-            *self.selector, "-f", "rtp",
+            *self.selector, *(["-bsf:v", self.bsf] if self.bsf else []), "-f", "rtp",
             f"rtp://127.0.0.1:{self.ffmpeg_target_port}/?localport={self.ffmpeg_from_port}"
         ]  # ffmpeg uses self.server_ports[0]+1 for RTCP by default
-        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
 
-        self.relays[0] = Thread(target=self.patch_rtp, args=(self.ffmpeg_target_port,))
-        self.relays[0].start()
-        if not Config().get("disable_rtcp"):
-            self.relays[1] = Thread(target=self.patch_outgoing_rtcp, args=(self.ffmpeg_target_port + 1,))
-            self.relays[1].start()
+    def start_relays(self):
+        # start relays before ffmpeg, so its first packets aren't lost
+        callbacks = {0: self.patch_rtp_batch if use_batched_io() else self.patch_rtp}
+        if not Config().get("disable_rtcp"): callbacks[1] = self.patch_outgoing_rtcp
+        for relay_id, callback in callbacks.items():
+            self.start_relay(relay_id, callback)
+
+    def start_relay(self, relay_id, callback):
+        """Relay sockets are bound on the first PLAY and kept until teardown"""
+        udp_socket = self.relay_socks.get(relay_id)
+        if udp_socket is None or udp_socket.fileno() == -1:  # closed by the relay loop after an error
+            from_port = self.ffmpeg_target_port + relay_id
+            try:
+                udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                udp_socket.bind(("127.0.0.1", from_port))
+            except OSError:
+                logging.error(f"Port {from_port} is already in use; not relaying(session {self.session.session_id}, track {self.track_id})")
+                return
+            self.relay_socks[relay_id] = udp_socket
+        else:
+            # drop what the previous ffmpeg sent after PAUSE; it has exited by now
+            try:
+                while udp_socket.recv(65536, socket.MSG_DONTWAIT): pass
+            except BlockingIOError:
+                pass
+        get_backend().add_reader(udp_socket, callback)
+
+    def hold(self, start_time):
+        """Keep packets from now on instead of sending them, until release()"""
+        self.held = []
+        self.hold_seq = self.last_seq
+        self.hold_since = monotonic()
+        self.warm_start = start_time
+        self.warm_expired = False
+        self.on_data, self.on_batch = self.hold_packet, self.hold_batch
+
+    def hold_packet(self, data, track_id, relay_id):
+        with self.hold_lock:
+            if self.held is not None:
+                if self.warm_expired: return
+                if monotonic() - self.hold_since > Config().get("warm_start_hold", 10):
+                    # -re runs ffmpeg in realtime; the client would get everything held at once, so give up on it
+                    self.warm_expired = True
+                    self.held = []
+                    return
+                self.held.append((bytes(data), relay_id))
+                return
+        self.on_data(data, track_id, relay_id)
+
+    def hold_batch(self, batch, track_id, relay_id):
+        for packet in batch.packets():
+            self.hold_packet(packet, track_id, relay_id)
+
+    def release(self):
+        """Send everything held since SETUP, then let packets through"""
+        with self.hold_lock:
+            held, self.held = self.held, None
+            self.on_data, self.on_batch = self.first_packet, self.first_batch
+            for data, relay_id in held:
+                self.on_data(data, self.track_id, relay_id)
 
+    def watch_first_packet(self):
+        """Route the next packet through first_packet, so the session can log its time to first packet"""
+        if self.held is not None: return  # release() does it once the hold is over
+        self.on_data, self.on_batch = self.first_packet, self.first_batch
 
-    def on_pause(self):
-        for sock in self.relay_socks:  # seems faster than using Event()
-            sock.close()
-        self.relay_socks = []
+    def first_packet(self, data, track_id, relay_id):
+        self.on_data, self.on_batch = self.session.transport.on_traffic, self.session.transport.on_batch
+        self.session.on_first_packet()
+        self.on_data(data, track_id, relay_id)
+
+    def first_batch(self, batch, track_id, relay_id):
+        self.on_data, self.on_batch = self.session.transport.on_traffic, self.session.transport.on_batch
+        self.session.on_first_packet()
+        self.on_batch(batch, track_id, relay_id)
+
+    def cut_at(self, cut_ts, then):
+        """Stop sending at the first RTP packet timestamped cut_ts (session timeline) or later, until on_pause.
+        then(track, True) runs in the relay once it's reached; then(track, False) if the first packet seen is past it
+        already, and sending goes on. Used to switch renditions at a keyframe"""
+        self.cut_ts, self.cut_seq, self.cut_then, self.cut_armed = cut_ts, None, then, False
+        self.on_data, self.on_batch = self.cut_packet, self.cut_batch
+
+    def uncut(self):
+        self.on_data, self.on_batch = self.session.transport.on_traffic, self.session.transport.on_batch
+        self.cut_ts = self.cut_seq = self.cut_then = None
+
+    def at_cut(self, seq, ts):
+        """Whether the packet is the first one at or past the cut"""
+        if (ts - self.cut_ts) & 0xFFFFFFFF >= 0x80000000:
+            self.cut_armed = True
+            return False
+        then = self.cut_then
+        if not self.cut_armed:
+            self.uncut()
+            then(self, False)
+            return False
+        self.cut_seq = (seq - 1) & 0xFFFF  # the next ffmpeg continues right after the last packet sent
+        then(self, True)
+        return True
+
+    def cut_packet(self, data, track_id, relay_id):
+        if self.cut_seq is None and self.cut_ts is not None and relay_id == 0:
+            self.at_cut(*struct.unpack_from("!HI", data, 2))
+        if self.cut_seq is None: self.session.transport.on_traffic(data, track_id, relay_id)
+        else: self.last_seq = self.cut_seq
+
+    def cut_batch(self, batch, track_id, relay_id):
+        if self.cut_seq is None:
+            seqs, ts = batch.field(2, "H"), batch.field(4, "I")
+            count = batch.count
+            for i in range(batch.first, count):
+                if self.cut_ts is None: break  # missed, see at_cut
+                if self.at_cut(int(seqs[i]), int(ts[i])):
+                    batch.count = i
+                    break
+            if batch.count > batch.first: self.session.transport.on_batch(batch, track_id, relay_id)
+            batch.count = count
+        if self.cut_seq is not None: self.last_seq = self.cut_seq
+
+    def when_stopped(self, func):
+        """Call func now, or once the ffmpeg being stopped by on_pause has exited"""
+        with self.exit_lock:
+            if self.exiting is not None:
+                self.exiting.append(func)
+                return
+        func()
+
+    def on_pause(self, then=None, kill=False, close=False):
+        """Stop sending. Relay sockets are kept for the next PLAY unless close; then() runs once ffmpeg has exited"""
+        if self.held is not None:
+            # a warm ffmpeg that is thrown away; the next one continues from the seq reported before
+            with self.hold_lock:
+                self.held = None
+                self.last_seq = self.hold_seq
+        if self.cut_ts is None:  # a cut keeps dropping until the relays are stopped below
+            self.on_data, self.on_batch = self.session.transport.on_traffic, self.session.transport.on_batch
+        if self.live_source is not None:
+            LiveHub().unsubscribe(self, self.live_source)
+            self.live_source = None
+        if self.paced is not None:
+            VodPacer().remove(self.paced)
+            self.paced = None
+        for sock in self.relay_socks.values():
+            get_backend().remove_reader(sock, close)
+        if close: self.relay_socks = {}
+        if self.cut_ts is not None: self.uncut()
         self.ts_offset = None
-        if self.proc is not None:
-            try:
-                self.proc.terminate()
-                self.proc.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                self.proc.kill()
-        self.proc = None
+        proc, self.proc = self.proc, None
+        if proc is None:
+            if then is not None: then()
+            return
+        with self.exit_lock:
+            if self.exiting is None: self.exiting = []
+        def exited():
+            if then is not None: then()
+            with self.exit_lock:
+                waiting, self.exiting = self.exiting, None
+            for func in waiting or (): func()
+        if isinstance(proc, SharedProcess): proc.stop(exited, kill)
+        else: get_backend().stop_process(proc, exited, kill)
 
     def teardown(self):
-        self.on_pause()
-        Config().port_set_free(self.ffmpeg_from_port)
-        Config().port_set_free(self.ffmpeg_target_port)
-
-
-    def patch_rtp(self, from_port):
-        """Change timestamps in RTP packets, record seq and send to transport class"""
-        try:
-            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            udp_socket.settimeout(1)
-            udp_socket.bind(("127.0.0.1", from_port))
-            self.relay_socks.append(udp_socket)
-        except OSError:
-            logging.error(f"Port {from_port} is already in use; not relaying(session {self.session.session_id}, track {self.track_id})")
-            return
-        try:
-            while True:
-                try: data, _ = udp_socket.recvfrom(65536)
-                except socket.timeout: continue
-                seq = int.from_bytes(data[2:4], "big")
-                self.last_seq = seq
-                ts = int.from_bytes(data[4:8], "big")
-
-                if self.ts_offset is None:
-                    if ts == 0: continue  # may get 0 once after resuming playback
-                    self.ts_offset = int(self.clock_rate*self.session.play_offset) - ts + self.initial_ts_offset
-
-                new_ts = ts + self.ts_offset
-                if new_ts > 0xFFFFFFFF or new_ts < 0:
-                    new_ts = (ts + self.ts_offset) & 0xFFFFFFFF
-                    self.ts_offset = (new_ts - ts) & 0xFFFFFFFF
-                new_ts_bytes = new_ts.to_bytes(4, "big")
-                data = data[:4] + new_ts_bytes + data[8:]
-
-                self.on_data(data, self.track_id, 0)
-        except Exception as e:
-            logging.error(f"Track stopped: {e}")
-            udp_socket.close()
-
-    def patch_outgoing_rtcp(self, from_port):
+        # ports go back to the pool only after ffmpeg has released them
+        self.on_pause(then=self.free_ports, close=True)
+        Metrics().inc("relayed_packets_total", self.packets)
+        Metrics().inc("relayed_bytes_total", self.octets)
+
+    def free_ports(self):
+        PortAllocator().release(self.ffmpeg_from_port)
+        PortAllocator().release(self.ffmpeg_target_port)
+
+
+    def map_ts(self, ts):
+        """Translate source RTP timestamp to the session timeline; None means the packet should be skipped"""
+        if self.ts_offset is None:
+            if ts == 0: return None  # may get 0 once after resuming playback
+            if self.is_shared():
+                if not self.anchor(ts, monotonic()): return None
+            else: self.ts_offset = round(self.clock_rate*self.session.play_offset) - ts + self.initial_ts_offset
+
+        new_ts = ts + self.ts_offset
+        if new_ts > 0xFFFFFFFF or new_ts < 0:
+            new_ts = (ts + self.ts_offset) & 0xFFFFFFFF
+            self.ts_offset = (new_ts - ts) & 0xFFFFFFFF
+        return new_ts
+
+    def anchor(self, ts, at, keyframe=False):
+        """Set ts_offset of a shared live track from a packet received at monotonic time at. Each track of a session
+        has its own source, so they are lined up by wallclock: the first one maps its packet to the rtptime the PLAY
+        response reported and the others add the time since. A video track joining with a cached GOP starts at its
+        keyframe, from before the others joined, so they wait for it. False means the packet should be skipped"""
+        session = self.session
+        with anchor_lock:
+            if session.live_epoch is None:
+                if not keyframe and any(t.live_source is not None and t in t.live_source.joining
+                                        for t in session.tracks.values()):
+                    return False
+                session.live_epoch = at
+            elapsed = session.play_offset + at - session.live_epoch
+            self.ts_offset = round(self.clock_rate*elapsed) - ts + self.initial_ts_offset
+        return True
+
+    def on_shared_packet(self, buf, data, relay_id, src_ts):
+        """Rewrite SSRC, seq and timestamp of a packet from a shared live source for this session.
+        buf is the source's receive buffer; headers are rewritten in place for each subscriber in turn"""
+        if relay_id == 0:
+            new_ts = self.map_ts(src_ts)
+            if new_ts is None: return
+            self.last_seq = (self.last_seq + 1) & 0xFFFF
+            struct.pack_into("!HII", buf, 2, self.last_seq, new_ts, self.ssrc)
+            self.packets += 1
+            self.octets += len(data)
+        elif buf[1] == 200:
+            if self.ts_offset is None: return
+            struct.pack_into("!I", buf, 4, self.ssrc)
+            struct.pack_into("!I", buf, 16, (src_ts + self.ts_offset) & 0xFFFFFFFF)
+        self.on_data(data, self.track_id, relay_id)
+
+    def patch_rtp(self, sock):
+        """Change timestamps in RTP packets, record seq and send to transport class.
+        The packet is received into a reused buffer and patched in place"""
+        buf, view = recv_buffer()
+        n = sock.recv_into(buf)
+        self.last_seq, ts = struct.unpack_from("!HI", buf, 2)
+
+        new_ts = self.map_ts(ts)
+        if new_ts is None: return
+        struct.pack_into("!I", buf, 4, new_ts)
+        self.packets += 1
+        self.octets += n
+
+        self.on_data(view[:n], self.track_id, 0)
+
+    def patch_rtp_batch(self, sock):
+        """patch_rtp for a whole burst: one recvmmsg, vectorized timestamp rewrite, batched send"""
+        batch = recv_batch(sock)
+        src_ts = batch.timestamps()
+        if not self.skip_to_first_ts(batch, src_ts): return
+        self.last_seq = batch.last_seq()
+        batch.rewrite(src_ts, self.ts_offset)
+        self.count_batch(batch)
+        self.on_batch(batch, self.track_id, 0)
+
+    def on_shared_batch(self, batch, src_ts):
+        """on_shared_packet for a whole burst; src_ts holds the source timestamps, as the buffer is rewritten per subscriber"""
+        batch.first = 0
+        if not self.skip_to_first_ts(batch, src_ts): return
+        first_seq = (self.last_seq + 1) & 0xFFFF
+        self.last_seq = (self.last_seq + batch.count - batch.first) & 0xFFFF
+        batch.rewrite(src_ts, self.ts_offset, first_seq, self.ssrc)
+        self.count_batch(batch)
+        self.on_batch(batch, self.track_id, 0)
+
+    def count_batch(self, batch):
+        self.packets += batch.count - batch.first
+        self.octets += sum(batch.lengths[batch.first:batch.count])
+
+    def skip_to_first_ts(self, batch, src_ts):
+        """Set up ts_offset from the first usable packet of a burst, like map_ts does per packet"""
+        while batch.first < batch.count:
+            if self.map_ts(int(src_ts[batch.first])) is not None: return True
+            batch.first += 1
+        return False
+
+    def patch_outgoing_rtcp(self, sock):
         """Change timestamps in RTCP sender report packets and forward to transport class"""
-        try:
-            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            udp_socket.settimeout(1)
-            udp_socket.bind(("127.0.0.1", from_port))
-            self.relay_socks.append(udp_socket)
-        except OSError:
-            logging.error(f"Port {from_port} is already in use; not relaying(session {self.session.session_id}, track {self.track_id})")
-            return
-        try:
-            while True:
-                try: data, _ = udp_socket.recvfrom(65536)
-                except socket.timeout: continue
-
-                if data[1] == 200:
-                    if self.ts_offset is None: continue
-                    ts = int.from_bytes(data[16:20], "big")
-                    new_ts = ts + self.ts_offset
-                    new_ts_bytes = new_ts.to_bytes(4, "big")
-                    data = data[:16] + new_ts_bytes + data[20:]
-
-                self.on_data(data, self.track_id, 1)
-        except Exception as e:
-            logging.error(f"RTCP relay stopped stopped: {e}")
-            udp_socket.close()
\ No newline at end of file
+        buf, view = recv_buffer()
+        n = sock.recv_into(buf)
+
+        if buf[1] == 200:
+            if self.ts_offset is None: return
+            ts = struct.unpack_from("!I", buf, 16)[0]
+            struct.pack_into("!I", buf, 16, (ts + self.ts_offset) & 0xFFFFFFFF)
+
+        self.on_data(view[:n], self.track_id, 1)
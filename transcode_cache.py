@@ -0,0 +1,198 @@
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import threading
+import subprocess
+from time import monotonic
+from collections import OrderedDict
+from configurable import transcode_profiles
+from Utils import Config
+from Utils.metrics import Metrics
+from Utils.probe_cache import ProbeCache
+
+# seconds a client told to come back (503) is asked to wait
+RETRY_AFTER = 30
+
+
+def rendition_name(content_source, profile):
+    """File name of a title transcoded with profile; changes when the file is modified or replaced
+    and when the profile's options change"""
+    st = os.stat(content_source)
+    options = transcode_profiles[profile]
+    key = f"{os.path.realpath(content_source)}:{st.st_mtime_ns}:{st.st_size}:{json.dumps(options, sort_keys=True)}"
+    # no "@": find_renditions would take the name for a bitrate rendition
+    title = os.path.splitext(os.path.basename(content_source))[0].replace("@", "_")
+    return f"{title}.{profile}.{hashlib.sha1(key.encode()).hexdigest()[:16]}{options.get("ext", ".mp4")}"
+
+
+class TranscodeCache:
+    """Titles transcoded with the profiles in configurable.py, kept in transcode_cache_dir up to transcode_cache_mb
+    and evicted least recently used first. Sessions pin the rendition they play so it isn't evicted under them.
+    Concurrent first requests for a rendition share one ffmpeg.
+    Worker processes share the directory: a pin is a shared flock on the file, eviction needs an exclusive one"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance.dir = Config().get("transcode_cache_dir", "transcoded")
+                    instance.max_bytes = Config().get("transcode_cache_mb", 4096) * 1024 * 1024
+                    instance.entries = OrderedDict()  # file name -> size, least recently used first
+                    instance.pins = {}  # file name -> share-locked handles, one per session playing it
+                    instance.jobs = {}  # file name -> Event set once its ffmpeg is done
+                    instance.failed = set()  # not retried until the title or the profile changes
+                    instance.slots = threading.Semaphore(Config().get("transcode_jobs", 2))
+                    instance.lock = threading.Lock()
+                    instance.scan()
+                    cls._instance = instance
+        return cls._instance
+
+    def scan(self):
+        """Picks up renditions made by earlier runs; leftovers of interrupted jobs are removed"""
+        os.makedirs(self.dir, exist_ok=True)
+        for _, name, size in sorted(self.listing()):
+            self.entries[name] = size
+        logging.debug(f"Transcode cache: {len(self.entries)} renditions, {sum(self.entries.values()) // 1048576} MB")
+
+    def listing(self):
+        """(mtime, name, size) of every rendition in the directory"""
+        found = []
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            try:
+                if name.startswith("part."):
+                    # part.<pid>.<name>; kept while that process may still be writing it
+                    try: os.kill(int(name.split(".")[1]), 0)
+                    except (ProcessLookupError, ValueError): os.remove(path)
+                    continue
+                st = os.stat(path)
+            except OSError:
+                continue
+            found.append((st.st_mtime, name, st.st_size))
+        return found
+
+    def refresh(self):
+        """Catches up with renditions other worker processes made or removed; called with the lock held"""
+        found = {name: size for _, name, size in self.listing()}
+        for name in [name for name in self.entries if name not in found]:
+            del self.entries[name]
+        for name, size in found.items():
+            if name not in self.entries:
+                self.entries[name] = size
+                self.entries.move_to_end(name, last=False)  # not known to be in use here
+
+    def acquire(self, content_source, profile, wait=0):
+        """Path of the title's rendition in profile, pinned until release(). The first request starts transcoding;
+        None if it isn't done within wait seconds. If transcoding fails, content_source itself is returned"""
+        name = rendition_name(content_source, profile)
+        path = os.path.join(self.dir, name)
+        with self.lock:
+            if name in self.failed: return content_source
+            if name not in self.entries and name not in self.jobs:
+                if os.path.isfile(path):
+                    self.entries[name] = os.path.getsize(path)  # made by another worker process
+                else:
+                    self.jobs[name] = threading.Event()
+                    threading.Thread(target=self.transcode, args=(content_source, profile, name), daemon=True).start()
+            job = self.jobs.get(name)
+        if job is not None and not job.wait(wait): return None
+        with self.lock:
+            if name not in self.entries: return content_source  # failed
+            handle = self.pin(path)
+            if handle is not None:
+                self.entries.move_to_end(name)
+                self.pins.setdefault(name, []).append(handle)
+            else: del self.entries[name]
+        if handle is None: return self.acquire(content_source, profile, wait)  # another worker process evicted it
+        try: os.utime(path)  # keeps the LRU order across restarts
+        except OSError: pass
+        return path
+
+    def release(self, path):
+        """A session stopped using a rendition from acquire()"""
+        name = os.path.basename(path)
+        with self.lock:
+            if name not in self.pins: return
+            self.pins[name].pop().close()
+            if not self.pins[name]: del self.pins[name]
+            evicted = self.evict()
+        self.remove(evicted)
+
+    @staticmethod
+    def pin(path):
+        """Open, share-locked handle on path; None if the file is gone"""
+        try: handle = open(path, "rb")
+        except OSError: return None
+        fcntl.flock(handle, fcntl.LOCK_SH)
+        if os.fstat(handle.fileno()).st_nlink == 0:  # removed while waiting for the lock
+            handle.close()
+            return None
+        return handle
+
+    def transcode(self, content_source, profile, name):
+        path = os.path.join(self.dir, name)
+        part = os.path.join(self.dir, f"part.{os.getpid()}.{name}")  # same extension, ffmpeg picks the muxer by it
+        # legacy clients take one video and one audio track
+        cmd = ["ffmpeg", "-loglevel", "error", "-y", "-i", content_source, "-map", "0:v:0?", "-map", "0:a:0?",
+               "-map_metadata", "-1", *transcode_profiles[profile]["args"], part]
+        size = None
+        started = monotonic()
+        logging.info(f"Transcoding {content_source} to {profile}")
+        try:
+            with self.slots:
+                proc = subprocess.run(cmd, capture_output=True, text=True)
+            if proc.returncode == 0 and os.path.isfile(part):
+                os.replace(part, path)
+                size = os.path.getsize(path)
+                logging.info(f"Transcoded {content_source} to {profile} in {monotonic() - started:.1f} s, {size // 1024} kB")
+            else:
+                logging.error(f"Transcoding {content_source} to {profile} failed, serving it as is: {proc.stderr.strip()[-500:]}")
+        except OSError as e:
+            logging.error(f"Transcoding {content_source} to {profile} failed, serving it as is: {e}")
+        finally:
+            try: os.remove(part)
+            except OSError: pass
+            with self.lock:
+                if size is None: self.failed.add(name)
+                else: self.entries[name] = size
+                self.refresh()
+                evicted = self.evict(keep=name)
+                self.jobs.pop(name).set()
+            Metrics().inc("transcodes_total", profile=profile, result="failed" if size is None else "ok")
+        self.remove(evicted)
+
+    def evict(self, keep=None):
+        """Drops least recently used renditions nobody plays until the cache fits; call with the lock held.
+        Returns them with an exclusive lock held, so no worker process pins them before they're removed"""
+        total = sum(self.entries.values())
+        evicted = []
+        for name, size in list(self.entries.items()):
+            if total <= self.max_bytes: break
+            if name in self.pins or name == keep: continue
+            try:
+                handle = open(os.path.join(self.dir, name), "rb")
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue  # played through another worker process
+            except OSError:
+                handle = None  # gone already
+            del self.entries[name]
+            total -= size
+            if handle is not None: evicted.append((name, handle))
+        return evicted
+
+    def remove(self, evicted):
+        for name, handle in evicted:
+            path = os.path.join(self.dir, name)
+            try: os.remove(path)
+            except OSError as e: logging.warning(f"Can't remove {path} from the transcode cache: {e}")
+            finally: handle.close()
+            ProbeCache().invalidate(path)
+            Metrics().inc("transcode_cache_evictions_total")
+            logging.debug(f"Evicted {name} from the transcode cache")
@@ -0,0 +1,381 @@
+import os
+import mmap
+import json
+import heapq
+import socket
+import struct
+import hashlib
+import logging
+import selectors
+import threading
+import subprocess
+from array import array
+from bisect import bisect_left, bisect_right
+from time import monotonic
+from Utils import Config
+from Utils.sdp_gen import probe_media
+from Utils.probe_cache import ProbeCache
+from Utils.ports import PortAllocator
+from Utils.metrics import Metrics
+from Utils.utils import track_selector
+from Utils.rtp import encoding_name, is_keyframe_start, sender_report
+
+# One file per track: header, raw RTP packets back to back, then the index
+HEADER = struct.Struct("<8sIIQ")  # magic, clock rate, packet count, index offset
+RECORD = struct.Struct("<QHqB")   # packet offset, length, timestamp relative to the first packet, flags
+MAGIC = b"DRTPSTR1"
+FLAG_KEY = 1
+SR_INTERVAL = 5
+
+
+def store_path(content_source):
+    """Directory of a title's store; changes when the file is modified or replaced"""
+    st = os.stat(content_source)
+    key = f"{os.path.realpath(content_source)}:{st.st_mtime_ns}:{st.st_size}"
+    return os.path.join(Config().get("vod_store_dir", "store"), hashlib.sha1(key.encode()).hexdigest()[:20])
+
+
+class StoreTrack:
+    """Memory-mapped packets and index of one track"""
+    def __init__(self, path, codec):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.clock_rate, count, index_offset = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a packet store")
+        self.codec = codec
+        self.offsets = array("Q")
+        self.lengths = array("H")
+        self.ts = array("q")
+        self.ts_max = array("q")  # running max, so B-frame reordering doesn't break bisect
+        self.key_ts = array("q")  # timestamps of packets that start a keyframe, ascending
+        top = None
+        for off, length, ts, flags in RECORD.iter_unpack(self.mm[index_offset:index_offset + count * RECORD.size]):
+            top = ts if top is None else max(top, ts)
+            if flags & FLAG_KEY: self.key_ts.append(ts)
+            self.offsets.append(off)
+            self.lengths.append(length)
+            self.ts.append(ts)
+            self.ts_max.append(top)
+
+    def index_at(self, seconds):
+        """First packet at or after media time seconds"""
+        return bisect_left(self.ts_max, int(seconds * self.clock_rate))
+
+    def keyframe_before(self, seconds):
+        """Media time of the last keyframe at or before seconds; None if the track has no keyframe markers"""
+        if not self.key_ts:
+            return None
+        i = bisect_right(self.key_ts, round(seconds * self.clock_rate))
+        return self.key_ts[max(i-1, 0)] / self.clock_rate
+
+
+class RTPStore:
+    def __init__(self, path, meta):
+        self.meta = meta
+        self.tracks = [StoreTrack(os.path.join(path, f"{t["id"]}.rtp"), t["codec"]) for t in meta["tracks"]]
+
+    def seek_time(self, seconds):
+        """Where playback really starts for a requested time: the preceding video keyframe"""
+        for track in self.tracks:
+            key = track.keyframe_before(seconds)
+            if key is not None: return key
+        return seconds
+
+
+class Packetizer:
+    """Runs ffmpeg once without -re (faster than realtime, see vod_store_readrate) and writes every track's RTP packets to disk"""
+    def __init__(self, content_source, path):
+        self.content_source = content_source
+        self.path = path
+
+    def run(self):
+        probe = ProbeCache().get(self.content_source, "sdp", probe_media)
+        tmp = f"{self.path}.tmp{os.getpid()}"  # worker processes may packetize the same title at once
+        os.makedirs(tmp, exist_ok=True)
+        socks, writers, ports = [], [], []
+        try:
+            cmd = ["ffmpeg", "-loglevel", "error", "-readrate", str(Config().get("vod_store_readrate", 16)),
+                   "-i", self.content_source]
+            meta_tracks = []
+            for tid, (_, lines, fmt_lines) in enumerate(probe["media"]):
+                codec = encoding_name(list(lines) + list(fmt_lines or []))
+                meta_tracks.append({"id": tid, "codec": codec, "clock_rate": probe["rates"][tid]})
+                rtp, port = self.bind_pair()
+                socks.extend(rtp)
+                ports.append(port)
+                writers.append(TrackWriter(os.path.join(tmp, f"{tid}.rtp"), probe["rates"][tid], codec))
+                cmd += [*track_selector(tid, probe["vtracks"]), "-f", "rtp", f"rtp://127.0.0.1:{port}"]
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+            Metrics().watch_process(proc)
+            self.collect(proc, socks, writers)
+            for w in writers: w.close()
+            if proc.returncode != 0:
+                raise RuntimeError(f"ffmpeg exited with {proc.returncode}")
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"source": self.content_source, "tracks": meta_tracks, "len": probe["len"]}, f)
+            try:
+                os.replace(tmp, self.path)
+            except OSError:
+                if not os.path.isfile(os.path.join(self.path, "meta.json")): raise
+                logging.debug(f"{self.content_source} was packetized by another worker meanwhile")
+                return
+            logging.info(f"Packetized {self.content_source} into {self.path}")
+        finally:
+            for s in socks: s.close()
+            for p in ports: PortAllocator().release(p)
+            for w in writers: w.close()
+            if os.path.isdir(tmp):
+                for name in os.listdir(tmp): os.remove(os.path.join(tmp, name))
+                os.rmdir(tmp)
+
+    @staticmethod
+    def bind_pair():
+        """RTP and RTCP sockets on a free relay port pair; RTCP is read and thrown away"""
+        port = PortAllocator().allocate("relay", "packetizer")
+        socks = []
+        for p in (port, port + 1):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+            s.bind(("127.0.0.1", p))
+            s.setblocking(False)
+            socks.append(s)
+        return socks, port
+
+    @staticmethod
+    def collect(proc, socks, writers):
+        sel = selectors.DefaultSelector()
+        for i, s in enumerate(socks):
+            sel.register(s, selectors.EVENT_READ, writers[i // 2] if i % 2 == 0 else None)
+        idle = 0
+        while idle < 3:
+            events = sel.select(0.2)
+            if not events:
+                # keep draining a little after ffmpeg has exited
+                if proc.poll() is not None: idle += 1
+                continue
+            idle = 0
+            for key, _ in events:
+                try:
+                    while True:
+                        data = key.fileobj.recv(65536)
+                        if key.data is not None: key.data.add(data)
+                except BlockingIOError:
+                    pass
+        sel.close()
+        proc.wait()
+
+
+class TrackWriter:
+    def __init__(self, path, clock_rate, codec):
+        self.f = open(path, "wb")
+        self.f.write(HEADER.pack(MAGIC, clock_rate, 0, 0))
+        self.clock_rate = clock_rate
+        self.codec = codec
+        self.records = []
+        self.first_ts = None
+        self.last_ts = None
+        self.unwrapped = 0
+        self.last_seq = None
+
+    def add(self, data):
+        seq, ts = struct.unpack_from("!HI", data, 2)
+        if self.last_seq is not None and seq != (self.last_seq + 1) & 0xFFFF:
+            raise RuntimeError(f"lost packets while packetizing (seq {self.last_seq} -> {seq}); lower vod_store_readrate")
+        self.last_seq = seq
+        if self.first_ts is None:
+            self.first_ts = self.last_ts = ts
+        # unwrap the 32 bit timestamp relative to the previous packet
+        self.unwrapped += ((ts - self.last_ts + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+        self.last_ts = ts
+        is_video = data[1] & 0x7f == 96
+        flags = FLAG_KEY if (not is_video or is_keyframe_start(self.codec, data)) else 0
+        self.records.append(RECORD.pack(self.f.tell(), len(data), self.unwrapped, flags))
+        self.f.write(data)
+
+    def close(self):
+        if self.f.closed: return
+        index_offset = self.f.tell()
+        self.f.write(b"".join(self.records))
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, self.clock_rate, len(self.records), index_offset))
+        self.f.close()
+
+
+class VodStore:
+    """Finds packet stores for titles and packetizes new ones in the background on first access"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance.stores = {}  # store path -> RTPStore
+                    instance.current = {}  # real path of a title -> path of its store in stores
+                    instance.jobs = set()
+                    instance.lock = threading.Lock()
+                    cls._instance = instance
+        return cls._instance
+
+    def get(self, content_source):
+        """Returns an RTPStore, or None if the title isn't packetized (yet)"""
+        if not Config().get("vod_store"):
+            return None
+        try: path = store_path(content_source)
+        except OSError: return None  # not a file
+        with self.lock:
+            if path in self.stores: return self.stores[path]
+        if os.path.isfile(os.path.join(path, "meta.json")):
+            try:
+                with open(os.path.join(path, "meta.json")) as f:
+                    store = RTPStore(path, json.load(f))
+            except (OSError, ValueError) as e:
+                logging.error(f"Broken packet store {path}: {e}")
+                return None
+            with self.lock:
+                # a replaced or re-encoded title has a new store; the old one is unmapped once no session plays it
+                real = os.path.realpath(content_source)
+                if self.current.get(real, path) != path: self.stores.pop(self.current[real], None)
+                self.current[real] = path
+                return self.stores.setdefault(path, store)
+        if Config().get("vod_store_on_first_access", True):
+            self.packetize_async(content_source, path)
+        return None
+
+    def packetize_async(self, content_source, path):
+        with self.lock:
+            if path in self.jobs: return
+            self.jobs.add(path)
+        threading.Thread(target=self.packetize, args=(content_source, path), daemon=True).start()
+
+    def packetize(self, content_source, path=None):
+        path = path or store_path(content_source)
+        try:
+            Packetizer(content_source, path).run()
+        except Exception as e:
+            logging.error(f"Failed to packetize {content_source}: {e}")
+        finally:
+            with self.lock: self.jobs.discard(path)
+
+
+class PacedStream:
+    """One track of one session being played from a store"""
+    def __init__(self, track, store_track, start_idx, ref_ts, end_ts, t0):
+        self.track = track
+        self.st = store_track
+        self.idx = start_idx
+        self.ref_ts = ref_ts  # store timestamp that plays at t0
+        self.end_ts = end_ts
+        self.t0 = t0
+        self.max_ts = ref_ts
+        self.active = True
+        self.packets = 0
+        self.octets = 0
+        self.next_sr = t0
+        self.due = t0
+        self.update_due()
+
+    def update_due(self):
+        if self.idx >= len(self.st.offsets):
+            self.due = None
+            return
+        self.max_ts = max(self.max_ts, self.st.ts[self.idx])
+        self.due = self.t0 + (self.max_ts - self.ref_ts) / self.st.clock_rate
+
+    def send_due(self, now, buf, view):
+        """Send every packet that is due; returns False once the stream is finished"""
+        track = self.track
+        while self.due is not None and self.due <= now:
+            i = self.idx
+            ts = self.st.ts[i]
+            if self.end_ts is not None and ts > self.end_ts:
+                return False
+            off, length = self.st.offsets[i], self.st.lengths[i]
+            buf[:length] = self.st.mm[off:off+length]
+            track.last_seq = (track.last_seq + 1) & 0xFFFF
+            struct.pack_into("!HII", buf, 2, track.last_seq, (ts + track.ts_offset) & 0xFFFFFFFF, track.ssrc)
+            track.on_data(view[:length], track.track_id, 0)
+            track.packets += 1
+            track.octets += length
+            self.packets += 1
+            self.octets += length - 12
+            self.idx += 1
+            self.update_due()
+        if now >= self.next_sr and self.packets and not Config().get("disable_rtcp"):
+            rtp_now = self.ref_ts + int((now - self.t0) * self.st.clock_rate) + track.ts_offset
+            track.on_data(sender_report(track.ssrc, rtp_now, self.packets, self.octets), track.track_id, 1)
+            self.next_sr = now + SR_INTERVAL
+        return self.due is not None
+
+    def next_wakeup(self):
+        if self.due is None: return self.next_sr
+        return min(self.due, self.next_sr) if self.packets else self.due
+
+
+class VodPacer:
+    """A single thread that sends packets of every store-backed stream on time"""
+    _instance = None
+    _create_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._create_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance.heap = []
+                    instance.counter = 0
+                    instance.cond = threading.Condition()
+                    instance.buf = bytearray(65536)
+                    instance.view = memoryview(instance.buf)
+                    threading.Thread(target=instance.run, name="vod-pacer", daemon=True).start()
+                    cls._instance = instance
+        return cls._instance
+
+    def add(self, stream):
+        with self.cond:
+            self.push(stream)
+            self.cond.notify()
+
+    def remove(self, stream):
+        stream.active = False  # dropped lazily when it reaches the top of the heap
+
+    def push(self, stream):
+        self.counter += 1
+        heapq.heappush(self.heap, (stream.next_wakeup(), self.counter, stream))
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap: self.cond.wait()
+                due, _, stream = self.heap[0]
+                if not stream.active:
+                    heapq.heappop(self.heap)
+                    continue
+                delay = due - monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+            try:
+                more = stream.send_due(monotonic(), self.buf, self.view)
+            except Exception as e:
+                logging.error(f"Paced stream stopped (session {stream.track.session.session_id}): {e}")
+                more = False
+            if more and stream.active:
+                with self.cond: self.push(stream)
+
+
+def play_from_store(store, tracks, start_time=0, end_time=None):
+    """Start store-backed playback for a session's tracks; all tracks start at the video keyframe before start_time"""
+    start = store.seek_time(start_time)
+    t0 = monotonic()
+    pacer = VodPacer()
+    for track in tracks:
+        st = store.tracks[track.track_id]
+        ref_ts = round(start * st.clock_rate)
+        end_ts = int(end_time * st.clock_rate) if end_time is not None else None
+        track.ts_offset = track.initial_ts_offset
+        track.paced = PacedStream(track, st, st.index_at(start), ref_ts, end_ts, t0)
+        pacer.add(track.paced)
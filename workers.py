@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import socket
+import logging
+import selectors
+import threading
+import multiprocessing
+from Utils import Config
+from Utils.ports import PortAllocator
+
+# how long the supervisor keeps a tunnel POST whose GET it hasn't heard of yet; the announcement may be on its way
+TUNNEL_WAIT = 2
+# cookies of GETs whose POST never came are forgotten after this
+TUNNEL_TTL = 60
+# largest control message: a request handed over with the bytes received after it
+MAX_MESSAGE = 256 * 1024
+
+
+def pack(header, data=b""):
+    return json.dumps(header).encode() + b"\n" + data
+
+def unpack(msg):
+    header, _, data = msg.partition(b"\n")
+    return json.loads(header), data
+
+
+class WorkerLink:
+    """A worker's end of its control socket to the supervisor. Tunnel GETs are announced over it,
+    connections another worker has to serve are handed over with their file descriptor, and the ones
+    routed to this worker come in"""
+    def __init__(self, index, count, sock):
+        self.index = index
+        self.count = count
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, header, data=b"", fds=()):
+        with self.lock:
+            socket.send_fds(self.sock, [pack(header, data)], list(fds))
+
+    def announce_tunnel(self, xsc):
+        """The GET half of tunnel xsc waits here; sent before the GET is answered, so it's ahead of the POST"""
+        self.send({"op": "tunnel_get", "xsc": xsc})
+
+    def hand_off(self, fd, route, data):
+        """Pass a client connection on, with what was received from it and not handled yet. The caller closes fd"""
+        self.send({"op": "handoff", "route": route}, data, [fd])
+
+    def serve(self, accept):
+        """Call accept(sock, data) for every connection routed to this worker"""
+        threading.Thread(target=self.run, args=(accept,), name="worker-link", daemon=True).start()
+
+    def run(self, accept):
+        while True:
+            msg, fds, _, _ = socket.recv_fds(self.sock, MAX_MESSAGE, 1)
+            if not msg:
+                logging.critical("Supervisor is gone, stopping")
+                os._exit(1)
+            _, data = unpack(msg)
+            for fd in fds:
+                conn = socket.socket(fileno=fd)
+                try: accept(conn, data)
+                except Exception as e:
+                    logging.error(f"Can't take over a connection: {e}")
+                    conn.close()
+
+
+def run_worker(index, count, sock, inherited):
+    for fd in inherited: os.close(fd)  # the supervisor's ends of the other workers' links
+    logging.basicConfig(level=Config().get("log_level", 40), force=True,
+                        format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s")
+    PortAllocator.partition(index, count)
+    link = WorkerLink(index, count, sock)
+    if Config().get("server_core") == "asyncio":
+        from async_server import AsyncRTSPServer
+        AsyncRTSPServer(link)
+    else:
+        from main import RTSPServer
+        RTSPServer(link)
+
+
+class Supervisor:
+    """Runs workers processes that all accept on main_port (SO_REUSEPORT) and routes connections between them.
+    Each worker has its own sessions, relays and share of the port ranges. What can't be split goes to one worker:
+    multicast sessions are handed to worker 0, which hosts every multicast group, and the POST half of an HTTP
+    tunnel to the worker holding its GET. Workers that die are restarted"""
+    def __init__(self, count):
+        self.count = count
+        self.ctx = multiprocessing.get_context("fork")  # workers start from the loaded config and modules
+        self.procs = [None] * count
+        self.links = [None] * count  # supervisor's end of each worker's control socket
+        self.tunnels = {}  # x-sessioncookie -> (worker, time announced)
+        self.waiting = []  # (deadline, route, data, fd) of tunnel POSTs whose GET isn't known yet
+        self.selector = selectors.DefaultSelector()
+
+    def run(self):
+        for index in range(self.count): self.start_worker(index)
+        print(f"Started RTSP server at port {Config().get("main_port")} ({self.count} workers)")
+        while True:
+            for key, _ in self.selector.select(timeout=0.5):
+                self.on_message(key.data, key.fileobj)
+            self.expire()
+            self.check_workers()
+
+    def start_worker(self, index):
+        if self.links[index] is not None:
+            self.selector.unregister(self.links[index])
+            self.links[index].close()
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        inherited = [link.fileno() for link in self.links if link is not None] + [ours.fileno()]
+        proc = self.ctx.Process(target=run_worker, args=(index, self.count, theirs, inherited), name=f"worker-{index}")
+        proc.start()
+        theirs.close()
+        self.procs[index], self.links[index] = proc, ours
+        self.selector.register(ours, selectors.EVENT_READ, index)
+
+    def check_workers(self):
+        for index, proc in enumerate(self.procs):
+            if proc.is_alive(): continue
+            logging.error(f"Worker {index} exited with {proc.exitcode}, restarting it")
+            self.start_worker(index)
+
+    def on_message(self, index, sock):
+        try:
+            msg, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, 1)
+        except OSError:
+            msg, fds = b"", []
+        if not msg:
+            self.selector.unregister(sock)  # the worker is exiting; check_workers restarts it
+            self.links[index] = None
+            sock.close()
+            return
+        header, data = unpack(msg)
+        if header["op"] == "tunnel_get":
+            self.tunnels[header["xsc"]] = (index, time.monotonic())
+            waiting, self.waiting = self.waiting, []
+            for deadline, route, data, fd in waiting: self.route(route, data, fd, deadline)
+        elif header["op"] == "handoff" and fds:
+            self.route(header["route"], data, fds[0])
+
+    def route(self, route, data, fd, deadline=None):
+        if route[0] == "multicast":
+            target = 0
+        else:
+            target = self.tunnels.pop(route[1], (None,))[0]
+            if target is None:
+                self.waiting.append((deadline or time.monotonic() + TUNNEL_WAIT, route, data, fd))
+                return
+        try:
+            socket.send_fds(self.links[target], [pack({"op": "accept"}, data)], [fd])
+        except (OSError, AttributeError) as e:
+            logging.error(f"Can't hand a connection to worker {target}: {e}")
+        finally:
+            os.close(fd)
+
+    def expire(self):
+        now = time.monotonic()
+        for deadline, route, _, fd in [w for w in self.waiting if w[0] <= now]:
+            logging.warning(f"HTTP tunnel POST for unknown x-sessioncookie {route[1]}, closing it")
+            os.close(fd)
+        self.waiting = [w for w in self.waiting if w[0] > now]
+        self.tunnels = {xsc: (index, at) for xsc, (index, at) in self.tunnels.items() if now - at < TUNNEL_TTL}